@@ -0,0 +1,15 @@
+import pcssTools
+import configobj
+
+import sys
+import os
+
+#Dry run for sizing cluster submissions: writes a manifest of the disopred / psipred / PSI-BLAST / model retrieval / DSSP
+#computations a run with this config would need to the run directory, without running any of them
+
+configFileName = sys.argv[1]
+
+pcssConfig = configobj.ConfigObj(configFileName)
+runner = pcssTools.FeaturePlanRunner(pcssConfig)
+runner.execute()
+print runner.pdh.getFullOutputFile(runner.internalConfig["feature_plan_file_name"])
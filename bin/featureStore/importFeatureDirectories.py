@@ -0,0 +1,80 @@
+"""Import existing disopred / psipred result directories into a SQLite sequence feature store.
+
+Usage:
+    python importFeatureDirectories.py <database file> <feature name> <root result dir> [<feature name> <root result dir> ...]
+
+Feature names are disopred (.diso files) and psipred (.ss2 files). Root result dirs are laid out the way
+SequenceFeatureFileHandler writes them (<root>/<first two letters of modbase id>/<modbase id>.<suffix>).
+Each result file is parsed and saved the same way SequenceFeatureRunner saves new results when
+sequence_feature_store = sqlite; existing results for the same ids are replaced. Files that can't be parsed
+are reported and skipped. Set sequence_feature_database in the internal config to the database file
+afterwards."""
+
+import sys
+import os
+import pcssErrors
+import pcssFeatures
+import pcssFeatureHandlers
+
+featureFileTypes = {"disopred" : ("diso", pcssFeatures.DisopredSequenceFeatureCallSet),
+                    "psipred" : ("ss2", pcssFeatures.PsipredSequenceFeatureCallSet)}
+
+batchSize = 1000
+
+def iterateResultFiles(rootDir, suffix):
+    """Yield (modbase id, full path) for every result file in the two letter directories under rootDir"""
+    for twoLetterDir in sorted(os.listdir(rootDir)):
+        fullTwoLetterDir = os.path.join(rootDir, twoLetterDir)
+        if (not os.path.isdir(fullTwoLetterDir)):
+            continue
+        for fileName in sorted(os.listdir(fullTwoLetterDir)):
+            [modbaseSeqId, fileSuffix] = os.path.splitext(fileName)
+            if (fileSuffix == ".%s" % suffix):
+                yield (modbaseSeqId, os.path.join(fullTwoLetterDir, fileName))
+
+def importResultDirectory(featureStore, featureName, rootDir):
+    """Save all result files under rootDir to featureStore, batchSize files per transaction; return counts"""
+    (suffix, callSetClass) = featureFileTypes[featureName]
+    importedCount = 0
+    failedCount = 0
+    callSets = {}
+    for (modbaseSeqId, resultFile) in iterateResultFiles(rootDir, suffix):
+        try:
+            callSets[modbaseSeqId] = callSetClass.fromResultFile(resultFile)
+        except (pcssErrors.PeptideException, IOError), e:
+            print "skipping %s: %s" % (resultFile, getattr(e, "msg", e))
+            failedCount += 1
+            continue
+        if (len(callSets) >= batchSize):
+            featureStore.putCallSets(featureName, callSets)
+            importedCount += len(callSets)
+            callSets = {}
+            print "%s: imported %s results" % (featureName, importedCount)
+    featureStore.putCallSets(featureName, callSets)
+    importedCount += len(callSets)
+    return [importedCount, failedCount]
+
+def main():
+    if (len(sys.argv) < 4 or len(sys.argv) % 2 != 0):
+        print __doc__
+        sys.exit(1)
+    databaseFile = sys.argv[1]
+    featureDirs = zip(sys.argv[2::2], sys.argv[3::2])
+    for (featureName, rootDir) in featureDirs:
+        if (featureName not in featureFileTypes):
+            print "Unknown feature name %s (expected one of %s)" % (featureName, ", ".join(sorted(featureFileTypes)))
+            sys.exit(1)
+        if (not os.path.isdir(rootDir)):
+            print "Result directory %s does not exist" % rootDir
+            sys.exit(1)
+
+    featureStore = pcssFeatureHandlers.SequenceFeatureStore(databaseFile)
+    try:
+        for (featureName, rootDir) in featureDirs:
+            [importedCount, failedCount] = importResultDirectory(featureStore, featureName, rootDir)
+            print "%s: imported %s results from %s (%s skipped)" % (featureName, importedCount, rootDir, failedCount)
+    finally:
+        featureStore.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,24 @@
+"""Build the seq_id offset index for a model table file.
+
+Usage:
+    python indexModelTable.py <model table file>
+
+PcssModelTable builds the index (<model table file>.pcssidx) the first time it opens a table with
+index_model_table set, but can't save it if the table's directory isn't writable by the run. Running this once
+after a new table is generated saves the index so every later run only reads the lines of its own proteins.
+The index is rebuilt automatically if the table changes."""
+
+import sys
+import pcssIO
+
+def main():
+    if (len(sys.argv) != 2):
+        print __doc__
+        sys.exit(1)
+    indexedTable = pcssIO.IndexedModelTableFile(sys.argv[1])
+    print "Indexed %s sequences (%s line ranges) in %s" % (len(indexedTable.getSequenceIds()), len(indexedTable.recordEntries),
+                                                           indexedTable.getIndexFileName())
+    indexedTable.close()
+
+if __name__ == '__main__':
+    main()
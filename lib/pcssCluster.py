@@ -18,18 +18,29 @@ class SeqDivider:
         self.pcssRunner = pcssRunner
         self.pdh = pcssRunner.pdh
         self.subDirectories = []
+        self.indexedFasta = None
 
     def getFastaGroupList(self, fastaFile):
-        fh = open(fastaFile, 'r')
-        fastaList = sorted(list(SeqIO.FastaIO.FastaIterator(fh)), key=lambda x: x.id)
+        """Divide the records in the fasta file, sorted by id, into groups of size seq_batch_size
+
+        Groups hold indices of records in the indexed fasta file (so records sharing an id each keep their own
+        sequence); sequences are read from the file when batch files are written. The file stays open for that
+        until closeFastaFile() is called"""
+        self.closeFastaFile()
+        self.indexedFasta = pcssIO.IndexedFastaFile(fastaFile)
+        entryIndexList = self.indexedFasta.getSortedEntryIndices()
         seqBatchSize = int(self.pcssRunner.internalConfig["seq_batch_size"])
 
         print "seq batch size: %s" % seqBatchSize
-        seqGroupList = [fastaList[i:i+seqBatchSize] for i in range(0, len(fastaList), seqBatchSize)]
-        fh.close()
+        seqGroupList = [entryIndexList[i:i+seqBatchSize] for i in range(0, len(entryIndexList), seqBatchSize)]
         self.seqBatchCount = len(seqGroupList)
         return seqGroupList
 
+    def closeFastaFile(self):
+        if (self.indexedFasta is not None):
+            self.indexedFasta.close()
+            self.indexedFasta = None
+
     def getSeqBatchCount(self):
         return self.seqBatchCount
 
@@ -43,6 +54,7 @@ class SeqDivider:
         
         fastaFile = self.pcssRunner.pcssConfig['fasta_file']
         seqGroupList = self.getFastaGroupList(fastaFile)
+        self.closeFastaFile()
         print "merging application results"
         seqBatchDirectory = self.pdh.getSeqBatchDirectory()
         allProteins = []
@@ -73,6 +85,7 @@ class SeqDivider:
         
         fastaFile = self.pcssRunner.pcssConfig['fasta_file']
         seqGroupList = self.getFastaGroupList(fastaFile)
+        self.closeFastaFile()
 
         seqBatchDirectory = self.pdh.getSeqBatchDirectory()
         allProteins = []
@@ -94,10 +107,13 @@ class SeqDivider:
 
         seqBatchDirectory = self.pdh.getSeqBatchDirectory()
         
-        for (i, nextGroup) in enumerate(seqGroupList):
-            self.createSequenceSubDirectory(i)
+        try:
+            for (i, nextGroup) in enumerate(seqGroupList):
+                self.createSequenceSubDirectory(i)
 
-            self.makeSeqBatchFile(i, nextGroup)
+                self.makeSeqBatchFile(i, nextGroup)
+        finally:
+            self.closeFastaFile()
         
     def createSequenceSubDirectory(self, i):
         subDirectoryName = self.pdh.getSeqBatchSubDirectoryName(i)
@@ -107,9 +123,9 @@ class SeqDivider:
     def makeSeqBatchFile(self, i, seqBatch):
         fileName = self.pdh.getSeqBatchFastaFileName(i)
         fh = open(fileName, 'w')
-        for seqRecord in seqBatch:
-            fh.write(">%s\n" % seqRecord.id)
-            fh.write("%s\n" % str(seqRecord.seq))
+        for entryIndex in seqBatch:
+            fh.write(">%s\n" % self.indexedFasta.getRecordIdForEntry(entryIndex))
+            fh.write("%s\n" % self.indexedFasta.getSequenceForEntry(entryIndex))
         fh.close()
 
     def makeRunDisopredSgeScript(self):
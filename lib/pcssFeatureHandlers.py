@@ -10,12 +10,23 @@ import pcssFeatures
 import tempfile
 import shutil
 import time
+import multiprocessing.pool
+import threading
+import mmap
+import sqlite3
+import zlib
+import numpy
 log = logging.getLogger("pcssFeatureHandlers")
 
 
 class SequenceFeatureFileHandler:
     
-    """Base class for handling sequence-feature specific file and directory information"""
+    """Base class for handling sequence-feature specific file and directory information
+
+    If featureStore is set, results are kept in that SequenceFeatureStore instead of in one file per protein;
+    the result file only exists in the temporary directory the algorithm runs in"""
+
+    featureStore = None
 
     def getSequenceFeatureFile(self, modbaseSeqId):
         """Return the full path file name for the sequence feature containing results for input sequence ID"""
@@ -27,20 +38,33 @@ class SequenceFeatureFileHandler:
         return os.path.join(self.getRootDataDir(), self.pdh.getTwoLetterOutputDir(modbaseSeqId))
 
     def outputFileExists(self, modbaseSeqId):
+        if (self.featureStore is not None):
+            return self.featureStore.hasResult(self.getName(), modbaseSeqId)
         return os.path.exists(self.getSequenceFeatureFile(modbaseSeqId))
 
+    def getExistingResultIds(self, modbaseSeqIds):
+        """Return set of the given ids that already have a result; one query per chunk of ids with a feature store"""
+        if (self.featureStore is not None):
+            return self.featureStore.getExistingIds(self.getName(), modbaseSeqIds)
+        return set([modbaseSeqId for modbaseSeqId in modbaseSeqIds if self.outputFileExists(modbaseSeqId)])
+
 class DisopredFileHandler(SequenceFeatureFileHandler):
     """Class providing Disopred-specific data for running algorithm and processing results"""
-    def __init__(self, pcssConfig, pdh):
+    def __init__(self, pcssConfig, pdh, featureStore=None):
         self.outputFileSuffix = "diso"
         self.pdh = pdh
         self.sequenceCmd = self.pdh.internalConfig["run_disopred_command"]
+        self.pssmSequenceCmd = self.pdh.internalConfig["run_disopred_from_pssm_command"]
         self.pcssConfig = pcssConfig
         self.name = "disopred"
+        self.featureStore = featureStore
 
     def getRootDataDir(self):
         return self.pdh.internalConfig["root_disopred_dir"]
 
+    def getCallSetClass(self):
+        return pcssFeatures.DisopredSequenceFeatureCallSet
+
     def getName(self):
         return self.name
 
@@ -49,15 +73,20 @@ class DisopredFileHandler(SequenceFeatureFileHandler):
     
 class PsipredFileHandler(SequenceFeatureFileHandler):
     """Class providing Psipred-specific data for running algorithm and processing results"""
-    def __init__(self, pcssConfig, pdh):
+    def __init__(self, pcssConfig, pdh, featureStore=None):
         self.outputFileSuffix = "ss2"
         self.pdh = pdh
         self.sequenceCmd = self.pdh.internalConfig["run_psipred_command"]
+        self.pssmSequenceCmd = self.pdh.internalConfig["run_psipred_from_pssm_command"]
         self.pcssConfig = pcssConfig
         self.name = "psipred"
+        self.featureStore = featureStore
 
     def getRootDataDir(self):
         return self.pdh.internalConfig["root_psipred_dir"]
+
+    def getCallSetClass(self):
+        return pcssFeatures.PsipredSequenceFeatureCallSet
                 
     def getName(self):
         return self.name
@@ -65,19 +94,107 @@ class PsipredFileHandler(SequenceFeatureFileHandler):
     def getCommandException(self, msg):
         return pcssErrors.PcssGlobalException(msg)
 
+class PssmFileHandler(SequenceFeatureFileHandler):
+    """Class providing data for the PSI-BLAST profile (PSSM) stage shared by disopred and psipred
+
+    The search checkpoint (.chk) and the PSSM made from it (.mtx) are kept in the same two letter directory tree
+    as the predictor results, keyed by modbase id"""
+    def __init__(self, pcssConfig, pdh):
+        self.outputFileSuffix = "mtx"
+        self.checkpointFileSuffix = "chk"
+        self.pdh = pdh
+        self.sequenceCmd = self.pdh.internalConfig["run_pssm_command"]
+        self.batchSequenceCmd = self.pdh.internalConfig["run_pssm_batch_command"]
+        self.pcssConfig = pcssConfig
+        self.name = "pssm"
+
+    def getRootDataDir(self):
+        return self.pdh.internalConfig["root_pssm_dir"]
+                
+    def getName(self):
+        return self.name
+
+    def getCheckpointFile(self, modbaseSeqId):
+        return os.path.join(self.getSequenceFeatureDir(modbaseSeqId), "%s.%s" % (modbaseSeqId, self.checkpointFileSuffix))
+
+    def getCommandException(self, msg):
+        return pcssErrors.PcssGlobalException(msg)
+
 class SequenceFeatureRunner:
     
     """Class that runs algorithm to calculate a sequence feature for a pcssProtein"""
 
-    def __init__(self, sequenceFileHandler):
+    def __init__(self, sequenceFileHandler, pssmRunner=None):
+        """@param pssmRunner: if set, the PSI-BLAST profile is made (or read from cache) by this PssmRunner and the
+        file handler's pssmSequenceCmd runs only the prediction step from it"""
         self.sfh = sequenceFileHandler
+        self.pssmRunner = pssmRunner
+
+    def getWorkerCount(self):
+        return self.sfh.pdh.internalConfig.as_int("sequence_feature_worker_count")
+
+    def getTimeout(self):
+        """Return number of seconds a single run may take before it is killed; None if there is no limit"""
+        timeout = self.sfh.pdh.internalConfig.as_int("sequence_feature_timeout")
+        if (timeout == 0):
+            return None
+        return timeout
+
+    def runMissingSequenceFeatures(self, pcssProteins):
+        """Run the algorithm for every protein that doesn't have a result file yet, several proteins at a time
+
+        Called before proteins read their results, so the slow runs for a group of proteins overlap instead of 
+        happening one after the other. Runs are done in a thread pool of size sequence_feature_worker_count; each run
+        is its own subprocess in its own temp directory. Every run is allowed to finish; if any failed, the first 
+        exception is raised afterwards."""
+        missingProteins = self.getMissingProteins(pcssProteins)
+        if (len(missingProteins) == 0):
+            return
+        if (self.pssmRunner is not None):
+            self.pssmRunner.runMissingSequenceFeatures(missingProteins.values())
+        workerCount = min(self.getWorkerCount(), len(missingProteins))
+        log.info("Running %s for %s proteins with %s workers" % (self.sfh.getName(), len(missingProteins), workerCount))
+        pool = multiprocessing.pool.ThreadPool(workerCount)
+        try:
+            exceptions = pool.map(self.runSequenceFeatureJob, missingProteins.values())
+        finally:
+            pool.close()
+            pool.join()
+        for exception in exceptions:
+            if (exception is not None):
+                raise exception
+
+    def getMissingProteins(self, pcssProteins):
+        """Return dictionary of proteins without errors that don't have a result file yet, keyed by modbase id"""
+        candidateProteins = {}
+        for pcssProtein in pcssProteins:
+            if (not pcssProtein.hasErrors()):
+                candidateProteins[pcssProtein.modbaseSequenceId] = pcssProtein
+        for modbaseSeqId in self.sfh.getExistingResultIds(candidateProteins.keys()):
+            del candidateProteins[modbaseSeqId]
+        return candidateProteins
+
+    def runSequenceFeatureJob(self, pcssProtein):
+        """Run the algorithm for one protein in a pool worker; return the exception it raised, or None"""
+        try:
+            self.runSequenceFeature(pcssProtein)
+        except pcssErrors.PeptideException, e:
+            #result file could not be parsed into the feature store; nothing is saved, so the protein runs again when
+            #it reads its result and gets this error there, where it is recorded for its peptides. Caught before
+            #ProteinException, which it subclasses
+            log.warning("Protein %s: could not save %s result (%s)" % (pcssProtein.modbaseSequenceId, self.sfh.getName(), e.msg))
+        except (pcssErrors.ProteinException, pcssErrors.PcssGlobalException), e:
+            return e
+        return None
 
     def runSequenceFeature(self, pcssProtein):
         """Call command for running shell script to run the sequence feature algorithm. 
 
-        Script runs in a temporary directory and copies results to permanent output location, defined by parameters
+        Script runs in a temporary directory and copies results to permanent output location, defined by parameters.
+        The script is started with the temporary directory as its working directory rather than changing the
+        directory of this process, so several proteins can be run at once from different threads.
         """
-        tempDirectory = pcssProtein.pcssRunner.pdh.makeTempDirectory()
+        tempDirectory = pcssProtein.pcssRunner.pdh.makeTempDirectory(changeDirectory=False)
 
         try:
             self.runSequenceSubprocess(pcssProtein, tempDirectory.tempDir)
@@ -87,11 +204,24 @@ class SequenceFeatureRunner:
         except pcssErrors.PcssGlobalException, e:
             tempDirectory.changeBack()
             raise e
-        outputFile = self.getSequenceFeatureOutputFile(pcssProtein)
+        try:
+            self.saveResult(pcssProtein, tempDirectory.tempDir)
+        finally:
+            tempDirectory.changeBack()
+
+    def saveResult(self, pcssProtein, tempDir):
+        """Save result from tempDir to its two letter directory, or parse it into the feature store if there is one"""
+        if (self.sfh.featureStore is not None):
+            resultFile = os.path.join(tempDir, self.getSequenceFeatureOutputFile(pcssProtein))
+            callSet = self.sfh.getCallSetClass().fromResultFile(resultFile)
+            self.sfh.featureStore.putCallSet(self.sfh.getName(), pcssProtein.modbaseSequenceId, callSet)
+            return
         destinationDir = self.makeSeqFeatureDirectory(pcssProtein)
-        
-        pcssProtein.pcssRunner.pdh.moveFile(tempDirectory.tempDir, outputFile, destinationDir)
-        tempDirectory.changeBack()
+        self.moveOutputFiles(pcssProtein, tempDir, destinationDir)
+
+    def moveOutputFiles(self, pcssProtein, tempDir, destinationDir):
+        outputFile = self.getSequenceFeatureOutputFile(pcssProtein)
+        pcssProtein.pcssRunner.pdh.moveFile(tempDir, outputFile, destinationDir)
         
 
     def getSequenceFeatureOutputFile(self, pcssProtein):
@@ -100,36 +230,323 @@ class SequenceFeatureRunner:
     def runSequenceSubprocess(self, pcssProtein, cwd):
         """Run system command that runs disopred / psipred algorithm"""
         fastaFile = pcssProtein.writeSequenceToFasta(cwd)
-        print "running command %s" % self.sfh.sequenceCmd
-        commandList = self.sfh.sequenceCmd.split(" ")
+        commandList = self.getCommandList(pcssProtein)
+        log.debug("Protein %s: running command %s" % (pcssProtein.modbaseSequenceId, " ".join(commandList)))
         commandList.append(fastaFile)
+        if (self.pssmRunner is not None):
+            commandList.append(self.pssmRunner.getPssmFile(pcssProtein))
         
-        output = self.sfh.pdh.runSubprocess(commandList, checkStdError=False)
+        output = self.sfh.pdh.runSubprocess(commandList, checkStdError=False, cwd=cwd, timeout=self.getTimeout())
         
-        outputFile = self.getSequenceFeatureOutputFile(pcssProtein)
+        outputFile = os.path.join(cwd, self.getSequenceFeatureOutputFile(pcssProtein))
         if (not os.path.exists(outputFile)):
 
             raise self.sfh.getCommandException("Finished %s command\nOutput file not where expected (looked for %s).\n "
                                         "Note that disopred/psipred can take hours to run on long sequences; "
                                         "Your job might have timed out. Command output: \n%s" %
-                                        (self.sfh.sequenceCmd, outputFile, output[1]))
+                                        (" ".join(commandList), outputFile, output[1]))
+
+    def getCommandList(self, pcssProtein):
+        """Return command for this protein, without its input files, as a list of arguments"""
+        if (self.pssmRunner is not None):
+            return self.sfh.pssmSequenceCmd.split(" ")
+        return self.sfh.sequenceCmd.split(" ")
     
     def makeSeqFeatureDirectory(self, pcssProtein):
         """Make directory where sequence feature result will be stored (two letter prefix)"""
         destinationDir = self.sfh.getSequenceFeatureDir(pcssProtein.modbaseSequenceId)
 
-        self.sfh.pdh.runSubprocess(["mkdir", "-p", destinationDir])
-        self.sfh.pdh.sleepUntilDone(destinationDir, predicate=self.sfh.pdh.fileDoesNotExist)
+        self.sfh.pdh.makeDirectory(destinationDir)
 
         return destinationDir
 
+class PssmRunner(SequenceFeatureRunner):
+
+    """Runs PSI-BLAST and makemat once per sequence and caches the checkpoint and PSSM for the predictors"""
+
+    def __init__(self, pssmFileHandler):
+        SequenceFeatureRunner.__init__(self, pssmFileHandler)
+        self.sequenceLocks = {}
+        self.sequenceLocksLock = threading.Lock()
+
+    def getSequenceLock(self, modbaseSeqId):
+        """Return the lock that serializes profile searches for this sequence, making it if there isn't one yet"""
+        with self.sequenceLocksLock:
+            return self.sequenceLocks.setdefault(modbaseSeqId, threading.Lock())
+
+    def getPssmFile(self, pcssProtein):
+        """Return cached PSSM file for this protein, running the profile search first if there isn't one yet
+
+        Only callers asking for the same sequence wait for each other, so predictor threads for different proteins
+        run their searches at the same time."""
+        with self.getSequenceLock(pcssProtein.modbaseSequenceId):
+            if (not self.sfh.outputFileExists(pcssProtein.modbaseSequenceId)):
+                log.debug("Protein %s: pssm file does not exist; creating new..." % pcssProtein.modbaseSequenceId)
+                self.runSequenceFeature(pcssProtein)
+        return self.sfh.getSequenceFeatureFile(pcssProtein.modbaseSequenceId)
+
+    def useBatchSearch(self):
+        return self.sfh.pdh.internalConfig["use_batch_pssm"]
+
+    def runMissingSequenceFeatures(self, pcssProteins):
+        """Make profiles for all proteins that don't have one yet. In batch mode (use_batch_pssm), all of them are
+        made by one run of the batch command on a multi-FASTA file instead of one run per protein"""
+        if (not self.useBatchSearch()):
+            SequenceFeatureRunner.runMissingSequenceFeatures(self, pcssProteins)
+            return
+        missingProteins = self.getMissingProteins(pcssProteins)
+        if (len(missingProteins) == 0):
+            return
+        self.runBatchSearch(missingProteins.values())
+
+    def runBatchSearch(self, pcssProteins):
+        """Run the batch command on all proteins at once and move each profile into its two letter directory
+
+        A protein whose profile the batch run didn't produce is only logged here; getPssmFile() will search for it
+        on its own when a predictor asks for it, and that run reports the error if there is one."""
+        pdh = self.sfh.pdh
+        tempDirectory = pdh.makeTempDirectory(changeDirectory=False)
+        try:
+            batchFastaFile = self.writeBatchFasta(pcssProteins, tempDirectory.tempDir)
+            commandList = self.sfh.batchSequenceCmd.split(" ")
+            commandList.append(batchFastaFile)
+            log.info("Running batch pssm search for %s proteins: %s" % (len(pcssProteins), " ".join(commandList)))
+            timeout = self.getTimeout()
+            if (timeout is not None):
+                timeout *= len(pcssProteins)
+            output = pdh.runSubprocess(commandList, checkStdError=False, cwd=tempDirectory.tempDir, timeout=timeout)
+
+            for pcssProtein in pcssProteins:
+                outputFile = self.getSequenceFeatureOutputFile(pcssProtein)
+                if (not os.path.exists(os.path.join(tempDirectory.tempDir, outputFile))):
+                    log.warning("Protein %s: batch pssm search did not produce %s; will search for it separately. "
+                                "Command output: \n%s" % (pcssProtein.modbaseSequenceId, outputFile, output[1]))
+                    continue
+                destinationDir = self.makeSeqFeatureDirectory(pcssProtein)
+                self.moveOutputFiles(pcssProtein, tempDirectory.tempDir, destinationDir)
+        finally:
+            tempDirectory.changeBack()
+
+    def writeBatchFasta(self, pcssProteins, outputDir):
+        """Write all proteins to one multi-FASTA file, each headed by its modbase id"""
+        fastaFileName = os.path.join(outputDir, "pssmBatch.fasta")
+        fh = open(fastaFileName, 'w')
+        for pcssProtein in pcssProteins:
+            fh.write(">%s\n%s\n" % (pcssProtein.modbaseSequenceId, pcssProtein.proteinSequence))
+        fh.close()
+        return fastaFileName
+
+    def moveOutputFiles(self, pcssProtein, tempDir, destinationDir):
+        """Move the checkpoint before the PSSM; the PSSM is what marks the profile as complete"""
+        checkpointFile = "%s.%s" % (pcssProtein.modbaseSequenceId, self.sfh.checkpointFileSuffix)
+        pcssProtein.pcssRunner.pdh.moveFile(tempDir, checkpointFile, destinationDir)
+        SequenceFeatureRunner.moveOutputFiles(self, pcssProtein, tempDir, destinationDir)
+
+class SequenceFeatureStore:
+
+    """SQLite database holding sequence feature results for many proteins, instead of one result file per protein
+
+    Results are keyed by feature name (disopred, psipred) and modbase sequence id. Each is stored as the residue count
+    and a zlib-compressed blob of the call set's arrays: residue codes, call codes and has-call flags (one byte per
+    residue each) followed by float64 scores. Existence checks and reads take a list of ids and do one query per
+    chunk of ids, so a whole batch of proteins costs a few queries instead of a stat and a read per protein.
+
+    One store can be shared by the worker threads of a SequenceFeatureRunner; all access goes through one
+    connection guarded by a lock. Ids known to have results are remembered, since results are never removed."""
+
+    queryChunkSize = 500
+
+    def __init__(self, databaseFile):
+        self.databaseFile = databaseFile
+        self.lock = threading.Lock()
+        try:
+            self.connection = sqlite3.connect(databaseFile, timeout=60, check_same_thread=False)
+            self.connection.execute("CREATE TABLE IF NOT EXISTS sequence_feature (feature_name TEXT NOT NULL, "
+                                    "modbase_seq_id TEXT NOT NULL, residue_count INTEGER NOT NULL, arrays BLOB NOT NULL, "
+                                    "PRIMARY KEY (feature_name, modbase_seq_id))")
+            self.connection.commit()
+        except sqlite3.Error, e:
+            raise pcssErrors.PcssGlobalException("Could not open sequence feature store %s: %s" % (databaseFile, e))
+        self.knownResults = set()
+
+    def getIdChunks(self, modbaseSeqIds):
+        modbaseSeqIds = list(modbaseSeqIds)
+        for i in range(0, len(modbaseSeqIds), self.queryChunkSize):
+            yield modbaseSeqIds[i:i + self.queryChunkSize]
+
+    def hasResult(self, featureName, modbaseSeqId):
+        return modbaseSeqId in self.getExistingIds(featureName, [modbaseSeqId])
+
+    def getExistingIds(self, featureName, modbaseSeqIds):
+        """Return set of the given ids that have a result for this feature"""
+        existingIds = set()
+        unknownIds = set()
+        for modbaseSeqId in modbaseSeqIds:
+            if ((featureName, modbaseSeqId) in self.knownResults):
+                existingIds.add(modbaseSeqId)
+            else:
+                unknownIds.add(modbaseSeqId)
+        with self.lock:
+            for idChunk in self.getIdChunks(unknownIds):
+                cursor = self.connection.execute("SELECT modbase_seq_id FROM sequence_feature WHERE feature_name = ? AND "
+                                                 "modbase_seq_id IN (%s)" % ",".join("?" * len(idChunk)), [featureName] + idChunk)
+                for (modbaseSeqId,) in cursor:
+                    existingIds.add(modbaseSeqId)
+                    self.knownResults.add((featureName, modbaseSeqId))
+        return existingIds
+
+    def getCallSets(self, featureName, modbaseSeqIds, callSetClass):
+        """Return dictionary of callSetClass objects keyed by modbase id, for the given ids that have a result"""
+        callSets = {}
+        with self.lock:
+            for idChunk in self.getIdChunks(set(modbaseSeqIds)):
+                cursor = self.connection.execute("SELECT modbase_seq_id, residue_count, arrays FROM sequence_feature WHERE "
+                                                 "feature_name = ? AND modbase_seq_id IN (%s)" % ",".join("?" * len(idChunk)),
+                                                 [featureName] + idChunk)
+                for (modbaseSeqId, residueCount, arrays) in cursor:
+                    callSets[modbaseSeqId] = self.unpackCallSet(callSetClass, residueCount, arrays)
+        return callSets
+
+    def putCallSet(self, featureName, modbaseSeqId, callSet):
+        self.putCallSets(featureName, {modbaseSeqId : callSet})
+
+    def putCallSets(self, featureName, callSets):
+        """Save dictionary of call sets keyed by modbase id in one transaction, replacing any existing results"""
+        rows = [(featureName, modbaseSeqId, len(callSet.residueCodes), self.packCallSet(callSet))
+                for (modbaseSeqId, callSet) in callSets.iteritems()]
+        with self.lock:
+            with self.connection:
+                self.connection.executemany("INSERT OR REPLACE INTO sequence_feature (feature_name, modbase_seq_id, "
+                                            "residue_count, arrays) VALUES (?, ?, ?, ?)", rows)
+            for modbaseSeqId in callSets:
+                self.knownResults.add((featureName, modbaseSeqId))
+
+    def packCallSet(self, callSet):
+        arrays = "".join([callSet.residueCodes.astype('S1').tostring(), callSet.callCodes.astype('S1').tostring(),
+                          callSet.hasCall.astype(bool).tostring(), callSet.scores.astype(numpy.float64).tostring()])
+        return sqlite3.Binary(zlib.compress(arrays))
+
+    def unpackCallSet(self, callSetClass, residueCount, packedArrays):
+        arrays = zlib.decompress(packedArrays)
+        residueCodes = numpy.frombuffer(arrays, dtype='S1', count=residueCount, offset=0)
+        callCodes = numpy.frombuffer(arrays, dtype='S1', count=residueCount, offset=residueCount)
+        hasCall = numpy.frombuffer(arrays, dtype=bool, count=residueCount, offset=2 * residueCount)
+        scores = numpy.frombuffer(arrays, dtype=numpy.float64, count=residueCount, offset=3 * residueCount)
+        return callSetClass.fromArrays(residueCodes, callCodes, scores, hasCall)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
 class SequenceFeatureReader:
     
-    """Abstract class for reading Sequence Feature Result; needs to be sublcassed"""
+    """Abstract class for reading Sequence Feature Result; needs to be sublcassed
+
+    The text result file is parsed by the file handler's call set class. The first time a result is parsed, its arrays are
+    also written to a binary sidecar next to the result file (<result file>.pcssbin); later reads memory-map the
+    sidecar instead of parsing the text again. The sidecar records the result file's modification time and size and
+    is ignored (and rewritten) if either has changed. Sidecar layout: a fixed size text header, then residue codes,
+    call codes and has-call flags (one byte per residue each), then float64 scores starting at an 8 byte boundary;
+    scores are kept as float64 rather than float32 so output is the same as from parsing the text.
+
+    Result directories are often shared: sidecars are written to a temporary file and renamed into place, so
+    concurrent runs never read a partial one, and are not written at all where the run can't write."""
+
+    sidecarVersion = "PCSSSF1"
+    sidecarHeaderSize = 128
 
     def readResult(self, modbaseSeqId):
-        print "Error: sequenceFeatureReader should only be implemented as a subclass"
-        sys.exit()
+        """Return result for this sequence as a SequenceFeatureCallSet
+
+        Read from the feature store if the file handler has one (or taken from results already fetched for a batch
+        of proteins by prefetchResults()); otherwise from the result file's sidecar if it is current"""
+        if (modbaseSeqId in self.prefetchedResults):
+            return self.prefetchedResults.pop(modbaseSeqId)
+        if (self.sfh.featureStore is not None):
+            callSets = self.sfh.featureStore.getCallSets(self.sfh.getName(), [modbaseSeqId], self.sfh.getCallSetClass())
+            if (modbaseSeqId not in callSets):
+                raise pcssErrors.PcssGlobalException("Feature store %s has no %s result for sequence %s" % 
+                                                     (self.sfh.featureStore.databaseFile, self.sfh.getName(), modbaseSeqId))
+            return callSets[modbaseSeqId]
+        sequenceFile = self.sfh.getSequenceFeatureFile(modbaseSeqId)
+        if (not os.path.exists(sequenceFile)):
+            return self.parseResultFile(sequenceFile)
+        fileStat = os.stat(sequenceFile)
+        fileStamp = "%r\t%s" % (fileStat.st_mtime, fileStat.st_size)
+        sidecarFile = self.getSidecarFileName(sequenceFile)
+        callSet = self.readSidecar(sidecarFile, fileStamp)
+        if (callSet is None):
+            callSet = self.parseResultFile(sequenceFile)
+            self.writeSidecar(sidecarFile, fileStamp, callSet)
+        return callSet
+
+    def prefetchResults(self, pcssProteins):
+        """Read results of all proteins with one query per chunk of ids, if results are in a feature store; each is 
+        handed out (once) by readResult()"""
+        if (self.sfh.featureStore is None):
+            return
+        modbaseSeqIds = [pcssProtein.modbaseSequenceId for pcssProtein in pcssProteins if not pcssProtein.hasErrors()]
+        self.prefetchedResults.update(self.sfh.featureStore.getCallSets(self.sfh.getName(), modbaseSeqIds, self.sfh.getCallSetClass()))
+
+    def parseResultFile(self, sequenceFile):
+        return self.sfh.getCallSetClass().fromResultFile(sequenceFile)
+
+    def getSidecarFileName(self, sequenceFile):
+        return "%s.pcssbin" % sequenceFile
+
+    def getScoresOffset(self, residueCount):
+        unalignedOffset = self.sidecarHeaderSize + 3 * residueCount
+        return unalignedOffset + (-unalignedOffset % 8)
+
+    def readSidecar(self, sidecarFile, fileStamp):
+        """Return call set mapped from sidecarFile, or None if it is missing, stale or unreadable"""
+        if (not os.path.exists(sidecarFile)):
+            return None
+        fh = open(sidecarFile, 'rb')
+        try:
+            headerFields = fh.read(self.sidecarHeaderSize).rstrip().split('\t')
+            if (len(headerFields) != 4 or headerFields[0] != self.sidecarVersion or "\t".join(headerFields[1:3]) != fileStamp):
+                log.info("Result sidecar %s is out of date; reparsing result file" % sidecarFile)
+                return None
+            residueCount = int(headerFields[3])
+            scoresOffset = self.getScoresOffset(residueCount)
+            if (os.fstat(fh.fileno()).st_size != scoresOffset + 8 * residueCount):
+                log.info("Result sidecar %s has unexpected size; reparsing result file" % sidecarFile)
+                return None
+            sidecarMap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError), e:
+            log.info("Could not read result sidecar %s (%s); reparsing result file" % (sidecarFile, e))
+            return None
+        finally:
+            fh.close()
+        
+        codesOffset = self.sidecarHeaderSize
+        residueCodes = numpy.frombuffer(sidecarMap, dtype='S1', count=residueCount, offset=codesOffset)
+        callCodes = numpy.frombuffer(sidecarMap, dtype='S1', count=residueCount, offset=codesOffset + residueCount)
+        hasCall = numpy.frombuffer(sidecarMap, dtype=bool, count=residueCount, offset=codesOffset + 2 * residueCount)
+        scores = numpy.frombuffer(sidecarMap, dtype=numpy.float64, count=residueCount, offset=scoresOffset)
+        return self.sfh.getCallSetClass().fromArrays(residueCodes, callCodes, scores, hasCall)
+
+    def writeSidecar(self, sidecarFile, fileStamp, callSet):
+        """Save callSet to sidecarFile unless its directory isn't writable; if writing fails, just log it"""
+        if (not os.access(os.path.dirname(sidecarFile), os.W_OK)):
+            log.debug("Result directory of %s is not writable; not writing result sidecar" % sidecarFile)
+            return
+        residueCount = len(callSet.residueCodes)
+        header = "%s\t%s\t%s" % (self.sidecarVersion, fileStamp, residueCount)
+        padding = self.getScoresOffset(residueCount) - self.sidecarHeaderSize - 3 * residueCount
+
+        def writeArrays(fh):
+            fh.write(header.ljust(self.sidecarHeaderSize - 1) + "\n")
+            fh.write(callSet.residueCodes.astype('S1').tostring())
+            fh.write(callSet.callCodes.astype('S1').tostring())
+            fh.write(callSet.hasCall.astype(bool).tostring())
+            fh.write("\0" * padding)
+            fh.write(callSet.scores.astype(numpy.float64).tostring())
+        try:
+            self.sfh.pdh.publishFile(sidecarFile, writeArrays)
+        except (IOError, OSError), e:
+            log.info("Could not write result sidecar %s (%s)" % (sidecarFile, e))
         
 class DisopredReader(SequenceFeatureReader):
 
@@ -137,18 +554,7 @@ class DisopredReader(SequenceFeatureReader):
 
     def __init__(self, disopredFileHandler):
         self.sfh = disopredFileHandler
-
-    def readResult(self, modbaseSeqId):
-        """Read .diso result file and store all data as a SequenceFeatureCalls"""
-        sequenceFile = self.sfh.getSequenceFeatureFile(modbaseSeqId)
-        reader = pcssTools.PcssFileReader(sequenceFile)
-        lines = reader.getLines()
-        dpc = pcssFeatures.DisopredSequenceFeatureCallSet()
-        for i in range(4, len(lines)): #first four lines aren't commented but need to be skipped
-            disorderCall = pcssFeatures.DisorderResidueCall(lines[i])
-            dpc.addSequenceFeatureCall(disorderCall)
-        
-        return dpc
+        self.prefetchedResults = {}
 
 class PsipredReader(SequenceFeatureReader):
 
@@ -156,15 +562,5 @@ class PsipredReader(SequenceFeatureReader):
 
     def __init__(self, psipredFileHandler):
         self.sfh = psipredFileHandler
-
-    def readResult(self, modbaseSeqId):
-        """Read .ss2 result file and store all data as a SequenceFeatureCalls"""
-        sequenceFile = self.sfh.getSequenceFeatureFile(modbaseSeqId)
-        reader = pcssTools.PcssFileReader(sequenceFile)
-        lines = reader.getLines()
-        ppc = pcssFeatures.PsipredSequenceFeatureCallSet()
-        for i in range(len(lines)): 
-            psipredCall = pcssFeatures.PsipredResidueCall(lines[i])
-            ppc.addSequenceFeatureCall(psipredCall)
-        return ppc
+        self.prefetchedResults = {}
     
@@ -12,50 +12,112 @@ import pcssErrors
 import pcssSvm
 import tempfile
 import shutil
+import numpy
 log = logging.getLogger("pcssFeatures")
 
-class SequenceFeatureCallSet:
-    """Simple class for storing a series of sequence features (psipred / disopred) on individual residues"""
-    def __init__(self):
-        self._sequenceFeatureCalls= {}
-
-    def addSequenceFeatureCall(self, sequenceFeatureCall):
-        """Add a call for an individual residue to my set"""
-        self._sequenceFeatureCalls[sequenceFeatureCall.residueNumber] = sequenceFeatureCall
+class SequenceFeatureCallSet(object):
+    """Columnar storage for a series of sequence features (psipred / disopred) on individual residues
+
+    Result file residues, call codes and scores are each held in one NumPy array per protein, indexed by zero-based
+    residue position. Peptide features are created as slices of these arrays, so they share the protein's memory
+    rather than copying values residue by residue."""
+
+    def __init__(self, sequenceFeatureCalls):
+        """@param sequenceFeatureCalls: list of SequenceFeatureCall objects, one for each line in the result file"""
+        arrayLength = 0
+        for sequenceFeatureCall in sequenceFeatureCalls:
+            arrayLength = max(arrayLength, sequenceFeatureCall.residueNumber)
+
+        self.residueCodes = numpy.zeros(arrayLength, dtype='S1')
+        self.callCodes = numpy.zeros(arrayLength, dtype='S1')
+        self.scores = numpy.zeros(arrayLength, dtype=numpy.float64)
+        self.hasCall = numpy.zeros(arrayLength, dtype=bool)
+
+        for sequenceFeatureCall in sequenceFeatureCalls:
+            residueIndex = sequenceFeatureCall.residueNumber - 1
+            self.residueCodes[residueIndex] = sequenceFeatureCall.residueOneLetter
+            self.callCodes[residueIndex] = sequenceFeatureCall.call
+            self.scores[residueIndex] = sequenceFeatureCall.score
+            self.hasCall[residueIndex] = True
+
+    @classmethod
+    def fromArrays(cls, residueCodes, callCodes, scores, hasCall):
+        """Create call set from arrays that are already in columnar form (e.g. mapped from a result sidecar file)"""
+        callSet = cls.__new__(cls)
+        callSet.residueCodes = residueCodes
+        callSet.callCodes = callCodes
+        callSet.scores = scores
+        callSet.hasCall = hasCall
+        return callSet
+
+    @classmethod
+    def fromResultFile(cls, resultFile):
+        """Parse result file written by the sequence feature algorithm; one call per residue line"""
+        reader = pcssTools.PcssFileReader(resultFile)
+        return cls([cls.makeResidueCall(line) for line in cls.getCallLines(reader.getLines())])
+
+    def getPeptideCalls(self, startPosition, endPosition):
+        """Return views of the call codes and scores for residues startPosition through endPosition (zero-based, inclusive)"""
+        sliceEnd = endPosition + 1
+        if (sliceEnd > len(self.hasCall) or not self.hasCall[startPosition:sliceEnd].all()):
+            missingPositions = [i for i in range(startPosition, sliceEnd) if i >= len(self.hasCall) or not self.hasCall[i]]
+            raise self.getFeatureNotFoundException(missingPositions[0] + 1)
+        return [self.callCodes[startPosition:sliceEnd], self.scores[startPosition:sliceEnd]]
 
-    def getSequenceFeatureCall(self, baseOneResidueNumber):
-        if (not self._sequenceFeatureCalls.has_key(baseOneResidueNumber)):
-            raise self.getFeatureNotFoundException(baseOneResidueNumber)
-        return self._sequenceFeatureCalls[baseOneResidueNumber]
-    
     def checkSequenceMatch(self, proteinSequence):
         """Check over all of my calls whether each has the same amino acid as expected in the input protein sequence"""
-        for sequenceFeatureCall in self._sequenceFeatureCalls.values():
-            sequenceFeatureCall.checkSequenceMatch(proteinSequence)
+        if (len(self.residueCodes) > len(proteinSequence)):
+            raise self.getMismatchException("%s result file has calls for %s residues but protein sequence has length %s" %
+                                            (self.name, len(self.residueCodes), len(proteinSequence)))
+        proteinResidues = numpy.frombuffer(str(proteinSequence)[0:len(self.residueCodes)], dtype='S1')
+        mismatches = numpy.flatnonzero(self.hasCall & (self.residueCodes != proteinResidues))
+        if (len(mismatches) > 0):
+            residueIndex = mismatches[0]
+            raise self.getMismatchException("%s mismatch between result file (%s) and protein sequence (%s) at position %s" %
+                                            (self.name, self.residueCodes[residueIndex], proteinResidues[residueIndex],
+                                             residueIndex + 1))
 
     def makeFullCallString(self):
        """Return all calls as a string of one letter call codes"""
-       callString = ""
-       for residueNumber, sequenceFeatureCall in (sorted(self._sequenceFeatureCalls.iteritems(), key=itemgetter(0))):
-           callString += sequenceFeatureCall.call
-       return callString
+       return self.callCodes[self.hasCall].tostring()
 
 class DisopredSequenceFeatureCallSet(SequenceFeatureCallSet):
+    name = "Disopred"
+
+    @classmethod
+    def getCallLines(cls, lines):
+        return lines[4:] #first four lines aren't commented but need to be skipped
+
+    @classmethod
+    def makeResidueCall(cls, line):
+        return DisorderResidueCall(line)
+
     def getFeatureNotFoundException(self, startResidue):
         return pcssErrors.DisopredPeptideNotFoundException("Disopred result file did not contain peptide start residue %s" % startResidue)
 
+    def getMismatchException(self, msg):
+        return pcssErrors.DisopredMismatchException(msg)
+
 class PsipredSequenceFeatureCallSet(SequenceFeatureCallSet):
+    name = "Psipred"
+
+    @classmethod
+    def getCallLines(cls, lines):
+        return lines
+
+    @classmethod
+    def makeResidueCall(cls, line):
+        return PsipredResidueCall(line)
+
     def getFeatureNotFoundException(self, startResidue):
         return pcssErrors.PsipredPeptideNotFoundException("Psipred result file did not contain peptide start residue %s" % startResidue)
 
+    def getMismatchException(self, msg):
+        return pcssErrors.PsipredMismatchException(msg)
+
 
 class SequenceFeatureCall:
-    def checkSequenceMatch(self, proteinSequence):
-        """Perform sanity check to make sure protein sequence residue matches mine at the same position"""
-        proteinSequenceAA = proteinSequence[self.residueNumber - 1]
-        if (self.residueOneLetter != proteinSequenceAA):
-            raise self.getMismatchException("%s mismatch between result file (%s) and protein sequence (%s) at position %s" % 
-                                            (self.name, self.residueOneLetter, proteinSequenceAA, self.residueNumber))                                           
+    """Parsed line from a sequence feature result file; only used while building a SequenceFeatureCallSet"""
 
 class DisorderResidueCall(SequenceFeatureCall):
 
@@ -77,9 +139,6 @@ class DisorderResidueCall(SequenceFeatureCall):
         else:
             raise pcssErrors.DisopredBadCallException("Disopred got unexpected call of %s from line %s (expect * or .)" % (disorderCall, disopredLine))
 
-    def getMismatchException(self, msg):
-        return pcssErrors.DisopredMismatchException(msg)
-
 class PsipredResidueCall(SequenceFeatureCall):
 
     """Simple class for storing a Psipred call for one residue"""
@@ -102,13 +161,15 @@ class PsipredResidueCall(SequenceFeatureCall):
         else:
             raise pcssErrors.PsipredBadCallException("Psipred got unexpected call of %s from line %s (expect H,C,E)" % (psipredCall, psipredLine))
 
-    def getMismatchException(self, msg):
-        return pcssErrors.PsipredMismatchException(msg)
 
+class PcssFeature(object):
+
+    """Represents one feature which can just be annotation or can be used for SVM Model input
 
-class PcssFeature:
+    One feature object is created for every peptide feature, so subclasses declare __slots__ and keep
+    the feature name and any lookup tables at class level where they are shared by all instances"""
 
-    """Represents one feature which can just be annotation or can be used for SVM Model input"""
+    __slots__ = ()
 
     def getOutputString(self):
         return "%s: %s" % (self.name, self.getValueString())
@@ -119,6 +180,15 @@ class PcssFeature:
     def getEmptyFeatureOffset(self, peptideLength):
         return self.getFeatureLength() * peptideLength
 
+    def getValueList(self, values):
+        """Return values as a list of Python objects; feature values may be views of per-protein NumPy arrays
+
+        Converting before formatting keeps output identical to lists of Python floats (str() of a NumPy float
+        prints more digits)"""
+        if (isinstance(values, numpy.ndarray)):
+            return values.tolist()
+        return values
+
     def convertStringListToFloat(self, stringList):
         floatList = []
         for nextString in stringList:
@@ -132,9 +202,11 @@ class PcssFeature:
         return 1
 
 class DisorderStringFeature(PcssFeature):
+    __slots__ = ('disorderStringList',)
+    name = "disopred_string_feature"
+
     def __init__(self, disorderStringList=None):
         self.disorderStringList = disorderStringList
-        self.name = "disopred_string_feature"
     
     def getValueString(self):
         if (self.disorderStringList is None):
@@ -146,8 +218,10 @@ class DisorderStringFeature(PcssFeature):
             self.disorderStringList = list(fileValue)
     
 class DisorderScoreFeature(PcssFeature):
+    __slots__ = ('disorderScoreList',)
+    name = "disopred_score_feature"
+
     def __init__(self, disorderScoreList=None):
-        self.name = "disopred_score_feature"
         self.disorderScoreList = disorderScoreList
 
     def initFromFileValue(self, fileValue):
@@ -158,11 +232,11 @@ class DisorderScoreFeature(PcssFeature):
         if (self.disorderScoreList is None):
             return ""
 
-        return ", ".join(str(x) for x in self.disorderScoreList)
+        return ", ".join(str(x) for x in self.getValueList(self.disorderScoreList))
 
     def makeSvmFeature(self, svmHandler):
         svmFeatureList = []
-        for score in self.disorderScoreList:
+        for score in self.getValueList(self.disorderScoreList):
             svmFeatureList.append("%s:%s" % (svmHandler.getFeatureNumber(), score))
             svmHandler.processFeature(1)
 
@@ -172,9 +246,11 @@ class DisorderScoreFeature(PcssFeature):
         return self.disorderScoreList is not None
 
 class PsipredStringFeature(PcssFeature):
+    __slots__ = ('psipredStringList',)
+    name = "psipred_string_feature"
+
     def __init__(self, psipredStringList=None):
         self.psipredStringList = psipredStringList
-        self.name = "psipred_string_feature"
     
     def getValueString(self):
         if (self.psipredStringList is None):
@@ -188,60 +264,49 @@ class PsipredStringFeature(PcssFeature):
 
 
 class PeptideSequenceFeature(PcssFeature):
+    __slots__ = ('sequence',)
+    name = "peptide_sequence"
+    residueOrder = ('A', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'K', 'L', 'M', 'N', 'P', 'Q', 'R', 'S', 'T', 'V', 'W', 'Y')
+    residueIndex = dict((residueCode, i) for (i, residueCode) in enumerate(residueOrder))
+
     def __init__(self, sequence=None):
         self.sequence = sequence
-        self.name = "peptide_sequence"
-        self.seqList = []
-        if (sequence is not None):
-            self.populateSeqList()
-        
-        self.makeSvmMap()
 
     def getFeatureLength(self):
         return 20
 
-    def populateSeqList(self):
-        for i in range(len(self.sequence)):
-            self.seqList.append(self.sequence[i])
-
-    def initFromFileValue(self, fileValue):
-        self.sequence = fileValue
-        self.populateSeqList()
-
-    def makeSvmMap(self):
-        self.residueOrder = ['A', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'K', 'L', 'M', 'N', 'P', 'Q', 'R', 'S', 'T', 'V', 'W', 'Y']
-
-    def getSingleResidueFeatureList(self, residueCode, featureNumber, seqList):
+    def getSingleResidueFeatureList(self, residueCode, featureNumber, sequence):
+        if (residueCode not in self.residueIndex):
+            raise pcssErrors.PcssGlobalException("Residue %s in sequence %s is not one of the 20 standard amino acids" 
+                                                 % (residueCode, sequence))
+        residueIndex = self.residueIndex[residueCode]
         featureList = []
-        foundResidue = False
-        for (i, nextResidueCode) in enumerate(self.residueOrder):
-            if (nextResidueCode == residueCode):
-                foundResidue = True
+        for i in range(len(self.residueOrder)):
+            if (i == residueIndex):
                 featureList.append("%s:%s" % (featureNumber + i, 1))
             else:
                 featureList.append("%s:%s" % (featureNumber + i, 0))
-        if (not foundResidue):
-            raise pcssErrors.PcssGlobalException("Residue %s in sequence %s is not one of the 20 standard amino acids" 
-                                                 % (residueCode, "".join(seqList)))
         return " ".join(featureList)
 
     def getValueString(self):
-        if (self.seqList is None):
+        if (self.sequence is None):
             return ""
-        return "".join(self.seqList)
+        return self.sequence
 
     def initFromFileValue(self, fileValue):
         if (fileValue != ""):
-            self.seqList = list(fileValue)
+            self.sequence = fileValue
 
     def makeSvmFeature(self, svmHandler):
         featureList = []
-        for residue in self.seqList:
-            featureList.append(self.getSingleResidueFeatureList(residue, svmHandler.getFeatureNumber(), self.seqList))
+        for residue in self.sequence:
+            featureList.append(self.getSingleResidueFeatureList(residue, svmHandler.getFeatureNumber(), self.sequence))
             svmHandler.processFeature(20)
         return " ".join(featureList)
 
 class StringAttribute(PcssFeature):
+    __slots__ = ('name', 'value')
+
     def __init__(self, name=None, value=None):
         self.setValues(name, value)
 
@@ -264,15 +329,17 @@ class StringAttribute(PcssFeature):
             return 
 
 class PsipredScoreFeature(PcssFeature):
+    __slots__ = ('psipredScoreList',)
+    name = "psipred_score_feature"
+
     def __init__(self, psipredScoreList=None):
         
         self.psipredScoreList = psipredScoreList
-        self.name = "psipred_score_feature"
 
     def getValueString(self):
         if (self.psipredScoreList is None):
             return ""
-        return ", ".join(str(x) for x in self.psipredScoreList)
+        return ", ".join(str(x) for x in self.getValueList(self.psipredScoreList))
 
     def initFromFileValue(self, fileValue):
         if (fileValue != ""):
@@ -280,7 +347,7 @@ class PsipredScoreFeature(PcssFeature):
 
     def makeSvmFeature(self, svmHandler):
         svmFeatureList = []
-        for score in self.psipredScoreList:
+        for score in self.getValueList(self.psipredScoreList):
             svmFeatureList.append("%s:%s" % (svmHandler.getFeatureNumber(), score))
             svmHandler.processFeature(1)
 
@@ -290,8 +357,17 @@ class PsipredScoreFeature(PcssFeature):
         return self.psipredScoreList is not None
 
 class DsspStructureFeature(PcssFeature):
+    __slots__ = ('dsspStructureList',)
+    name = "dssp_structure"
+
+    #DSSP has multiple representations for each structure type (e.g. 3-10 helix vs normal helix); collapse them to one type
+    _structureMap = {"H" : "A", "G" : "A", "I" : "A",
+                     "B" : "B", "E" : "B",
+                     "T" : "L", "S" : "L", "-" : "L"}
+
+    _callMap = {"B" : 3, "A" : 2, "L" : 1}
+
     def __init__(self, inputDsspStructureList=None):
-        self.createStructureMap()
         
         if (inputDsspStructureList is not None):
             self.dsspStructureList = []
@@ -302,26 +378,21 @@ class DsspStructureFeature(PcssFeature):
                 self.dsspStructureList.append(mappedCall)
         else:
             self.dsspStructureList = None
-        self.name = "dssp_structure"
-
-    def createStructureMap(self):
-        """DSSP has multiple representations for each structure type (e.g. 3-10 helix vs normal helix); collapse them to one type"""
-        self._structureMap = {}
-        self._callMap = {}
-        self._structureMap["H"] = "A"
-        self._structureMap["G"] = "A"
-        self._structureMap["I"] = "A"
-
-        self._structureMap["B"] = "B"
-        self._structureMap["E"] = "B"
-        
-        self._structureMap["T"] = "L"
-        self._structureMap["S"] = "L"
-        self._structureMap["-"] = "L"
 
-        self._callMap["B"] = 3
-        self._callMap["A"] = 2
-        self._callMap["L"] = 1
+    @classmethod
+    def mapStructureArray(cls, dsspCalls):
+        """Map an array of raw DSSP calls to collapsed structure types; calls that can't be mapped become empty"""
+        mappedCalls = numpy.zeros(len(dsspCalls), dtype='S1')
+        for (dsspCall, mappedCall) in cls._structureMap.iteritems():
+            mappedCalls[dsspCalls == dsspCall] = mappedCall
+        return mappedCalls
+
+    @classmethod
+    def fromMappedCalls(cls, mappedCalls):
+        """Create feature from calls that have already been collapsed by mapStructureArray()"""
+        feature = cls()
+        feature.dsspStructureList = mappedCalls
+        return feature
 
     def getMappedCall(self, dsspCall):
         if (dsspCall not in self._structureMap):
@@ -360,9 +431,12 @@ class PeptideErrorFeature(PcssFeature):
 
     """An error is its own feature; track errors for peptides using this class"""
 
+    __slots__ = ('errorCodeList',)
+    name = "peptide_errors"
+
     def __init__(self):
-        self.errorCodeList = []
-        self.name = "peptide_errors"
+        #most peptides never get an error; share the empty tuple until one is added
+        self.errorCodeList = ()
     
     def getValueString(self):
         
@@ -372,16 +446,18 @@ class PeptideErrorFeature(PcssFeature):
             return '; '.join(self.errorCodeList)
     
     def addError(self, errorCode):
-        self.errorCodeList.append(errorCode)
+        self.errorCodeList = self.errorCodeList + (errorCode,)
 
     def initFromFileValue(self, fileValue):
         if (fileValue != "none"):
-            self.errorCodeList = fileValue.split('; ')
+            self.errorCodeList = tuple(fileValue.split('; '))
 
 class DsspAccFeature(PcssFeature):
+    __slots__ = ('dsspAccList',)
+    name = "dssp_accessibility"
+
     def __init__(self, dsspAccList=None):
         self.dsspAccList = dsspAccList
-        self.name = "dssp_accessibility"
 
     def initFromFileValue(self, fileValue):
         if (fileValue != ""):
@@ -390,16 +466,15 @@ class DsspAccFeature(PcssFeature):
     def getValueString(self):
         if (self.dsspAccList is None):
             return ""
-        return ", ".join(str(round(x, 3)) for x in self.dsspAccList)
+        return ", ".join(str(round(x, 3)) for x in self.getValueList(self.dsspAccList))
 
     def makeSvmFeature(self, svmHandler):
 
         svmFeatureList = []
-        for score in self.dsspAccList:
+        for score in self.getValueList(self.dsspAccList):
             svmFeatureList.append("%s:%s" % (svmHandler.getFeatureNumber(), score))
             svmHandler.processFeature(1)
         return ' '.join(svmFeatureList)
 
     def isInitialized(self):
         return self.dsspAccList is not None
-
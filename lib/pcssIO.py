@@ -1,5 +1,9 @@
 import sys
 import os
+import re
+import mmap
+import multiprocessing
+import numpy
 from Bio import SeqIO
 import itertools
 import pcssModels
@@ -13,32 +17,32 @@ import pcssFeatureHandlers
 log = logging.getLogger("pcssPeptide")
 
 class PeptideImporter:
-    def parseFastaHeader(self, seqRecord):
+    def parseFastaHeader(self, recordId):
         """Return PcssProtein by reading fasta header. Header is of format <modbaseId|uniprotId>"""
-        [modbaseId, uniprotId] = seqRecord.id.split('|')
+        [modbaseId, uniprotId] = recordId.split('|')
         seq = pcssPeptide.PcssProtein(modbaseId, self.pcssRunner)
         seq.setUniprotId(uniprotId)
         return seq
 
     def readInputFile(self, proteinFastaFile):
         """Read input fasta file, parse headers to create PcssProteins and parse sequence to create PcssPeptides"""
-        fh = open(proteinFastaFile, 'r')
-        fastaIterator = SeqIO.FastaIO.FastaIterator(fh)
-        pcssProteins = []
-        
-        for seqRecord in fastaIterator:
-            
-            pcssProtein = self.parseFastaHeader(seqRecord)
-            pcssProtein.setProteinSequence(seqRecord.seq)
-            pcssPeptideList = self.parseFastaSequence(seqRecord)
-            pcssProtein.setPeptides(pcssPeptideList)
-
-            pcssProteins.append(pcssProtein)
+        pcssProteins = list(self.iterateProteins(proteinFastaFile))
         
         log.info("PeptideImporter: read %s proteins from input file" % len(pcssProteins))
-        fh.close()
         return pcssProteins
 
+    def iterateProteins(self, proteinFastaFile):
+        """Generator yielding one PcssProtein at a time from the input fasta file; used when streaming proteins through the pipeline"""
+        for (recordId, sequence) in FastaReader(proteinFastaFile):
+            yield self.makeProtein(recordId, sequence)
+
+    def makeProtein(self, recordId, sequence):
+        pcssProtein = self.parseFastaHeader(recordId)
+        pcssProtein.setProteinSequence(sequence)
+        pcssPeptideList = self.parseFastaSequence(sequence)
+        pcssProtein.setPeptides(pcssPeptideList)
+        return pcssProtein
+
 class ScanPeptideImporter(PeptideImporter):
 
     """Class to read a fasta sequence and parse peptides from the actual sequence according to defined rules"""
@@ -48,25 +52,82 @@ class ScanPeptideImporter(PeptideImporter):
         self.rules = ParsingRules(pcssRunner.pcssConfig['rules_file'])
         self.pcssRunner = pcssRunner
         self.pcssRunner.setPeptideLength(pcssRunner.pcssConfig.as_int('peptide_length'))
+        self.rules.compileAllowedResidueTable(self.pcssRunner.getPeptideLength())
 
-    def parseFastaSequence(self, seqRecord):
-        """Use user-defined rules to read protein sequence, parse peptides, and return a list of those that conform to rules"""
-        seqLength = len(seqRecord.seq)
+    def parseFastaSequence(self, sequence):
+        """Use user-defined rules to read protein sequence, parse peptides, and return a list of those that conform to rules
+
+        All window start positions are evaluated against the compiled rules in one pass; PcssPeptides are only created
+        for windows that pass"""
+        return self.makePeptides(sequence, self.rules.getValidStartPositions(sequence))
+
+    def makePeptides(self, sequence, startPositions):
+        """Create a PcssPeptide for each 0-based start position in sequence"""
+        peptideLength = self.pcssRunner.getPeptideLength()
         pcssPeptideList = []
-        for i in range(0, seqLength - self.pcssRunner.getPeptideLength() + 1):
-            nextPeptide = str(seqRecord.seq[i:i+self.pcssRunner.getPeptideLength()])
-            if (self.rules.isValidPeptide(nextPeptide)):
-                pcssPeptideList.append(pcssPeptide.PcssPeptide(nextPeptide, i, i + self.pcssRunner.getPeptideLength() - 1, self.pcssRunner))
+        for i in startPositions:
+            i = int(i)
+            pcssPeptideList.append(pcssPeptide.PcssPeptide(sequence[i:i+peptideLength], i, i + peptideLength - 1, self.pcssRunner))
         
         return pcssPeptideList
 
+    def iterateProteins(self, proteinFastaFile):
+        """Generator yielding one PcssProtein at a time from the input fasta file
+
+        If the runner is configured for more than one peptide import process, the file is divided into chunks at
+        record boundaries and the rules are evaluated for each chunk in a process pool. Workers return each record's
+        sequence with compact peptide descriptors, so chunks are parsed only once; proteins and peptides are created
+        here, in input order."""
+        processCount = self.pcssRunner.getPeptideImportProcessCount()
+        if (processCount < 2):
+            for pcssProtein in PeptideImporter.iterateProteins(self, proteinFastaFile):
+                yield pcssProtein
+            return
+
+        fastaReader = FastaReader(proteinFastaFile)
+        offsets = fastaReader.getRecordBoundaryOffsets(processCount * 4)
+        chunkArgs = []
+        for i in range(len(offsets) - 1):
+            chunkArgs.append((proteinFastaFile, offsets[i], offsets[i + 1], self.pcssRunner.pcssConfig['rules_file'], 
+                              self.pcssRunner.getPeptideLength()))
+        log.info("ScanPeptideImporter: scanning %s chunks of %s with %s processes" % (len(chunkArgs), proteinFastaFile, processCount))
+        pool = multiprocessing.Pool(processCount)
+        try:
+            for chunkRecords in pool.imap(scanFastaChunk, chunkArgs):
+                for (recordId, sequence, startPositions) in chunkRecords:
+                    pcssProtein = self.parseFastaHeader(recordId)
+                    pcssProtein.setProteinSequence(sequence)
+                    pcssProtein.setPeptides(self.makePeptides(sequence, startPositions))
+                    yield pcssProtein
+        except:
+            #includes the generator being closed before all proteins were read
+            pool.terminate()
+            pool.join()
+            raise
+        pool.close()
+        pool.join()
+
+def scanFastaChunk(chunkArgs):
+    """Evaluate peptide rules for all records in one byte range of a fasta file; run in a worker process
+
+    @param chunkArgs: tuple of (fastaFileName, startOffset, endOffset, rulesFileName, peptideLength)
+    @return: list with one (recordId, sequence, startPositions) descriptor for each record in the chunk, where
+    startPositions is an array of 0-based peptide start positions. Peptide length is the same for all peptides."""
+    (fastaFileName, startOffset, endOffset, rulesFileName, peptideLength) = chunkArgs
+    rules = ParsingRules(rulesFileName)
+    rules.compileAllowedResidueTable(peptideLength)
+    descriptors = []
+    for (recordId, sequence) in FastaReader(fastaFileName, startOffset=startOffset, endOffset=endOffset):
+        descriptors.append((recordId, sequence, rules.getValidStartPositions(sequence).astype(numpy.int32)))
+    return descriptors
+
 class FullProteinImporter(PeptideImporter):
     def __init__(self, pcssRunner):
         self.pcssRunner = pcssRunner
 
-    def parseFastaSequence(self, seqRecord):
+    def parseFastaSequence(self, sequence):
         pcssPeptideList = []
-        firstPeptide = str(seqRecord.seq[0:1])
+        firstPeptide = sequence[0:1]
         pcssPeptideList.append(pcssPeptide.PcssPeptide(firstPeptide, 0, 1, self.pcssRunner))
         return pcssPeptideList
 
@@ -80,20 +141,9 @@ class DefinedPeptideImporter(PeptideImporter):
 
     def readInputFile(self, proteinFastaFile):
         """Read input fasta file, parse headers to create PcssProteins and parse sequence to create PcssPeptides"""
-        fh = open(proteinFastaFile, 'r')
-        fastaIterator = SeqIO.FastaIO.FastaIterator(fh)
-        pcssProteins = []
-
-        for seqRecord in fastaIterator:
-            
-            pcssProtein = self.parseFastaHeader(seqRecord)
-            pcssProtein.setProteinSequence(seqRecord.seq)
-            
-            pcssProtein.validatePeptideSequences()
-            pcssProteins.append(pcssProtein)
+        pcssProteins = list(self.iterateProteins(proteinFastaFile))
 
         log.info("Read %s proteins from input file" % len(pcssProteins))
-        fh.close()
         #tempFh = open("pcssDemoTraining.txt", "w")
         #for pcssProtein in pcssProteins:
         #    for peptide in pcssProtein.peptides.values():
@@ -101,9 +151,15 @@ class DefinedPeptideImporter(PeptideImporter):
         #        tempFh.write("%s\n" % '\t'.join(str(x) for x in outputList))
             
         return pcssProteins
+
+    def makeProtein(self, recordId, sequence):
+        pcssProtein = self.parseFastaHeader(recordId)
+        pcssProtein.setProteinSequence(sequence)
+        pcssProtein.validatePeptideSequences()
+        return pcssProtein
         
-    def parseFastaHeader(self, seqRecord):
-        cols = seqRecord.id.split('|')
+    def parseFastaHeader(self, recordId):
+        cols = recordId.split('|')
         modbaseSeqId = cols[0]
         uniprotId = cols[1]
         seq = pcssPeptide.PcssProtein(modbaseSeqId, self.pcssRunner)
@@ -136,6 +192,332 @@ class DefinedPeptideImporter(PeptideImporter):
         peptide.addStringAttribute("status", status)
         return peptide
 
+class FastaReader:
+
+    """Lightweight fasta parser yielding (recordId, sequence) string tuples
+
+    Reads the file in large blocks and splits them on header lines, so no SeqRecord or Seq objects are created. 
+    recordId is the first word of the header line, the same as SeqRecord.id; whitespace is removed from sequences.
+    If startOffset and endOffset are given, only records starting in that byte range are read; offsets should be
+    record boundaries as returned by getRecordBoundaryOffsets()."""
+
+    def __init__(self, fastaFileName, bufferSize=4 * 1024 * 1024, startOffset=0, endOffset=None):
+        self.fastaFileName = fastaFileName
+        self.bufferSize = bufferSize
+        self.startOffset = startOffset
+        self.endOffset = endOffset
+
+    def readBlock(self, fh):
+        if (self.endOffset is None):
+            return fh.read(self.bufferSize)
+        return fh.read(max(0, min(self.bufferSize, self.endOffset - fh.tell())))
+
+    def __iter__(self):
+        fh = open(self.fastaFileName, 'rb')
+        try:
+            fh.seek(self.startOffset)
+            pending = self.readBlock(fh)
+            if (pending.startswith('>')):
+                pending = pending[1:]
+                foundHeader = True
+            else:
+                foundHeader = False
+            while (True):
+                if (not foundHeader):
+                    #skip anything before the first header line
+                    headerStart = pending.find('\n>')
+                    if (headerStart != -1):
+                        pending = pending[headerStart + 2:]
+                        foundHeader = True
+                    else:
+                        pending = pending[-1:]
+                if (foundHeader):
+                    records = pending.split('\n>')
+                    pending = records.pop()
+                    for record in records:
+                        yield self.parseRecord(record)
+                chunk = self.readBlock(fh)
+                if (not chunk):
+                    break
+                pending += chunk
+            if (foundHeader):
+                yield self.parseRecord(pending)
+        finally:
+            fh.close()
+
+    def parseRecord(self, record):
+        """Return (recordId, sequence) for one record; record is its text without the leading '>'"""
+        headerEnd = record.find('\n')
+        if (headerEnd == -1):
+            headerEnd = len(record)
+        title = record[0:headerEnd].split(None, 1)
+        recordId = title[0] if title else ""
+        return (recordId, "".join(record[headerEnd + 1:].split()))
+
+    def getRecordBoundaryOffsets(self, chunkCount):
+        """Divide the file into about chunkCount byte ranges that each start at a header line
+
+        Returns sorted list of offsets beginning with 0 and ending with the file size; consecutive offsets
+        delimit one chunk. Chunks are never empty so fewer than chunkCount may be returned for small files."""
+        fileSize = os.path.getsize(self.fastaFileName)
+        offsets = [0]
+        fh = open(self.fastaFileName, 'rb')
+        try:
+            for i in range(1, chunkCount):
+                targetOffset = max(fileSize * i / chunkCount, offsets[-1] + 1)
+                if (targetOffset >= fileSize):
+                    break
+                #look for the next header line starting at or after targetOffset
+                fh.seek(targetOffset - 1)
+                searchStart = targetOffset - 1
+                boundary = None
+                pending = ""
+                while (boundary is None):
+                    block = fh.read(self.bufferSize)
+                    if (not block):
+                        break
+                    pending += block
+                    headerStart = pending.find('\n>')
+                    if (headerStart != -1):
+                        boundary = searchStart + headerStart + 1
+                    else:
+                        searchStart += len(pending) - 1
+                        pending = pending[-1:]
+                if (boundary is None):
+                    break
+                if (boundary > offsets[-1]):
+                    offsets.append(boundary)
+        finally:
+            fh.close()
+        offsets.append(fileSize)
+        return offsets
+
+class OffsetIndexedFile:
+
+    """Base class for a memory-mapped text file with an index of [key, start offset, end offset] entries
+
+    The index is stored next to the file (<file>.pcssidx) and rebuilt when the file's modification time or size no
+    longer match the values recorded in the index. If the index can't be written (e.g. read-only input directory) it
+    is kept in memory only. Subclasses scan the file for entries in buildIndex() and set up lookups in setEntries()."""
+
+    fileDescription = "Indexed"
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        if (not os.path.exists(fileName)):
+            raise pcssErrors.PcssGlobalException("%s file %s does not exist" % (self.fileDescription, fileName))
+        self.fh = open(fileName, 'rb')
+        fileStat = os.fstat(self.fh.fileno())
+        self.fileStamp = "%r\t%s" % (fileStat.st_mtime, fileStat.st_size)
+        if (fileStat.st_size > 0):
+            self.fileMap = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            #can't mmap an empty file
+            self.fileMap = ""
+        self.loadIndex()
+
+    def getIndexFileName(self):
+        return "%s.pcssidx" % self.fileName
+
+    def loadIndex(self):
+        """Read index file if it is current for this file, otherwise build it and try to save it"""
+        self.recordEntries = self.readIndexFile()
+        if (self.recordEntries is None):
+            self.recordEntries = self.buildIndex()
+            self.writeIndexFile()
+        self.setEntries(self.recordEntries)
+
+    def readIndexFile(self):
+        """Return list of [key, start, end] from the index file, or None if it is missing or stale"""
+        indexFileName = self.getIndexFileName()
+        if (not os.path.exists(indexFileName)):
+            return None
+        indexFh = open(indexFileName, 'r')
+        try:
+            if (indexFh.readline().rstrip('\n') != self.fileStamp):
+                log.info("%s index %s is out of date; rebuilding" % (self.fileDescription, indexFileName))
+                return None
+            recordEntries = []
+            for line in indexFh:
+                [recordId, recordStart, recordEnd] = line.rstrip('\n').split('\t')
+                recordEntries.append([recordId, int(recordStart), int(recordEnd)])
+            return recordEntries
+        except ValueError:
+            log.info("Could not read %s index %s; rebuilding" % (self.fileDescription, indexFileName))
+            return None
+        finally:
+            indexFh.close()
+
+    def writeIndexFile(self):
+        indexFileName = self.getIndexFileName()
+        tmpFileName = "%s.%s.tmp" % (indexFileName, os.getpid())
+        try:
+            indexFh = open(tmpFileName, 'w')
+            indexFh.write("%s\n" % self.fileStamp)
+            for [recordId, recordStart, recordEnd] in self.recordEntries:
+                indexFh.write("%s\t%s\t%s\n" % (recordId, recordStart, recordEnd))
+            indexFh.close()
+            os.rename(tmpFileName, indexFileName)
+        except (IOError, OSError), e:
+            log.info("Could not write %s index %s (%s); keeping index in memory" % (self.fileDescription, indexFileName, e))
+
+    def close(self):
+        if (not isinstance(self.fileMap, str)):
+            self.fileMap.close()
+        self.fh.close()
+
+class IndexedFastaFile(OffsetIndexedFile):
+
+    """Memory-mapped fasta file with an offset index, for fetching records without reparsing the whole file
+
+    The index maps each record id (first word of the header) to the byte range of its sequence."""
+
+    fileDescription = "Fasta"
+
+    def setEntries(self, recordEntries):
+        self.recordIndex = {}
+        self.modbaseIdIndex = {}
+        for (i, [recordId, sequenceStart, sequenceEnd]) in enumerate(recordEntries):
+            if (recordId not in self.recordIndex):
+                self.recordIndex[recordId] = i
+            self.modbaseIdIndex[recordId.split('|')[0]] = i
+
+    def buildIndex(self):
+        """Scan the fasta file once for header lines and record where each sequence starts and ends"""
+        recordEntries = []
+        fastaMap = self.fileMap
+        fileSize = len(fastaMap)
+        if (fastaMap[0:1] == '>'):
+            headerStart = 0
+        else:
+            headerStart = fastaMap.find('\n>')
+            if (headerStart != -1):
+                headerStart += 1
+        while (headerStart != -1):
+            headerEnd = fastaMap.find('\n', headerStart)
+            if (headerEnd == -1):
+                headerEnd = fileSize
+            title = fastaMap[headerStart + 1:headerEnd].split(None, 1)
+            recordId = title[0] if title else ""
+            nextHeader = fastaMap.find('\n>', headerEnd)
+            if (nextHeader == -1):
+                sequenceEnd = fileSize
+                headerStart = -1
+            else:
+                sequenceEnd = nextHeader + 1
+                headerStart = nextHeader + 1
+            recordEntries.append([recordId, min(headerEnd + 1, fileSize), sequenceEnd])
+        return recordEntries
+
+    def getSequenceForEntry(self, entryIndex):
+        [recordId, sequenceStart, sequenceEnd] = self.recordEntries[entryIndex]
+        return "".join(self.fileMap[sequenceStart:sequenceEnd].split())
+
+    def hasRecord(self, recordId):
+        return recordId in self.recordIndex
+
+    def getSequence(self, recordId):
+        """Return sequence for the record with this id (full id from the header, e.g. <modbaseId|uniprotId>)"""
+        if (recordId not in self.recordIndex):
+            raise pcssErrors.PcssGlobalException("Fasta file %s has no record %s" % (self.fileName, recordId))
+        return self.getSequenceForEntry(self.recordIndex[recordId])
+
+    def hasModbaseId(self, modbaseId):
+        return modbaseId in self.modbaseIdIndex
+
+    def getSequenceByModbaseId(self, modbaseId):
+        """Return sequence for the record whose header starts with this modbase id"""
+        if (modbaseId not in self.modbaseIdIndex):
+            raise pcssErrors.PcssGlobalException("Fasta file %s has no record for modbase id %s" % (self.fileName, modbaseId))
+        return self.getSequenceForEntry(self.modbaseIdIndex[modbaseId])
+
+    def getRecordIds(self):
+        """Return record ids in file order"""
+        return [entry[0] for entry in self.recordEntries]
+
+    def getSortedRecordIds(self):
+        return sorted(self.getRecordIds())
+
+    def getRecordIdForEntry(self, entryIndex):
+        return self.recordEntries[entryIndex][0]
+
+    def getSortedEntryIndices(self):
+        """Return indices of all records sorted by id; records with the same id stay in file order"""
+        return sorted(range(len(self.recordEntries)), key=lambda i: self.recordEntries[i][0])
+
+    def iterateRecords(self, sortById=False):
+        """Generator yielding (recordId, sequence) tuples in file order, or sorted by id; sequences are read on demand
+
+        Every record is yielded, including records whose id repeats an earlier one (getSequence() only finds the
+        first of those)"""
+        entryIndices = range(len(self.recordEntries))
+        if (sortById):
+            entryIndices = self.getSortedEntryIndices()
+        for i in entryIndices:
+            yield (self.recordEntries[i][0], self.getSequenceForEntry(i))
+
+    def getRecordCount(self):
+        return len(self.recordEntries)
+
+class IndexedModelTableFile(OffsetIndexedFile):
+
+    """Memory-mapped model table file with an offset index, for reading the lines of a few sequences without reading
+    the whole table
+
+    The index maps each seq_id (first column) to the byte ranges of its lines; consecutive lines of the same
+    sequence share one range, so a table sorted or grouped by seq_id has one entry per sequence. Blank lines and
+    lines starting with '#' are skipped, as PcssFileReader does."""
+
+    fileDescription = "Model table"
+
+    def setEntries(self, recordEntries):
+        self.sequenceIndex = {}
+        for [sequenceId, rangeStart, rangeEnd] in recordEntries:
+            self.sequenceIndex.setdefault(sequenceId, []).append([rangeStart, rangeEnd])
+
+    def buildIndex(self):
+        """Scan the table once and record the byte range of each run of lines with the same seq_id"""
+        recordEntries = []
+        tableMap = self.fileMap
+        fileSize = len(tableMap)
+        lineStart = 0
+        while (lineStart < fileSize):
+            lineEnd = tableMap.find('\n', lineStart)
+            if (lineEnd == -1):
+                lineEnd = fileSize
+            line = tableMap[lineStart:lineEnd].rstrip('\r')
+            if (line.strip() != "" and not line.startswith('#')):
+                sequenceId = line.split('\t', 1)[0]
+                if (len(recordEntries) > 0 and recordEntries[-1][0] == sequenceId and recordEntries[-1][2] == lineStart):
+                    recordEntries[-1][2] = min(lineEnd + 1, fileSize)
+                else:
+                    recordEntries.append([sequenceId, lineStart, min(lineEnd + 1, fileSize)])
+            lineStart = lineEnd + 1
+        return recordEntries
+
+    def hasSequence(self, sequenceId):
+        return sequenceId in self.sequenceIndex
+
+    def getSequenceIds(self):
+        return self.sequenceIndex.keys()
+
+    def getSequenceLines(self, sequenceId):
+        """Return model table lines for this seq_id in file order; empty list if it has no models"""
+        lines = []
+        for [rangeStart, rangeEnd] in self.sequenceIndex.get(sequenceId, []):
+            for line in self.fileMap[rangeStart:rangeEnd].split('\n'):
+                line = line.rstrip('\r')
+                if (line.strip() != "" and not line.startswith('#')):
+                    lines.append(line)
+        return lines
+
+    def getFirstLine(self):
+        """Return first model line in the table, or None if it has none"""
+        if (len(self.recordEntries) == 0):
+            return None
+        [sequenceId, rangeStart, rangeEnd] = self.recordEntries[0]
+        return self.getSequenceLines(sequenceId)[0]
+
 class AnnotationFileReader:
     def __init__(self, pcssRunner):
         self.pcssRunner = pcssRunner
@@ -174,18 +556,16 @@ class AnnotationFileReader:
         self.pcssRunner.setPeptideLength(refLength)
 
     def readProteinSequences(self, fastaFileName):
-        fh = open(fastaFileName, 'r')
-        fastaIterator = SeqIO.FastaIO.FastaIterator(fh)
-        for seqRecord in fastaIterator:
-            [modbaseId, uniprotId] = seqRecord.id.split('|')
-            if (modbaseId in self.proteins):
-                protein = self.proteins[modbaseId]
-                protein.setProteinSequence(seqRecord.seq)
+        """Set sequences for proteins read from the annotation file, looking each one up in the indexed fasta file"""
+        indexedFasta = IndexedFastaFile(fastaFileName)
+        for (modbaseId, protein) in self.proteins.iteritems():
+            if (indexedFasta.hasModbaseId(modbaseId)):
+                protein.setProteinSequence(indexedFasta.getSequenceByModbaseId(modbaseId))
+        indexedFasta.close()
 
         for protein in self.proteins.values():
             if (protein.proteinSequence is None):
                 raise pcssErrors.PcssGlobalException("Protein %s has no sequence set" % protein.modbaseSequenceId)
-        fh.close()
     def validateColumnLine(self, annotationFile, line):
         sortedAttributes = self.pcssRunner.pfa.getColumnSortedInputAttributes()
         firstAttribute = sortedAttributes[0]
@@ -258,12 +638,20 @@ class ParsingRules:
         """Read rules file and store user-defined rules for parsing peptides
 
         @paramRulesFile: full path of text file specifying user-defined rules for what peptides are
-        of interest. Each line represents one position in the peptide. For each line, the first entry 
-        is the position index and subsequent entries are one letter codes of amino acids not allowed 
-        at that position. For example, the line "3 A C D" means that at position 3, a peptide will not
-        have A, C, or D present. 
+        of interest. Each line is one rule; all rules must hold for a peptide to be parsed. Residues are 
+        one letter codes and are matched case-insensitively. Lines can be:
+
+        "<position> <residues>": residues not allowed at that position (positions start at 1). For example, 
+        the line "3 A C D" means that at position 3, a peptide will not have A, C, or D present.
+        "disallow <position> <residues>": same as above.
+        "allow <position> <residues>": only these residues are allowed at that position.
+        "require <residues>": at least one of these residues must appear somewhere in the peptide.
+        "motif <pattern>": pattern matched against the peptide starting at position 1. Each element of the pattern
+        is one position: a residue, '.' for any residue, [ACD] for any of a set or [^ACD] for none of a set. For 
+        example, "motif ..[DE]P" requires D or E at position 3 and P at position 4.
         """
         self._rules = {}
+        self._requiredResidueSets = []
 
         reader = pcssTools.PcssFileReader(rulesFile)
         lines = reader.getLines()
@@ -275,20 +663,115 @@ class ParsingRules:
 
         @param ruleLine: space separated columns from text, formatted as in class description
         """
-        cols = ruleLine.split(' ')
-        positionNumber = int(cols[0])
-        self._rules[positionNumber] = {}
-        for i in range(1, len(cols)):
-            self._rules[positionNumber][cols[i].upper()] = 1
-                                        
+        cols = ruleLine.split()
+        if (len(cols) == 0):
+            return
+        keyword = cols[0].lower()
+        try:
+            if (cols[0].isdigit()):
+                self.addPositionRule(int(cols[0]), False, cols[1:])
+            elif (keyword == "disallow" and len(cols) > 2):
+                self.addPositionRule(int(cols[1]), False, cols[2:])
+            elif (keyword == "allow" and len(cols) > 2):
+                self.addPositionRule(int(cols[1]), True, cols[2:])
+            elif (keyword == "require" and len(cols) > 1):
+                self._requiredResidueSets.append(self.getResidueSet(cols[1:]))
+            elif (keyword == "motif" and len(cols) == 2):
+                self.addMotif(cols[1])
+            else:
+                raise ValueError(ruleLine)
+        except ValueError:
+            raise pcssErrors.PcssGlobalException("Could not read peptide rule from line '%s'; see ParsingRules for the "
+                                                 "expected format" % ruleLine)
+
+    def getResidueSet(self, residueCodes):
+        residueSet = frozenset(residueCode.upper() for residueCode in "".join(residueCodes))
+        for residueCode in residueSet:
+            if (not residueCode.isalpha()):
+                raise ValueError(residueCode)
+        return residueSet
+
+    def addPositionRule(self, positionNumber, isAllowedSet, residueCodes):
+        """Store rule for one peptide position as [isAllowedSet, residueSet]; a position can have several rules"""
+        self._rules.setdefault(positionNumber, []).append([isAllowedSet, self.getResidueSet(residueCodes)])
+
+    def addMotif(self, motifPattern):
+        """Translate motif into one position rule for each element of the pattern that isn't a wildcard"""
+        elements = re.findall(r'\[\^?[A-Za-z]+\]|[A-Za-z.]', motifPattern)
+        if ("".join(elements) != motifPattern):
+            raise ValueError(motifPattern)
+        for (i, element) in enumerate(elements):
+            if (element == "."):
+                continue
+            if (element.startswith("[^")):
+                self.addPositionRule(i + 1, False, [element[2:-1]])
+            elif (element.startswith("[")):
+                self.addPositionRule(i + 1, True, [element[1:-1]])
+            else:
+                self.addPositionRule(i + 1, True, [element])
+
     def isValidPeptide(self, sequence):
         """Return True if passed sequence conforms to rules"""
-        for position, disallowedAAs in self._rules.iteritems():
+        for position, positionRules in self._rules.iteritems():
             nextAA = sequence[position - 1].upper()
-            if nextAA in disallowedAAs:
+            for [isAllowedSet, residueSet] in positionRules:
+                if ((nextAA in residueSet) != isAllowedSet):
+                    return False
+        upperSequence = sequence.upper()
+        for residueSet in self._requiredResidueSets:
+            if (not any(residueCode in residueSet for residueCode in upperSequence)):
                 return False
         return True
 
+    def getResidueMask(self, residueSet):
+        """Return array with an entry for each byte value that is True for residues in residueSet (either case)"""
+        residueMask = numpy.zeros(256, dtype=bool)
+        for residueCode in residueSet:
+            residueMask[ord(residueCode.upper())] = True
+            residueMask[ord(residueCode.lower())] = True
+        return residueMask
+
+    def compileAllowedResidueTable(self, peptideLength):
+        """Compile rules into a lookup table of allowed residues for each peptide position
+
+        Table has one row for each position in the peptide and one column for each byte value; an entry is
+        True if the residue with that byte value is allowed at that position. All position rules (including motifs) 
+        for the same position are combined into its row. Required residue rules are compiled to one byte mask each.
+        Residues are matched case-insensitively as in isValidPeptide()."""
+        for position in self._rules.keys():
+            if (position < 1 or position > peptideLength):
+                raise pcssErrors.PcssGlobalException("Rules file specifies position %s which is outside of peptide length %s" %
+                                                     (position, peptideLength))
+        self._allowedResidueTable = numpy.ones((peptideLength, 256), dtype=bool)
+        for position, positionRules in self._rules.iteritems():
+            for [isAllowedSet, residueSet] in positionRules:
+                residueMask = self.getResidueMask(residueSet)
+                if (isAllowedSet):
+                    self._allowedResidueTable[position - 1] &= residueMask
+                else:
+                    self._allowedResidueTable[position - 1] &= ~residueMask
+        self._requiredResidueMasks = [self.getResidueMask(residueSet) for residueSet in self._requiredResidueSets]
+        self._peptideLength = peptideLength
+
+    def getValidStartPositions(self, sequence):
+        """Return array of 0-based start positions of all windows in sequence that conform to rules
+
+        Requires compileAllowedResidueTable() to have been called. The sequence is encoded as an array of bytes and each
+        rule position is checked for all windows at once, so no per-window strings are created. Required residues are
+        counted for all windows at once from a running total of matching residues."""
+        windowCount = len(sequence) - self._peptideLength + 1
+        if (windowCount < 1):
+            return numpy.zeros(0, dtype=int)
+        encodedSequence = numpy.frombuffer(sequence, dtype=numpy.uint8)
+        validWindows = numpy.ones(windowCount, dtype=bool)
+        for position in self._rules.keys():
+            positionResidues = encodedSequence[position - 1:position - 1 + windowCount]
+            validWindows &= self._allowedResidueTable[position - 1][positionResidues]
+        for residueMask in self._requiredResidueMasks:
+            matchCounts = numpy.concatenate(([0], numpy.cumsum(residueMask[encodedSequence])))
+            validWindows &= (matchCounts[self._peptideLength:] - matchCounts[0:windowCount]) > 0
+        return numpy.flatnonzero(validWindows)
+
 class PcssFileAttribute:
 
     """Class specifying the properties of proteins and peptides that will be written to result file
@@ -392,6 +875,7 @@ class PcssFileAttributes:
         reader = pcssTools.PcssFileReader(fileName)
         lines = reader.getLines()
         self._attributes = {}
+        self._featureIndices = {}
         inputCounter = 0
         outputCounter = 0
         for line in lines:
@@ -408,6 +892,20 @@ class PcssFileAttributes:
 
     def setFileAttribute(self, attribute):
         self._attributes[attribute.name] = attribute
+        if (attribute.name not in self._featureIndices):
+            self._featureIndices[attribute.name] = len(self._featureIndices)
+
+    def getFeatureIndex(self, attributeName):
+        """Return the position of this attribute in the feature list that peptides use to store their features"""
+        self.validateAttribute(attributeName)
+        return self._featureIndices[attributeName]
+
+    def findFeatureIndex(self, attributeName):
+        """Same as getFeatureIndex() but return None instead of raising an exception for unknown attributes"""
+        return self._featureIndices.get(attributeName)
+
+    def getFeatureCount(self):
+        return len(self._featureIndices)
 
     def getAttribute(self, name):
         return self._attributes[name]
@@ -463,9 +961,15 @@ class AnnotationFileWriter:
 
     def writeAllOutput(self, proteins):
         """Write output file; write column headers and write one line for each peptide in the protein set."""
-        self.outputFh.write("%s\n" % self.pcssRunner.pfa.getOutputColumnHeaderString())
+        self.writeColumnHeader()
         for protein in proteins:
             self.writeProteinOutputLines(protein)
+        self.close()
+
+    def writeColumnHeader(self):
+        self.outputFh.write("%s\n" % self.pcssRunner.pfa.getOutputColumnHeaderString())
+
+    def close(self):
         self.outputFh.close()
 
     def writeProteinOutputLines(self, protein):
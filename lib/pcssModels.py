@@ -1,9 +1,11 @@
 import sys
 import os
 from Bio import SeqIO
-from Bio import PDB
+from Bio.PDB.DSSP import MAX_ACC as dsspMaxAccessibility
 import itertools
+import collections
 import pcssTools
+import pcssIO
 import StringIO
 from operator import itemgetter
 import logging
@@ -11,21 +13,43 @@ import subprocess
 import pcssErrors
 import tempfile
 import shutil
+import numpy
+import bisect
+import multiprocessing.pool
+import threading
+import pcssFeatures
 log = logging.getLogger("pcssModels")
 
 
 
 class PcssModelTableColumns:
     
-    """Class handling order of column names that are read in from the model table; helps provide controlled vocabulary for subsequent access"""
+    """Class handling order of column names that are read in from the model table; helps provide controlled vocabulary for subsequent access
+
+    Each line of the column order file is a column name, optionally followed by its type (string, int or float;
+    string if not given). Typed columns are converted once when a sequence's models are read (see PcssModelSequence)"""
+
+    columnTypes = {"string" : object, "int" : numpy.int64, "float" : numpy.float64}
 
     def __init__(self, fileName):
         reader = pcssTools.PcssFileReader(fileName)
         lines = reader.getLines()
         columnOrder = 0
         self._columnDict = {}
+        self._columnNumbers = {}
+        self._columnTypeDict = {}
         for line in lines:
-            self._columnDict[columnOrder] = line
+            cols = line.split()
+            columnName = cols[0]
+            columnType = "string"
+            if (len(cols) > 1):
+                columnType = cols[1]
+            if (columnType not in self.columnTypes):
+                raise pcssErrors.PcssGlobalException("Model table column order file %s gives column %s type %s; expected "
+                                                     "one of %s" % (fileName, columnName, columnType, ", ".join(sorted(self.columnTypes.keys()))))
+            self._columnDict[columnOrder] = columnName
+            self._columnNumbers[columnName] = columnOrder
+            self._columnTypeDict[columnName] = columnType
             columnOrder += 1
 
     def getColumnNameIterator(self):
@@ -41,48 +65,440 @@ class PcssModelTableColumns:
     def getColumnCount(self):
         return len(self._columnDict.keys())
 
+    def hasColumn(self, columnName):
+        return columnName in self._columnNumbers
+
+    def getColumnNumber(self, columnName):
+        if (not self.hasColumn(columnName)):
+            raise pcssErrors.PcssGlobalException("Error: model table does not have column %s. Make sure this attribute "
+                                                 "is specified in the model column info file" % columnName)
+        return self._columnNumbers[columnName]
+
+    def getColumnType(self, columnName):
+        return self._columnTypeDict[columnName]
+
+    def getColumnDtype(self):
+        """Return numpy structured dtype with one field per column, typed as given in the column order file"""
+        return [(columnName, self.columnTypes[self.getColumnType(columnName)]) for columnName in self.getColumnNameIterator()]
+
+    def splitLine(self, line):
+        """Return list of values in model table line; raise exception if it doesn't have one value per column"""
+        cols = line.split('\t')
+        if (self.getColumnCount() != len(cols)):
+            raise pcssErrors.PcssGlobalException("Model table column order file contains a "
+                                                 "different number of columns (%s) than model table (%s)\nline: %s" % 
+                                                 (self.getColumnCount(), len(cols), line))
+        return cols
+
 class PcssModelTable:
 
-    """Class representing a model table file that was generated from an SQL query; creates models and groups them by their proteins"""
+    """Class representing a model table file that was generated from an SQL query; creates models and groups them by their proteins
+
+    If index_model_table is set, the table is opened through an offset index keyed by seq_id (built once and saved
+    next to the table) and models are only created for the sequences that are asked for, so a run only pays for its
+    own proteins. Otherwise every line is read when the table is created."""
 
     def __init__(self, pcssRunner, modelTableColumns):
-        """Read model table file and make one model for each line"""
-        reader = pcssTools.PcssFileReader(pcssRunner.internalConfig['model_table_file'])
-        lines = reader.getLines()
+        """Open model table file; read it completely and make one model for each line unless it is indexed"""
         self.pcssRunner = pcssRunner
+        self.modelTableColumns = modelTableColumns
         self._sequenceDict = {}
-        for line in lines:
-            pcssModel = PcssModel(pcssRunner)
-            pcssModel.initFromModelTableLine(line, modelTableColumns)
-            
-            self.addModel(pcssModel)
-
-    def addModel(self, pcssModel):
-        sequenceId = pcssModel.getAttributeValue("seq_id")
-        modelSequence = self.getPcssModelSequence(sequenceId)
-        modelSequence.addModel(pcssModel)
+        self.indexedTable = None
+        modelTableFile = pcssRunner.internalConfig['model_table_file']
+        if (self.useIndex()):
+            self.indexedTable = pcssIO.IndexedModelTableFile(modelTableFile)
+            self.checkColumnCount()
+        else:
+            reader = pcssTools.PcssFileReader(modelTableFile)
+            sequenceIdColumn = self.modelTableColumns.getColumnNumber("seq_id")
+            sequenceFields = collections.OrderedDict()
+            for line in reader.getLines():
+                fields = self.modelTableColumns.splitLine(line)
+                sequenceFields.setdefault(fields[sequenceIdColumn], []).append(fields)
+            for sequenceId, fieldsList in sequenceFields.iteritems():
+                self.makeModelSequence(sequenceId, fieldsList)
+
+    def useIndex(self):
+        """The index is keyed on the first column, so only use it when that column is seq_id"""
+        return (self.pcssRunner.internalConfig['index_model_table'] and self.modelTableColumns.getColumnCount() > 0 and
+                self.modelTableColumns.getColumnName(0) == "seq_id")
+
+    def checkColumnCount(self):
+        """Read the first line so a column order file that doesn't match the table fails right away, as it does when
+        the whole table is read"""
+        firstLine = self.indexedTable.getFirstLine()
+        if (firstLine is not None):
+            modelSequence = PcssModelSequence("firstLine")
+            modelSequence.loadModelTableFields(self.pcssRunner, [self.modelTableColumns.splitLine(firstLine)], self.modelTableColumns)
+
+    def makeModelSequence(self, sequenceId, fieldsList):
+        modelSequence = PcssModelSequence(sequenceId)
+        modelSequence.loadModelTableFields(self.pcssRunner, fieldsList, self.modelTableColumns)
+        self._sequenceDict[sequenceId] = modelSequence
+        return modelSequence
 
     def getPcssModelSequence(self, sequenceId):
         """Factory method for getting a PcssModelSequence for the input sequenceId"""
-        modelSequence = None
-
         if (sequenceId in self._sequenceDict):
             return self._sequenceDict[sequenceId]
-        else:
-            modelSequence = PcssModelSequence(sequenceId)
-            self._sequenceDict[sequenceId] = modelSequence
-        return modelSequence
+        fieldsList = []
+        if (self.indexedTable is not None):
+            fieldsList = [self.modelTableColumns.splitLine(line) for line in self.indexedTable.getSequenceLines(sequenceId)]
+        return self.makeModelSequence(sequenceId, fieldsList)
             
     def getSequences(self):
+        """Return all sequences in the table; if the table is indexed, only sequences that have been loaded so far"""
         return self._sequenceDict.values()
 
+def runDsspOnModelFile(dsspExecutable, modelFileName):
+    """Run DSSP on a model PDB file and return its results as arrays (see readDsspOutput())
+
+    Raise DsspException if the executable can't be run or the model file can't be read"""
+    commandList = dsspExecutable.split(" ")
+    commandList.append(modelFileName)
+    try:
+        process = subprocess.Popen(commandList, shell=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        (dsspOutput, dsspError) = process.communicate()
+    except OSError, e:
+        raise pcssErrors.DsspException("Could not run DSSP executable %s on model file %s: %s" % (dsspExecutable, modelFileName, e))
+    try:
+        residueNames = readModelResidueNames(modelFileName)
+    except (IOError, OSError), e:
+        raise pcssErrors.DsspException("Could not read model file %s: %s" % (modelFileName, e))
+    return readDsspOutput(dsspOutput.splitlines(), residueNames)
+
+def readModelResidueNames(modelFileName):
+    """Return dictionary of (residue number, insertion code) to three letter residue name for the blank chain of the
+    first model in a PDB file
+
+    Reads the ATOM / HETATM records directly rather than building a structure. As in BioPython's DSSP module, an ATOM
+    residue is used over a HETATM residue with the same number, waters are ignored, and for residues with alternate
+    locations the name of location A (or 1, or blank) is used."""
+    residueNames = {}
+    fh = open(modelFileName, 'r')
+    try:
+        for line in fh:
+            recordName = line[0:6]
+            if (recordName == "ENDMDL"):
+                break
+            if ((recordName != "ATOM  " and recordName != "HETATM") or len(line) < 27 or line[21] != ' '):
+                continue
+            residueName = line[17:20].strip()
+            if (recordName == "HETATM" and (residueName == "HOH" or residueName == "WAT")):
+                continue
+            residueKey = (int(line[22:26]), line[26])
+            #rank of this record for the residue name; lower is better
+            recordRank = (recordName == "HETATM") * 2 + (line[16] not in "A1 ")
+            if (residueKey not in residueNames or recordRank < residueNames[residueKey][1]):
+                residueNames[residueKey] = (residueName, recordRank)
+    finally:
+        fh.close()
+    return dict((residueKey, residueName) for (residueKey, (residueName, recordRank)) in residueNames.iteritems())
+
+def readDsspOutput(outputLines, residueNames):
+    """Parse DSSP output into [residue codes, secondary structure, relative solvent accessibility] arrays indexed by
+    zero-based residue position (residue number - 1)
+
+    Only residues in the blank chain without insertion codes are kept. The fixed columns are read the way
+    BioPython's DSSP module reads them, and relative accessibility is the DSSP accessibility divided by BioPython's
+    maximum for the residue (at most 1.0; nan for non-standard residues). Residue codes come from the residue names in
+    the model file (residueNames, see readModelResidueNames()); non-standard residues get an empty code so any
+    peptide covering them is reported as a mismatch."""
+    residueEntries = []
+    readingResidues = False
+    for line in outputLines:
+        if (not readingResidues):
+            fields = line.split()
+            readingResidues = (len(fields) > 1 and fields[1] == "RESIDUE")
+            continue
+        if (len(line) < 12 or line[9] == " "):
+            #chain break
+            continue
+        try:
+            accessibility = int(line[34:38])
+            float(line[103:109])
+            float(line[109:115])
+        except ValueError:
+            #accessibility overflowed its columns; DSSP shifts the rest of the line
+            if (line[34] == ' '):
+                raise
+            shift = line[34:].find(' ')
+            accessibility = int(line[34 + shift:38 + shift])
+        residueNumber = int(line[5:10])
+        if (line[11] != ' ' or line[10] != ' ' or residueNumber < 1):
+            continue
+        secondaryStructure = line[16]
+        if (secondaryStructure == " "):
+            secondaryStructure = "-"
+        residueEntries.append((residueNumber - 1, residueNames.get((residueNumber, ' ')), secondaryStructure, accessibility))
+
+    arrayLength = 0
+    for (residueIndex, residueName, secondaryStructure, accessibility) in residueEntries:
+        arrayLength = max(arrayLength, residueIndex + 1)
+    residueCodes = numpy.zeros(arrayLength, dtype='S1')
+    secondaryStructureCalls = numpy.zeros(arrayLength, dtype='S1')
+    relativeSolventAcc = numpy.zeros(arrayLength, dtype=numpy.float64)
+    for (residueIndex, residueName, secondaryStructure, accessibility) in residueEntries:
+        try:
+            residueCodes[residueIndex] = pcssTools.getOneLetterFromBioResidue(residueName)
+        except KeyError:
+            residueCodes[residueIndex] = ''
+        secondaryStructureCalls[residueIndex] = secondaryStructure
+        if (residueName in dsspMaxAccessibility):
+            relativeSolventAcc[residueIndex] = min(accessibility / dsspMaxAccessibility[residueName], 1.0)
+        else:
+            relativeSolventAcc[residueIndex] = numpy.nan
+    return [residueCodes, secondaryStructureCalls, relativeSolventAcc]
+
+class DsspRunner:
+
+    """Computes DSSP for the distinct best models of a group of proteins before their peptides read DSSP features
+
+    Proteins get their models and their peptides' best models chosen here (the same choice processDssp() makes
+    later). If model files are kept, files of models that aren't in the DSSP cache are prefetched (see
+    PcssModelHandler.prefetchModelFiles()). Then every best model without DSSP results is loaded in a thread pool
+    of size dssp_worker_count: read from the DSSP cache or run through DSSP. Each DSSP run is its own process, so
+    runs overlap even though the workers are threads. A model whose DSSP fails keeps its exception, which is raised again for each
+    peptide that uses it when peptides process DSSP, so the failure is recorded the same way as before."""
+
+    def __init__(self, pcssRunner):
+        self.pcssRunner = pcssRunner
+
+    def getWorkerCount(self):
+        return self.pcssRunner.internalConfig.as_int("dssp_worker_count")
+
+    def runMissingDssp(self, pcssProteins):
+        missingModels = self.getMissingModels(pcssProteins)
+        if (len(missingModels) == 0):
+            return
+        self.prefetchModelFiles(missingModels)
+        workerCount = min(self.getWorkerCount(), len(missingModels))
+        log.info("Loading DSSP for %s models with %s workers" % (len(missingModels), workerCount))
+        pool = multiprocessing.pool.ThreadPool(workerCount)
+        try:
+            pool.map(self.runDsspJob, missingModels)
+        finally:
+            pool.close()
+            pool.join()
+        self.pcssRunner.modelHandler.logStructureCacheCounts()
+
+    def prefetchModelFiles(self, missingModels):
+        """Retrieve the files of models that will need DSSP run (those not in the DSSP cache) before running it"""
+        dsspCache = self.pcssRunner.getDsspCache()
+        fileModels = [model for model in missingModels if dsspCache is None or not dsspCache.hasResults(model.getId())]
+        self.pcssRunner.modelHandler.prefetchModelFiles(fileModels)
+
+    def getMissingModels(self, pcssProteins):
+        """Return list of distinct best models of the proteins' peptides that don't have DSSP results yet"""
+        missingModels = {}
+        for pcssProtein in pcssProteins:
+            pcssProtein.addModels(self.pcssRunner.modelTable)
+            if (pcssProtein.hasErrors() or not pcssProtein.hasModels()):
+                continue
+            pcssProtein.setPeptideBestModels()
+            for peptide in pcssProtein.peptides.values():
+                model = peptide.bestModel
+                if (model and not model.hasDsspResults() and model.dsspException is None):
+                    missingModels[model.getId()] = model
+        return missingModels.values()
+
+    def runDsspJob(self, pcssModel):
+        """Load DSSP results for one model in a pool worker; failures are kept by the model (see PcssModel.loadDsspResults())"""
+        try:
+            pcssModel.loadDsspResults()
+        except pcssErrors.StructureException:
+            pass
+
+class RankedModelIndex:
+
+    """Interval index over a protein's ranked models for finding each peptide's best model
+
+    The best model for a peptide is the highest ranked model that contains it (see PcssModel.containsPeptide()).
+    Rather than scanning the ranked list for every peptide, peptides are visited in order of start position while
+    models whose start is before the peptide are added to a Fenwick tree keyed by model end position that keeps the
+    best rank seen; the best model for the peptide is the best rank among added models ending after the peptide. This
+    takes O((models + peptides) log models) for a protein instead of O(models * peptides)."""
+
+    def __init__(self, rankedModels):
+        self.rankedModels = rankedModels
+        self.modelsByStart = sorted(range(len(rankedModels)), key=lambda rank: rankedModels[rank].getModelStart())
+        self.modelEnds = sorted(set([model.getModelEnd() for model in rankedModels]))
+
+    def getBestModels(self, peptides):
+        """Return dictionary of peptide start position to the best ranked model containing that peptide; peptides
+        that no model contains are left out"""
+        endCount = len(self.modelEnds)
+        #tree position i covers end positions in descending order, so a prefix query covers all ends after a position
+        bestRanks = [len(self.rankedModels)] * (endCount + 1)
+        bestModels = {}
+        nextModel = 0
+        for peptide in sorted(peptides, key=lambda peptide: peptide.startPosition):
+            while (nextModel < len(self.modelsByStart) and
+                   self.rankedModels[self.modelsByStart[nextModel]].getModelStart() < peptide.startPosition):
+                rank = self.modelsByStart[nextModel]
+                treePosition = endCount - bisect.bisect_left(self.modelEnds, self.rankedModels[rank].getModelEnd())
+                while (treePosition <= endCount):
+                    bestRanks[treePosition] = min(bestRanks[treePosition], rank)
+                    treePosition += treePosition & -treePosition
+                nextModel += 1
+            treePosition = endCount - bisect.bisect_right(self.modelEnds, peptide.endPosition)
+            bestRank = len(self.rankedModels)
+            while (treePosition > 0):
+                bestRank = min(bestRank, bestRanks[treePosition])
+                treePosition -= treePosition & -treePosition
+            if (bestRank < len(self.rankedModels)):
+                bestModels[peptide.startPosition] = self.rankedModels[bestRank]
+        return bestModels
+
+class DsspResultCache:
+
+    """Saved DSSP results for models, one file per model ID under model_directory
+
+    DSSP results for a ModBase model never change, so once a model's per-residue arrays (see
+    PcssModel.loadDsspArrays()) are computed they are saved in <model_directory>/<first two letters of model
+    id>/<model id>.pcssdssp and later runs load them without retrieving the PDB file or running DSSP. The file has a
+    fixed size header (version, model id, residue count) followed by the residue codes, the secondary structure calls
+    and, aligned to 8 bytes, the relative accessibilities as float64 so cached values give the same output as new
+    ones. A file that doesn't match its header is ignored and DSSP is run again.
+
+    Only used when use_dssp_cache is set (off by default), since model_directory is usually shared and every run
+    would otherwise write its models' results there."""
+
+    cacheVersion = "PCSSDS1"
+    headerSize = 64
+
+    def __init__(self, cacheDirectory, pdh):
+        self.cacheDirectory = cacheDirectory
+        self.pdh = pdh
+
+    def getCacheFile(self, modelId):
+        return os.path.join(self.cacheDirectory, modelId[0:2], "%s.pcssdssp" % modelId)
+
+    def hasResults(self, modelId):
+        return os.path.exists(self.getCacheFile(modelId))
+
+    def getAccOffset(self, residueCount):
+        unalignedOffset = self.headerSize + 2 * residueCount
+        return unalignedOffset + (-unalignedOffset % 8)
+
+    def readResults(self, pcssModel):
+        """Set pcssModel's DSSP arrays from its cache file; return False if there is no usable cache file"""
+        cacheFile = self.getCacheFile(pcssModel.getId())
+        if (not os.path.exists(cacheFile)):
+            return False
+        try:
+            fh = open(cacheFile, 'rb')
+            try:
+                cacheContents = fh.read()
+            finally:
+                fh.close()
+            headerFields = cacheContents[0:self.headerSize].rstrip().split('\t')
+            if (len(headerFields) != 3 or headerFields[0] != self.cacheVersion or headerFields[1] != pcssModel.getId()):
+                log.info("DSSP cache file %s does not match model %s; running DSSP" % (cacheFile, pcssModel.getId()))
+                return False
+            residueCount = int(headerFields[2])
+            accOffset = self.getAccOffset(residueCount)
+            if (len(cacheContents) != accOffset + 8 * residueCount):
+                log.info("DSSP cache file %s has unexpected size; running DSSP" % cacheFile)
+                return False
+        except (ValueError, EnvironmentError), e:
+            log.info("Could not read DSSP cache file %s (%s); running DSSP" % (cacheFile, e))
+            return False
+        residueCodes = numpy.frombuffer(cacheContents, dtype='S1', count=residueCount, offset=self.headerSize)
+        secondaryStructure = numpy.frombuffer(cacheContents, dtype='S1', count=residueCount, offset=self.headerSize + residueCount)
+        relativeSolventAcc = numpy.frombuffer(cacheContents, dtype=numpy.float64, count=residueCount, offset=accOffset)
+        pcssModel.setDsspArrays(residueCodes, secondaryStructure, relativeSolventAcc)
+        return True
+
+    def writeResults(self, pcssModel):
+        """Save pcssModel's DSSP arrays to its cache file; if that fails (e.g. read-only model directory), just log it"""
+        cacheFile = self.getCacheFile(pcssModel.getId())
+        residueCount = len(pcssModel.dsspResidueCodes)
+        header = "%s\t%s\t%s" % (self.cacheVersion, pcssModel.getId(), residueCount)
+        padding = self.getAccOffset(residueCount) - self.headerSize - 2 * residueCount
+
+        def writeArrays(fh):
+            fh.write(header.ljust(self.headerSize - 1) + "\n")
+            fh.write(pcssModel.dsspResidueCodes.astype('S1').tostring())
+            fh.write(pcssModel.dsspSecondaryStructure.astype('S1').tostring())
+            fh.write("\0" * padding)
+            fh.write(pcssModel.dsspRelativeSolventAcc.astype(numpy.float64).tostring())
+        try:
+            self.pdh.makeDirectory(os.path.dirname(cacheFile))
+            self.pdh.publishFile(cacheFile, writeArrays)
+        except (pcssErrors.PcssGlobalException, IOError, OSError), e:
+            log.info("Could not write DSSP cache file %s (%s)" % (cacheFile, e))
+
+class LoadedDsspResults:
+
+    """Bounds the memory used by the DSSP arrays of a run's models
+
+    Models add themselves once their DSSP arrays are loaded and mark themselves used each time the arrays are asked
+    for. When the arrays of all added models take more than loaded_dssp_max_megabytes, the least recently used
+    models release theirs (the most recently added model is always kept); PcssModel.loadDsspResults() loads them
+    again from the DSSP cache, or by running DSSP if the cache is off, when they are needed later. Models are added
+    from DSSP pool workers, so changes are made under a lock.
+
+    The DSSP stage loads the best models of a whole group of proteins before their peptides read them (all input
+    proteins unless streaming_mode is on), so the budget should hold one group's models; otherwise models are
+    released before they are read and loaded twice. The bound is off (0) by default."""
+
+    def __init__(self, maxMegabytes):
+        self.maxBytes = maxMegabytes * 1024 * 1024
+        self.loadedBytes = 0
+        self.releaseCount = 0
+        self._modelSizes = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def addModel(self, pcssModel):
+        with self.lock:
+            if (pcssModel in self._modelSizes):
+                self.loadedBytes -= self._modelSizes.pop(pcssModel)
+            self._modelSizes[pcssModel] = pcssModel.getDsspArraysSize()
+            self.loadedBytes += self._modelSizes[pcssModel]
+            while (self.loadedBytes > self.maxBytes and len(self._modelSizes) > 1):
+                [releasedModel, releasedBytes] = self._modelSizes.popitem(last=False)
+                releasedModel.releaseDsspArrays()
+                self.loadedBytes -= releasedBytes
+                self.releaseCount += 1
+                log.debug("Released DSSP results for model %s; %s bytes of DSSP results loaded" % (releasedModel.getId(), self.loadedBytes))
+
+    def markUsed(self, pcssModel):
+        with self.lock:
+            if (pcssModel in self._modelSizes):
+                self._modelSizes[pcssModel] = self._modelSizes.pop(pcssModel)
+
+    def getLoadedModelCount(self):
+        return len(self._modelSizes)
+
 class PcssModelSequence:
 
-    """Simple class for grouping models read in by model table; models from here are later transferred to PcssProteins"""
+    """Class for grouping models read in by model table; models from here are later transferred to PcssProteins
+
+    The sequence's model table values are kept as a numpy structured array with one typed field per column
+    (columnValues, one row per model) next to the values as they appear in the table (tableFields, used for
+    output). Each PcssModel is a view of one row, so numeric values are converted once per table rather than on
+    every access, and coverage and ranking are computed for all of a protein's models at once."""
 
     def __init__(self, modbaseSeqId):
         self._models = []
         self.modbaseSeqId = modbaseSeqId
+        self.modelTableColumns = None
+        self.columnValues = None
+        self.tableFields = None
+        self.modelCoverage = None
+
+    def loadModelTableFields(self, pcssRunner, fieldsList, modelTableColumns):
+        """Convert model table values (one list of column values per model) to typed columns and make a model for each row"""
+        self.modelTableColumns = modelTableColumns
+        self.tableFields = fieldsList
+        try:
+            self.columnValues = numpy.array([tuple(fields) for fields in fieldsList], dtype=modelTableColumns.getColumnDtype())
+        except ValueError, e:
+            raise pcssErrors.PcssGlobalException("Model table values for sequence %s don't match the column types in the model "
+                                                 "table column order file: %s" % (self.modbaseSeqId, e))
+        for rowIndex in range(len(fieldsList)):
+            self.addModel(PcssModel(pcssRunner, self, rowIndex))
 
     def addModel(self, pcssModel):
         self._models.append(pcssModel)
@@ -95,6 +511,41 @@ class PcssModelSequence:
             if (m.getId() == modelId):
                 return m
 
+    def hasColumn(self, columnName):
+        return self.modelTableColumns is not None and self.modelTableColumns.hasColumn(columnName)
+
+    def getTableValue(self, rowIndex, columnName):
+        """Return value of columnName for the model in rowIndex as it appears in the model table"""
+        return self.tableFields[rowIndex][self.modelTableColumns.getColumnNumber(columnName)]
+
+    def getColumnValue(self, rowIndex, columnName):
+        """Return typed value of columnName for the model in rowIndex"""
+        return self.columnValues[columnName][rowIndex]
+
+    def calculateCoverage(self, proteinSeqLength):
+        """Calculate the fraction of the protein covered by each model; raise exception if any model's end is not after its start"""
+        if (self.columnValues is None or len(self._models) == 0):
+            return
+        targetBegin = self.columnValues["target_beg"].astype(numpy.int64)
+        targetEnd = self.columnValues["target_end"].astype(numpy.int64)
+        invalidRows = numpy.nonzero(targetEnd <= targetBegin)[0]
+        if (len(invalidRows) > 0):
+            invalidRow = invalidRows[0]
+            raise pcssErrors.PcssGlobalException("Error in model table: model %s has target_end position %s "
+                                                 "before target_start position %s" % (self._models[invalidRow].getId(), targetEnd[invalidRow],
+                                                                                      targetBegin[invalidRow]))
+        self.modelCoverage = (targetEnd - targetBegin) / float(proteinSeqLength)
+
+    def getRankValues(self, pcssModels, attributeName):
+        """Return array of the typed value of attributeName (a model table column or coverage) for each of pcssModels"""
+        rows = [pcssModel.rowIndex for pcssModel in pcssModels]
+        if (attributeName == "coverage"):
+            return self.modelCoverage[rows]
+        if (not self.hasColumn(attributeName)):
+            raise pcssErrors.PcssGlobalException("Error: model does not have attribute %s. Make sure this attribute "
+                                                 "is specified in the model column info file" % attributeName)
+        return self.columnValues[attributeName][rows]
+
     def getOutput(self):
         result = "\nModbase Seq: %s\n" % self.modbaseSeqId
         modelOutputList = []
@@ -106,68 +557,103 @@ class PcssModelSequence:
 
 class PcssModel:
 
-    """Class for a homology model for a protein. Stores all attributes for the model and handles DSSP processing"""
+    """Class for a homology model for a protein. Stores all attributes for the model and handles DSSP processing
 
-    def __init__(self, pcssRunner):
+    A model read from the model table is a view of one row of its PcssModelSequence's columns; attributes set
+    later (coverage for models read elsewhere, model url, values read from an annotation file) are kept by the
+    model itself and take precedence over the table's values."""
+
+    def __init__(self, pcssRunner, modelSequence=None, rowIndex=None):
         self._attributes = {}
+        self.modelSequence = modelSequence
+        self.rowIndex = rowIndex
         self.pcssRunner = pcssRunner
-        self.bioModel = None
-        self.dssp = None
+        self.dsspResidueCodes = None
+        self.dsspException = None
+        self._modelBounds = None
         
     def loadDsspResults(self):
-        """Get the PDB file for this model and use it as input for DSSP"""
-        self.loadBioModelPdb()
-        self.runDssp()
+        """Load this model's DSSP results from the run's DSSP cache; if they aren't there, get the PDB file, run
+        DSSP on it and save the results to the cache. If that fails, the exception is kept and raised again on later
+        calls rather than running DSSP again.
+
+        If the run bounds the memory used by DSSP results (see LoadedDsspResults), the results may be released when
+        other models are loaded; they are loaded again the same way the next time they are needed"""
+        loadedDsspResults = self.pcssRunner.getLoadedDsspResults()
+        if (self.hasDsspResults()):
+            if (loadedDsspResults is not None):
+                loadedDsspResults.markUsed(self)
+            return
+        if (self.dsspException is not None):
+            raise self.dsspException
+        dsspCache = self.pcssRunner.getDsspCache()
+        if (dsspCache is None or not dsspCache.readResults(self)):
+            try:
+                self.runDssp()
+            except pcssErrors.StructureException, e:
+                self.dsspException = e
+                raise
+            if (dsspCache is not None):
+                dsspCache.writeResults(self)
+        if (loadedDsspResults is not None):
+            loadedDsspResults.addModel(self)
+
+    def hasDsspResults(self):
+        return self.dsspResidueCodes is not None
 
     def runDssp(self):
-        """Run DSSP executable for this model"""
-        if (self.dssp is None):
-            dssp = PDB.DSSP(self.bioModel, self.pcssRunner.pdh.getFullModelFile(self), 
-                            self.pcssRunner.internalConfig["dssp_executable"])
-            #Hard to get exact reason why DSSP didn't work since it's BioPython, but will set 
-            #as feature exception rather than global exception
-            if (dssp is None or len(dssp.keys()) < 1):
-                raise pcssErrors.DsspException("Did not load DSSP for model %s. This likely indicates a problem with the "
-                                               "Biopython DSSP module;\ntry running DSSP from the command line to isolate "
-                                               "the issue" % self.getId())
-            self.dssp = dssp
+        """Run DSSP executable on this model's PDB file and store its results"""
+        dsspExecutable = self.pcssRunner.internalConfig["dssp_executable"]
+        [residueCodes, secondaryStructure, relativeSolventAcc] = self.pcssRunner.modelHandler.runOnModelFile(
+            self, lambda modelFileName: runDsspOnModelFile(dsspExecutable, modelFileName))
+        if (len(residueCodes) < 1):
+            raise pcssErrors.DsspException("Did not load DSSP for model %s; DSSP reported no residues for its model file.\n"
+                                           "Try running DSSP from the command line to isolate the issue" % self.getId())
+        self.setDsspArrays(residueCodes, secondaryStructure, relativeSolventAcc)
+
+    def setDsspArrays(self, residueCodes, secondaryStructure, relativeSolventAcc):
+        """Set DSSP results from arrays indexed by zero-based residue position (model residue number - 1)
+
+        Peptide DSSP features are slices of these arrays, so each model's results are read only once no matter
+        how many peptides use it as their best model. Positions DSSP did not report have an empty residue code."""
+        self.dsspResidueCodes = residueCodes
+        self.dsspSecondaryStructure = secondaryStructure
+        self.dsspRelativeSolventAcc = relativeSolventAcc
+        self.dsspMappedStructure = pcssFeatures.DsspStructureFeature.mapStructureArray(self.dsspSecondaryStructure)
+
+    def releaseDsspArrays(self):
+        self.dsspResidueCodes = None
+        self.dsspSecondaryStructure = None
+        self.dsspRelativeSolventAcc = None
+        self.dsspMappedStructure = None
+
+    def getDsspArraysSize(self):
+        """Return number of bytes used by this model's DSSP arrays"""
+        return sum([dsspArray.nbytes for dsspArray in [self.dsspResidueCodes, self.dsspSecondaryStructure,
+                                                       self.dsspRelativeSolventAcc, self.dsspMappedStructure]])
 
     def getRelativeSolventAcc(self, residueIndex):
         """Return the fraction of the residue that is accessible to solvent according to DSSP"""
-        dsspList = self.getDsspTuple(residueIndex)
-        relativeSolventAcc = dsspList[3]
-        return relativeSolventAcc
+        return self.dsspRelativeSolventAcc[residueIndex]
 
     def getSecondaryStructure(self, residueIndex):
         """Return the secondary structure call for this residue according to DSSP"""
-        dsspList = self.getDsspTuple(residueIndex)
-        secondaryStructure = dsspList[1]
-        return secondaryStructure
+        return self.dsspSecondaryStructure[residueIndex]
 
     def getDsspResidueCode(self, residueIndex):
         """Get the one-letter residue code for this residue according to DSSP (mostly for testing / validation"""
-        dsspList = self.getDsspTuple(residueIndex)
-        residueCode = pcssTools.getOneLetterFromBioResidue(dsspList[0].get_resname())
-
-        return residueCode
-
-    def getDsspTuple(self, residueIndex):
-        """Return DSSP information for this residue.
-
-        DSSP is sort of messy; use this as a convenience method for accessing its results. Results are returned as a 
-        5-element list: [residue object, secondary structure, solvent accessibility, relative solvent accessibility, ?]"""
-        dsspKey = (' ', self.bioChain._translate_id(residueIndex + 1))
-        dsspTuple =  self.dssp[dsspKey]
-        return dsspTuple
-
-    def loadBioModelPdb(self):
-        """Create a BioPython model and chain object for this model"""
-        if (self.bioModel is None):
-            modelFileName = self.pcssRunner.modelHandler.getLocalModelFileName(self)
-            parser =  self.pcssRunner.getBioParser()
-            self.bioModel = parser.get_structure(self.getId(), modelFileName)[0]
-            self.bioChain =  self.bioModel[" "]
-                
+        return self.dsspResidueCodes[residueIndex]
+
+    def getPeptideDsspArrays(self, startPosition, endPosition):
+        """Return copies of [residue codes, mapped secondary structure, relative solvent accessibility] for the
+        residues startPosition through endPosition (zero-based, inclusive)
+
+        Copies rather than views, so peptide features don't keep this model's full arrays alive after
+        releaseDsspArrays()"""
+        sliceEnd = endPosition + 1
+        return [self.dsspResidueCodes[startPosition:sliceEnd].copy(), self.dsspMappedStructure[startPosition:sliceEnd].copy(),
+                self.dsspRelativeSolventAcc[startPosition:sliceEnd].copy()]
+
     def getPdbFileName(self):
         return "%s.pdb" % self.getId()
 
@@ -177,47 +663,56 @@ class PcssModel:
     def getSequenceId(self):
         return self.getAttributeValue("seq_id")
 
+    def isTableRow(self):
+        return self.modelSequence is not None
+
     def getAttributeValue(self, attributeName):
         """"Return string for the given attribute as it appears in the model table"""
-        if (not attributeName in self._attributes):
-            raise pcssErrors.PcssGlobalException("Error: model does not have attribute %s. Make sure this attribute "
-                                                 "is specified in the model column info file" % attributeName)
-        return self._attributes[attributeName]
-
+        if (attributeName in self._attributes):
+            return self._attributes[attributeName]
+        if (self.isTableRow()):
+            if (self.modelSequence.hasColumn(attributeName)):
+                return self.modelSequence.getTableValue(self.rowIndex, attributeName)
+            if (attributeName == "coverage" and self.modelSequence.modelCoverage is not None):
+                return float(self.modelSequence.modelCoverage[self.rowIndex])
+        raise pcssErrors.PcssGlobalException("Error: model does not have attribute %s. Make sure this attribute "
+                                             "is specified in the model column info file" % attributeName)
+
+    def getTypedValue(self, attributeName):
+        """Return the given attribute converted to its column type; attributes set on the model are returned as they were set"""
+        if (attributeName not in self._attributes and self.isTableRow() and self.modelSequence.hasColumn(attributeName)):
+            return self.modelSequence.getColumnValue(self.rowIndex, attributeName)
+        return self.getAttributeValue(attributeName)
 
     def getAttributeNames(self):
-        return self._attributes.keys()
+        attributeNames = []
+        if (self.isTableRow()):
+            attributeNames = self.modelSequence.modelTableColumns.getColumnNameIterator()
+            if (self.modelSequence.modelCoverage is not None):
+                attributeNames.append("coverage")
+        return attributeNames + [attributeName for attributeName in self._attributes.keys() if attributeName not in attributeNames]
 
     def setAttribute(self, attributeName, attributeValue):
         self._attributes[attributeName] = attributeValue
-
-    def initFromModelTableLine(self, line, modelTableColumns):
-        """Initialize model from file.
-
-        Use ModelTableColumns to get the names of each attribute in the line (which is read from the model table file)
-        and save these attributes internally"""
-        cols = line.split('\t')
-        i = 0
-
-        if (modelTableColumns.getColumnCount() != len(cols)):
-            raise pcssErrors.PcssGlobalException("Model table column order file contains a "
-                                                 "different number of columns (%s) than model table (%s)\nline: %s" % 
-                                                 (modelTableColumns.getColumnCount(), len(cols), line))
-        for col in cols:
-            columnName = modelTableColumns.getColumnName(i)
-            self.setAttribute(columnName, col)
-            i += 1
+        if (attributeName == "target_beg" or attributeName == "target_end"):
+            self._modelBounds = None
 
     def containsPeptide(self, peptide):
         """Return true if the given peptide is fully contained within this model"""
         return (peptide.startPosition > self.getModelStart() and
                 peptide.endPosition < self.getModelEnd())
     
+    def getModelBounds(self):
+        """Return [target_beg, target_end] as ints; converted once and kept until either attribute is set again"""
+        if (self._modelBounds is None):
+            self._modelBounds = [int(self.getTypedValue("target_beg")), int(self.getTypedValue("target_end"))]
+        return self._modelBounds
+
     def getModelStart(self):
-        return int(self.getAttributeValue("target_beg"))
+        return self.getModelBounds()[0]
     
     def getModelEnd(self):
-        return int(self.getAttributeValue("target_end"))
+        return self.getModelBounds()[1]
 
     def getRange(self):
         return [self.getAttributeValue("target_beg"), self.getAttributeValue("target_end")]
@@ -227,8 +722,8 @@ class PcssModel:
 
     def getOutput(self):
         outputList = []
-        for attributeName, attributeValue in self._attributes.iteritems():
-            outputList.append("%s = %s" % (attributeName, attributeValue))
+        for attributeName in self.getAttributeNames():
+            outputList.append("%s = %s" % (attributeName, self.getAttributeValue(attributeName)))
 
         return "; ".join(outputList)
 
@@ -240,8 +735,7 @@ class PcssModel:
         self.setAttribute("model_url", modelUrl)
 
     def getLength(self):
-        targetEnd = int(self.getAttributeValue("target_end"))
-        targetBegin = int(self.getAttributeValue("target_beg"))
+        [targetBegin, targetEnd] = self.getModelBounds()
         if (targetEnd <= targetBegin):
             raise pcssErrors.PcssGlobalException("Error in model table: model %s has target_end position %s "
                                                  "before target_start position %s" % (self.getId(), targetEnd, targetBegin))
@@ -250,8 +744,9 @@ class PcssModel:
     def isEqual(self, otherModel):
         if (otherModel is None):
             return False
+        attributeNames = set(self.getAttributeNames())
         for attName in otherModel.getAttributeNames():
-            if (attName not in self._attributes):
+            if (attName not in attributeNames):
                 return False
             if (str(self.getAttributeValue(attName)) != str(otherModel.getAttributeValue(attName))):
                 return False
@@ -8,6 +8,8 @@ import pcssSvm
 import pcssErrors
 import pcssFeatures
 import pcssFeatureHandlers
+import pcssModels
+import numpy
 log = logging.getLogger("pcssPeptide")
 
 class PcssProtein(object):
@@ -18,6 +20,9 @@ class PcssProtein(object):
         self.modbaseSequenceId = modbaseSequenceId
         self.peptides = {}
         self._pcssModels = None
+        self._modelSequence = None
+        self._rankedModels = None
+        self._rankedModelIndex = None
         self.uniprotId = "<uninitialized>"
         self.pcssRunner = pcssRunner
         self.proteinSequence = None
@@ -39,6 +44,10 @@ class PcssProtein(object):
     def hasModels(self):
         return len(self._pcssModels.values()) > 0
 
+    def hasLoadedModels(self):
+        """Return True if addModels() has read my models from the model table, so they are ranked only once"""
+        return self._modelSequence is not None
+
     def setStringAttribute(self, attributeName, attributeValue):
         self.pcssRunner.pfa.validateAttribute(attributeName)
         self.proteinAttributes[attributeName] = pcssFeatures.StringAttribute(attributeName, attributeValue)
@@ -168,12 +177,14 @@ class PcssProtein(object):
             return
         
         modelSequence = modelTable.getPcssModelSequence(self.modbaseSequenceId)
-        print "got model squence; %s" % modelSequence
         modelList = modelSequence.getModels()
-        print "model list length: %s" % len(modelList)
+        log.debug("Protein %s: got %s models from model table" % (self.modbaseSequenceId, len(modelList)))
         self._pcssModels = {}
+        self._modelSequence = modelSequence
+        self._rankedModels = None
+        self._rankedModelIndex = None
+        modelSequence.calculateCoverage(self.getSequenceLength())
         for model in modelList:
-            model.calculateCoverage(self.getSequenceLength())
             model.setModelUrl(self.pcssRunner.getModelUrl(model.getId()))
             self._pcssModels[model.getAttributeValue("model_id")] = model
 
@@ -181,9 +192,10 @@ class PcssProtein(object):
         """Run DSSP on each of my peptide's best model"""
         if self.hasErrors():
             return
+        if (self.hasModels()):
+            self.setPeptideBestModels()
         for nextPeptide in self.peptides.values():
             if (self.hasModels()):
-                nextPeptide.setBestModel(self.getRankedModels())
                 try:
                     #nextPeptide.setTemplate()
                     nextPeptide.processDssp()
@@ -206,9 +218,29 @@ class PcssProtein(object):
         return str(self.proteinSequence[start:end])
 
     def getRankedModels(self):
-        """Return a list of models ranked by the user-input best model criteria"""
-        return sorted (self._pcssModels.values(), 
-                       key=lambda model: model.getAttributeValue(self.pcssRunner.pcssConfig["best_model_attribute"]), reverse=True)
+        """Return a list of models ranked by the user-input best model criteria; ranked once after models are added
+
+        Models are ranked on the typed values of the attribute (numerically for numeric columns) in descending
+        order; models with equal values keep their order"""
+        if (self._rankedModels is None):
+            models = self._pcssModels.values()
+            rankValues = self._modelSequence.getRankValues(models, self.pcssRunner.pcssConfig["best_model_attribute"])
+            if (rankValues.dtype == object):
+                modelOrder = sorted(range(len(models)), key=lambda modelIndex: rankValues[modelIndex], reverse=True)
+            else:
+                modelOrder = numpy.argsort(-rankValues, kind="mergesort")
+            self._rankedModels = [models[modelIndex] for modelIndex in modelOrder]
+        return self._rankedModels
+
+    def setPeptideBestModels(self):
+        """Set each peptide's best model to the highest ranked model containing it, using an interval index over the
+        ranked models; same result as calling setBestModel(getRankedModels()) for each peptide"""
+        if (self._rankedModelIndex is None):
+            self._rankedModelIndex = pcssModels.RankedModelIndex(self.getRankedModels())
+        bestModels = self._rankedModelIndex.getBestModels(self.peptides.values())
+        for peptide in self.peptides.values():
+            if (peptide.startPosition in bestModels):
+                peptide.bestModel = bestModels[peptide.startPosition]
             
 
     def isEqual(self, otherProtein):
@@ -230,17 +262,22 @@ class PcssProtein(object):
         return True
             
 
-class PcssPeptide:
+class PcssPeptide(object):
     
-    """Class for one peptide; provides feature tracking and conversion methods"""
+    """Class for one peptide; provides feature tracking and conversion methods
+
+    Scans can create millions of peptides, so features are kept in a list indexed by the position of 
+    their attribute in the run's PcssFileAttributes rather than in a per-peptide dictionary"""
+
+    __slots__ = ('sequence', 'startPosition', 'endPosition', 'bestModel', '_features', 'pcssRunner')
 
     def __init__(self, sequence, startPosition, endPosition, pcssRunner):
         self.sequence = sequence
         self.startPosition = startPosition
         self.endPosition = endPosition
         self.bestModel = None
-        self.attributes = {}
         self.pcssRunner = pcssRunner
+        self._features = [None] * pcssRunner.pfa.getFeatureCount()
         self.addFeature(pcssFeatures.PeptideSequenceFeature(sequence))
         self.addStringAttribute("peptide_start", startPosition)
         self.addStringAttribute("peptide_end", endPosition)
@@ -261,13 +298,22 @@ class PcssPeptide:
 
     def getAttribute(self, attributeName):
         """Return the requested attribute object"""
-        if (not self.hasAttribute(attributeName)):
+        featureIndex = self.pcssRunner.pfa.findFeatureIndex(attributeName)
+        if (featureIndex is None):
             return None
-        else:
-            return self.attributes[attributeName]
+        return self._features[featureIndex]
 
     def hasAttribute(self, attributeName):
-        return attributeName in self.attributes
+        return self.getAttribute(attributeName) is not None
+
+    @property
+    def attributes(self):
+        """Dictionary of attribute names to feature objects for all features set for this peptide"""
+        attributes = {}
+        for feature in self._features:
+            if (feature is not None):
+                attributes[feature.name] = feature
+        return attributes
 
     def getAttributeNameString(self):
         return ", ".join(self.attributes.keys())
@@ -296,19 +342,26 @@ class PcssPeptide:
         self.addError(e.code)
 
     def createDsspFeatures(self):
-        """Get solvent accessibility and secondary structure as assessed by DSSP and create respective features for them"""
-        dsspAccList = []
-        dsspStructureList = []
-        for i in range(len(self.sequence)):
-            nextResidue = self.sequence[i]
-            nextPosition = self.startPosition + i
-            if (nextResidue != self.bestModel.getDsspResidueCode(nextPosition)):
-                raise pcssErrors.DsspMismatchException("Dssp residue %s does not match peptide sequence %s at position %s" %
-                                                       (self.bestModel.getDsspResidueCode(nextPosition), nextResidue, nextPosition))
-            dsspAccList.append(self.bestModel.getRelativeSolventAcc(nextPosition))
-            dsspStructureList.append(self.bestModel.getSecondaryStructure(nextPosition))
-        dsspStructureFeature = pcssFeatures.DsspStructureFeature(dsspStructureList)
-        dsspAccFeature = pcssFeatures.DsspAccFeature(dsspAccList)
+        """Get solvent accessibility and secondary structure as assessed by DSSP and create respective features for them
+
+        Features hold copies of the peptide's slice of the best model's DSSP arrays, so the model can release its
+        arrays (see pcssModels.LoadedDsspResults) while the peptide is kept"""
+        [dsspResidueCodes, dsspStructureCalls, dsspAccValues] = self.bestModel.getPeptideDsspArrays(self.startPosition, self.endPosition)
+        if (len(dsspResidueCodes) != len(self.sequence)):
+            raise pcssErrors.DsspMismatchException("Dssp results for model end before peptide %s ending at position %s" %
+                                                   (self.sequence, self.endPosition))
+        peptideResidues = numpy.frombuffer(str(self.sequence), dtype='S1')
+        mismatches = numpy.flatnonzero(dsspResidueCodes != peptideResidues)
+        if (len(mismatches) > 0):
+            i = mismatches[0]
+            raise pcssErrors.DsspMismatchException("Dssp residue %s does not match peptide sequence %s at position %s" %
+                                                   (dsspResidueCodes[i], peptideResidues[i], self.startPosition + i))
+        unmappedCalls = numpy.flatnonzero(dsspStructureCalls == '')
+        if (len(unmappedCalls) > 0):
+            raise pcssErrors.DsspException("Error: could not map call from dssp call %s" % 
+                                           self.bestModel.getSecondaryStructure(self.startPosition + unmappedCalls[0]))
+        dsspStructureFeature = pcssFeatures.DsspStructureFeature.fromMappedCalls(dsspStructureCalls)
+        dsspAccFeature = pcssFeatures.DsspAccFeature(dsspAccValues)
 
         self.addFeature(dsspStructureFeature)
         self.addFeature(dsspAccFeature)
@@ -339,45 +392,34 @@ class PcssPeptide:
 
     def setDisopredResult(self, disorderProteinCalls):
         """Use DisopredSequenceFeatureCallSet for full protein sequence to create disorder features for this peptide"""
-        disorderStringList = []
-        disorderScoreList = []
-        for i in range(self.startPosition, self.endPosition + 1):
-            try:
-                nextCall = disorderProteinCalls.getSequenceFeatureCall(i+1)
-                disorderStringList.append(nextCall.call)
-                disorderScoreList.append(nextCall.score)
-            except pcssErrors.DisopredPeptideNotFoundException, e:
-                e.setPeptide(self)
-                raise e
+        try:
+            [disorderCalls, disorderScores] = disorderProteinCalls.getPeptideCalls(self.startPosition, self.endPosition)
+        except pcssErrors.DisopredPeptideNotFoundException, e:
+            e.setPeptide(self)
+            raise e
                                 
-        disorderStringFeature = pcssFeatures.DisorderStringFeature(disorderStringList)
-        disorderScoreFeature = pcssFeatures.DisorderScoreFeature(disorderScoreList)
+        disorderStringFeature = pcssFeatures.DisorderStringFeature(disorderCalls)
+        disorderScoreFeature = pcssFeatures.DisorderScoreFeature(disorderScores)
 
         self.addFeature(disorderStringFeature)
         self.addFeature(disorderScoreFeature)
 
     def setPsipredResult(self, psipredProteinCalls):
         """Use PsipredSequenceFeatureCallSet for full protein sequence to create disorder features for this peptide"""
-        psipredStringList = []
-        psipredScoreList = []
-        for i in range(self.startPosition, self.endPosition + 1):
-            try:
-                nextCall = psipredProteinCalls.getSequenceFeatureCall(i+1)
-                psipredStringList.append(nextCall.call)
-                psipredScoreList.append(nextCall.score)
-            except pcssErrors.PsipredPeptideNotFoundException, e:
-                e.setPeptide(self)
-                raise e
+        try:
+            [psipredCalls, psipredScores] = psipredProteinCalls.getPeptideCalls(self.startPosition, self.endPosition)
+        except pcssErrors.PsipredPeptideNotFoundException, e:
+            e.setPeptide(self)
+            raise e
                                 
-        psipredStringFeature = pcssFeatures.PsipredStringFeature(psipredStringList)
-        psipredScoreFeature = pcssFeatures.PsipredScoreFeature(psipredScoreList)
+        psipredStringFeature = pcssFeatures.PsipredStringFeature(psipredCalls)
+        psipredScoreFeature = pcssFeatures.PsipredScoreFeature(psipredScores)
 
         self.addFeature(psipredStringFeature)
         self.addFeature(psipredScoreFeature)
 
     def addFeature(self, feature):
-        self.pcssRunner.pfa.validateAttribute(feature.name)
-        self.attributes[feature.name] = feature
+        self._features[self.pcssRunner.pfa.getFeatureIndex(feature.name)] = feature
 
     def setTemplate(self):
         if (not self.bestModel):
@@ -414,7 +456,6 @@ class PcssPeptide:
         svmFileStringList = []
         featureNumber = 0
         svmHandler = pcssSvm.SvmFeatureHandler()
-        self.svmHandler = svmHandler
         for featureName in self.pcssRunner.getSvmFeatureOrder():
             if (not self.hasAttribute(featureName)):
                 raise pcssErrors.PcssGlobalException("Error: peptide tried to make svm feature for %s but does not have this feature" % featureName)
@@ -49,9 +49,7 @@ class PcssTest(unittest.TestCase):
         fullExpectedFileName = self.getFullExpectedOutputFile(shortExpectedFileName)
 
         outputDir = os.path.join(self.pcssConfig["home_test_directory"], "newExpectedOutputFiles")
-        if (not os.path.exists(outputDir)):
-            os.mkdir(outputDir)
-            self.runner.sleepUntilDone(outputDir, predicate=pcssTools.pcssRunner.fileDoesNotExist)
+        self.runner.pdh.makeDirectory(outputDir)
         
         #copy observed file to temporary directory for holding new expected output files
         shutil.copy(observedFileName, os.path.join(outputDir, expectedFileName))
@@ -8,10 +8,16 @@ import myCollections
 import pcssIO
 import pcssCluster
 import tempfile
+import gzip
+import errno
 import configobj
 import copy
 import subprocess
 import time
+import threading
+import multiprocessing.pool
+import signal
+import socket
 import logging
 import pcssSvm
 import pcssErrors
@@ -21,6 +27,7 @@ import pcssModels
 import pcssFeatures
 import pcssFeatureHandlers
 import shutil
+import stat
 import traceback
 from Bio import PDB
 log = logging.getLogger("pcssTools")
@@ -71,9 +78,9 @@ class PcssRunner:
         self.pdh = self.createDirectoryHandler(pcssConfig, self.internalConfig)
         self.pdh.createOutputDirectory()
 
-        self.parser = PDB.PDBParser(QUIET=True)
         self.readFileAttributes()
         self.peptideLength = None
+        self.sequenceFeatureStore = None
         
         logging.basicConfig(filename=self.pdh.getFullOutputFile("%s.log" % self.getRunName()), level=logging.DEBUG,
                             filemode="w", format='%(asctime)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
@@ -151,9 +158,6 @@ class PcssRunner:
             raise pcssErrors.PcssGlobalException("Error: Peptide Length was never set; please make sure it is set when reading input")
         return self.peptideLength
 
-    def getBioParser(self):
-        return self.parser
-
     def getSvmFeatureOrder(self):
         featureOrderList = self.internalConfig["feature_order"]
         return featureOrderList
@@ -224,7 +228,26 @@ class PcssRunner:
         return self.pdh.getRunName()
 
     def readProteins(self):
+        peptideImporter = self.createPeptideImporter()
+        self.proteins = peptideImporter.readInputFile(self.pcssConfig['fasta_file'])
 
+    def iterateProteins(self):
+        """Return generator that reads one protein at a time from the input fasta file"""
+        peptideImporter = self.createPeptideImporter()
+        return peptideImporter.iterateProteins(self.pcssConfig['fasta_file'])
+
+    def iterateProteinGroups(self, groupSize):
+        """Return generator that reads groups of at most groupSize proteins from the input fasta file"""
+        proteinGroup = []
+        for protein in self.iterateProteins():
+            proteinGroup.append(protein)
+            if (len(proteinGroup) >= groupSize):
+                yield proteinGroup
+                proteinGroup = []
+        if (len(proteinGroup) > 0):
+            yield proteinGroup
+
+    def createPeptideImporter(self):
         peptideImporterType = self.pcssConfig["peptide_importer_type"]
         peptideImporter = None
         if (peptideImporterType == "scan"):
@@ -234,7 +257,19 @@ class PcssRunner:
             peptideImporter = pcssIO.DefinedPeptideImporter(self)
         else:
             peptideImporter = pcssIO.FullProteinImporter(self)
-        self.proteins = peptideImporter.readInputFile(self.pcssConfig['fasta_file'])
+        return peptideImporter
+
+    def isStreamingMode(self):
+        """Return True if proteins should be processed and written one group at a time instead of all at once"""
+        if ("streaming_mode" not in self.pcssConfig):
+            return False
+        return self.pcssConfig.as_bool("streaming_mode")
+
+    def getPeptideImportProcessCount(self):
+        """Return number of processes ScanPeptideImporter should use to evaluate peptide rules (1 means no process pool)"""
+        if ("peptide_import_processes" not in self.pcssConfig):
+            return 1
+        return self.pcssConfig.as_int("peptide_import_processes")
 
     def handleConfigError(self, results):
         msg = "CONFIGURATION ERROR\n"
@@ -248,25 +283,75 @@ class PcssRunner:
                 
     def addPeptideFeatures(self):
         
-        modelColumns = pcssModels.PcssModelTableColumns(self.internalConfig['model_table_column_file'])
-        modelTable = pcssModels.PcssModelTable(self, modelColumns)
-
-        disopredFileHandler = pcssFeatureHandlers.DisopredFileHandler(self.pcssConfig, self.pdh)
-        disopredReader = pcssFeatureHandlers.DisopredReader(disopredFileHandler)
-        disopredRunner = pcssFeatureHandlers.SequenceFeatureRunner(disopredFileHandler)
-        
-        psipredFileHandler = pcssFeatureHandlers.PsipredFileHandler(self.pcssConfig, self.pdh)
-        psipredReader = pcssFeatureHandlers.PsipredReader(psipredFileHandler)
-        psipredRunner = pcssFeatureHandlers.SequenceFeatureRunner(psipredFileHandler)
+        self.createFeatureHandlers()
+        self.runMissingSequenceFeatures(self.proteins)
+        self.runMissingStructureFeatures(self.proteins)
 
         for protein in self.proteins:
-            protein.processDisopred(disopredReader, disopredRunner)
-            protein.processPsipred(psipredReader, psipredRunner)
-            protein.addModels(modelTable)        
-            protein.processDssp()
+            self.addProteinFeatures(protein)
             
         #sum1 = summary.summarize(muppy.get_objects())
         #summary.print_(sum1)
+
+    def createFeatureHandlers(self):
+        """Load model table and create sequence feature readers and runners; done once per run"""
+        modelColumns = pcssModels.PcssModelTableColumns(self.internalConfig['model_table_column_file'])
+        self.modelTable = pcssModels.PcssModelTable(self, modelColumns)
+
+        disopredFileHandler = pcssFeatureHandlers.DisopredFileHandler(self.pcssConfig, self.pdh, self.getSequenceFeatureStore())
+        self.disopredReader = pcssFeatureHandlers.DisopredReader(disopredFileHandler)
+        pssmRunner = self.createPssmRunner()
+        self.disopredRunner = pcssFeatureHandlers.SequenceFeatureRunner(disopredFileHandler, pssmRunner)
+        
+        psipredFileHandler = pcssFeatureHandlers.PsipredFileHandler(self.pcssConfig, self.pdh, self.getSequenceFeatureStore())
+        self.psipredReader = pcssFeatureHandlers.PsipredReader(psipredFileHandler)
+        self.psipredRunner = pcssFeatureHandlers.SequenceFeatureRunner(psipredFileHandler, pssmRunner)
+
+        self.dsspRunner = pcssModels.DsspRunner(self)
+
+    def getSequenceFeatureStore(self):
+        """Return SequenceFeatureStore shared by this run's disopred and psipred file handlers, or None if results 
+        are kept as one file per protein (sequence_feature_store = directory)"""
+        if (self.internalConfig["sequence_feature_store"] != "sqlite"):
+            return None
+        if (self.sequenceFeatureStore is None):
+            self.sequenceFeatureStore = pcssFeatureHandlers.SequenceFeatureStore(self.internalConfig["sequence_feature_database"])
+        return self.sequenceFeatureStore
+
+    def createPssmRunner(self):
+        """Return runner for the PSI-BLAST profile shared by disopred and psipred, or None if each predictor
+        runs its own search (use_shared_pssm is off)"""
+        if (not self.internalConfig["use_shared_pssm"]):
+            return None
+        pssmFileHandler = pcssFeatureHandlers.PssmFileHandler(self.pcssConfig, self.pdh)
+        return pcssFeatureHandlers.PssmRunner(pssmFileHandler)
+
+    def runMissingSequenceFeatures(self, proteins):
+        """Run disopred and psipred for all proteins missing results before any protein reads its results, then
+        fetch the results of the whole group at once if they are in a feature store"""
+        self.disopredRunner.runMissingSequenceFeatures(proteins)
+        self.psipredRunner.runMissingSequenceFeatures(proteins)
+        self.disopredReader.prefetchResults(proteins)
+        self.psipredReader.prefetchResults(proteins)
+
+    def runMissingStructureFeatures(self, proteins):
+        """Compute DSSP for the best models of all proteins' peptides, several models at a time, before any peptide
+        reads its DSSP features; createFeatureHandlers() must be called first"""
+        self.dsspRunner.runMissingDssp(proteins)
+
+    def planMissingFeatures(self, proteins, featurePlan):
+        """Add entries for these proteins to featurePlan without running anything; createFeatureHandlers() must be called first"""
+        featurePlan.addProteins(proteins)
+
+    def addProteinFeatures(self, protein):
+        """Add all sequence and structure features to one protein; createFeatureHandlers() must be called first"""
+        protein.processDisopred(self.disopredReader, self.disopredRunner)
+        protein.processPsipred(self.psipredReader, self.psipredRunner)
+        if (not protein.hasLoadedModels()):
+            #usually already added by the DSSP stage (see runMissingStructureFeatures())
+            protein.addModels(self.modelTable)
+        protein.processDssp()
+
     def writeOutput(self):
 
         afw = pcssIO.AnnotationFileWriter(self)
@@ -290,9 +375,11 @@ class DisopredStandaloneRunner(PcssRunner):
 
     def runDisopred(self):
 
-        disopredFileHandler = pcssFeatureHandlers.DisopredFileHandler(self.pcssConfig, self.pdh)
+        disopredFileHandler = pcssFeatureHandlers.DisopredFileHandler(self.pcssConfig, self.pdh, self.getSequenceFeatureStore())
         disopredReader = pcssFeatureHandlers.DisopredReader(disopredFileHandler)
-        disopredRunner = pcssFeatureHandlers.SequenceFeatureRunner(disopredFileHandler)
+        disopredRunner = pcssFeatureHandlers.SequenceFeatureRunner(disopredFileHandler, self.createPssmRunner())
+        disopredRunner.runMissingSequenceFeatures(self.proteins)
+        disopredReader.prefetchResults(self.proteins)
 
         for protein in self.proteins:
             protein.processDisopred(disopredReader, disopredRunner)
@@ -300,6 +387,53 @@ class DisopredStandaloneRunner(PcssRunner):
 class ModelRunner(PcssRunner):
     def initSubclass(self):
         self.modelHandler = PcssModelHandler(self.pcssConfig, self.pdh)
+        self.dsspCache = None
+        self.loadedDsspResults = None
+        self.loadedDsspResultsLock = threading.Lock()
+
+    def getDsspCache(self):
+        """Return DsspResultCache shared by this run's models, or None if DSSP is run for every model (use_dssp_cache is off)"""
+        if (not self.internalConfig["use_dssp_cache"]):
+            return None
+        if (self.dsspCache is None):
+            self.dsspCache = pcssModels.DsspResultCache(self.internalConfig["model_directory"], self.pdh)
+        return self.dsspCache
+
+    def getLoadedDsspResults(self):
+        """Return LoadedDsspResults that bounds the memory used by this run's DSSP arrays, or None if they are kept
+        until the run ends (loaded_dssp_max_megabytes is 0)"""
+        maxMegabytes = self.internalConfig.as_int("loaded_dssp_max_megabytes")
+        if (maxMegabytes == 0):
+            return None
+        with self.loadedDsspResultsLock:
+            if (self.loadedDsspResults is None):
+                self.loadedDsspResults = pcssModels.LoadedDsspResults(maxMegabytes)
+        return self.loadedDsspResults
+
+    def executeStreamingPipeline(self):
+        """Read, annotate and write proteins one group at a time so peak memory does not depend on input size
+
+        Each group is released once its output lines are written"""
+        self.createFeatureHandlers()
+        afw = pcssIO.AnnotationFileWriter(self)
+        afw.writeColumnHeader()
+        proteinCount = 0
+        for proteinGroup in self.iterateProteinGroups(self.getStreamingGroupSize()):
+            self.processProteinGroup(proteinGroup)
+            for protein in proteinGroup:
+                afw.writeProteinOutputLines(protein)
+            proteinCount += len(proteinGroup)
+        afw.close()
+        log.info("Streamed %s proteins from input file" % proteinCount)
+
+    def processProteinGroup(self, proteins):
+        self.runMissingSequenceFeatures(proteins)
+        self.runMissingStructureFeatures(proteins)
+        for protein in proteins:
+            self.addProteinFeatures(protein)
+
+    def getStreamingGroupSize(self):
+        return 1
 
 class PrepareClusterRunner(PcssRunner):
     def updateInputFileConfig(self):
@@ -464,8 +598,14 @@ class PrepareSvmApplicationServerRunner(PrepareSvmApplicationClusterRunner):
 
 class SvmApplicationRunner(ModelRunner):
     def runSvm(self):
+        self.runSvmOnProteins(self.proteins)
+
+    def runSvmOnProteins(self, proteins):
         self.appSvm = pcssSvm.ApplicationSvm(self)
-        self.appSvm.setProteins(self.proteins)
+        self.appSvm.setProteins(proteins)
+        if (len(self.appSvm.peptides) == 0):
+            log.info("No peptides without errors in protein set; skipping svm classification")
+            return
         self.appSvm.writeClassificationFile()
         self.appSvm.classifySvm()
         self.appSvm.readResultFile()
@@ -494,6 +634,9 @@ class SvmApplicationInputRunner(SvmApplicationRunner):
 class SvmApplicationFeatureRunner(SvmApplicationRunner):
 
     def executePipeline(self):
+        if (self.isStreamingMode()):
+            self.executeStreamingPipeline()
+            return
 
         self.readProteins()
 
@@ -502,10 +645,24 @@ class SvmApplicationFeatureRunner(SvmApplicationRunner):
         self.runSvm()
         
         self.writeOutput()
+
+    def processProteinGroup(self, proteins):
+        """Add features to all proteins in the group and score their peptides with one svm classification call"""
+        self.runMissingSequenceFeatures(proteins)
+        self.runMissingStructureFeatures(proteins)
+        for protein in proteins:
+            self.addProteinFeatures(protein)
+        self.runSvmOnProteins(proteins)
+
+    def getStreamingGroupSize(self):
+        return int(self.internalConfig["streaming_svm_group_size"])
         
 class AnnotationRunner(ModelRunner):
 
     def executePipeline(self):
+        if (self.isStreamingMode()):
+            self.executeStreamingPipeline()
+            return
         self.readProteins()
 
         self.addPeptideFeatures()
@@ -517,6 +674,21 @@ class AnnotationRunner(ModelRunner):
         fileName = self.internalConfig["annotation_attribute_file"]
         self.pfa = pcssIO.PcssFileAttributes(fileName)
 
+class FeaturePlanRunner(AnnotationRunner):
+
+    """Dry run: report which feature computations an annotation or svm application run on the same input would need
+
+    Reads the input once, a group of proteins at a time, and writes a FeaturePlan manifest to the run directory
+    instead of computing any features"""
+
+    def executePipeline(self):
+        self.createFeatureHandlers()
+        featurePlan = FeaturePlan(self)
+        for proteinGroup in self.iterateProteinGroups(int(self.internalConfig["feature_plan_group_size"])):
+            self.planMissingFeatures(proteinGroup, featurePlan)
+        featurePlan.writeManifest(self.pdh.getFullOutputFile(self.internalConfig["feature_plan_file_name"]))
+        log.info(featurePlan.getSummary())
+
 class TrainingAnnotationRunner(AnnotationRunner):
     def readFileAttributes(self):
 
@@ -587,13 +759,148 @@ class TrainingBenchmarkRunner(PcssRunner):
         self.pfa = pcssIO.PcssFileAttributes(fileName)
     
 
+class FeaturePlanEntry:
+
+    """Feature computations one protein needs, and their estimated cost in seconds"""
+
+    def __init__(self, protein):
+        self.modbaseSeqId = protein.modbaseSequenceId
+        self.sequenceLength = protein.getSequenceLength()
+        self.peptideCount = len(protein.peptides)
+        self.psiblastSearches = 0
+        self.runDisopred = False
+        self.runPsipred = False
+        self.modelRetrievals = 0
+        self.dsspRuns = 0
+        self.estimatedSeconds = 0.0
+
+    def needsSequenceFeatures(self):
+        return self.runDisopred or self.runPsipred
+
+    def getOutputLine(self):
+        return "\t".join([self.modbaseSeqId, str(self.sequenceLength), str(self.peptideCount), str(self.psiblastSearches),
+                          str(int(self.runDisopred)), str(int(self.runPsipred)), str(self.modelRetrievals),
+                          str(self.dsspRuns), "%.1f" % self.estimatedSeconds])
+
+class FeaturePlan:
+
+    """Manifest of the feature computations a run would need for its proteins, with a rough cost estimate for each
+
+    Proteins are added a group at a time. Existing disopred, psipred and (if use_shared_pssm is set) pssm results
+    are checked with one bulk call per group, which is one query per chunk of ids with a feature store. Local model
+    files are checked against one listing of the structure directory. Best models are chosen the same way as in a
+    real run; each needs DSSP unless its results are in the DSSP cache, and then needs its file copied from the
+    modbase file server if it isn't local yet.
+    Cost is linear in sequence length for PSI-BLAST and the predictors, using the plan_* internal config values;
+    these are averages meant for sizing cluster submissions, not predictions for single proteins."""
+
+    outputColumns = ["modbase_seq_id", "sequence_length", "peptide_count", "psiblast_searches", "run_disopred",
+                     "run_psipred", "model_retrievals", "dssp_runs", "estimated_seconds"]
+
+    def __init__(self, pcssRunner):
+        self.pcssRunner = pcssRunner
+        internalConfig = pcssRunner.internalConfig
+        self.psiblastSecondsPerResidue = float(internalConfig["plan_psiblast_seconds_per_residue"])
+        self.predictorSecondsPerResidue = float(internalConfig["plan_predictor_seconds_per_residue"])
+        self.modelRetrievalSeconds = float(internalConfig["plan_model_retrieval_seconds"])
+        self.dsspSecondsPerModel = float(internalConfig["plan_dssp_seconds_per_model"])
+        self.localModelFiles = set(os.listdir(pcssRunner.pdh.getStructureDirectory()))
+        self.entries = []
+        self.errorProteinCount = 0
+
+    def addProteins(self, proteins):
+        plannedProteins = [protein for protein in proteins if not protein.hasErrors()]
+        self.errorProteinCount += len(proteins) - len(plannedProteins)
+        modbaseSeqIds = [protein.modbaseSequenceId for protein in plannedProteins]
+        existingDisopred = self.pcssRunner.disopredRunner.sfh.getExistingResultIds(modbaseSeqIds)
+        existingPsipred = self.pcssRunner.psipredRunner.sfh.getExistingResultIds(modbaseSeqIds)
+        pssmRunner = self.pcssRunner.disopredRunner.pssmRunner
+        existingPssm = set()
+        if (pssmRunner is not None):
+            existingPssm = pssmRunner.sfh.getExistingResultIds(modbaseSeqIds)
+
+        for protein in plannedProteins:
+            entry = FeaturePlanEntry(protein)
+            entry.runDisopred = protein.modbaseSequenceId not in existingDisopred
+            entry.runPsipred = protein.modbaseSequenceId not in existingPsipred
+            if (pssmRunner is None):
+                #each predictor runs its own search
+                entry.psiblastSearches = int(entry.runDisopred) + int(entry.runPsipred)
+            elif (entry.needsSequenceFeatures() and protein.modbaseSequenceId not in existingPssm):
+                entry.psiblastSearches = 1
+            self.addModelPlan(protein, entry)
+            entry.estimatedSeconds = (entry.psiblastSearches * self.psiblastSecondsPerResidue * entry.sequenceLength +
+                                      (int(entry.runDisopred) + int(entry.runPsipred)) * self.predictorSecondsPerResidue * entry.sequenceLength +
+                                      entry.modelRetrievals * self.modelRetrievalSeconds + entry.dsspRuns * self.dsspSecondsPerModel)
+            self.entries.append(entry)
+
+    def addModelPlan(self, protein, entry):
+        """Count the distinct best models of the protein's peptides that aren't in the DSSP cache; each is a DSSP run and maybe a file retrieval"""
+        protein.addModels(self.pcssRunner.modelTable)
+        if (not protein.hasModels()):
+            return
+        protein.setPeptideBestModels()
+        bestModels = {}
+        for peptide in protein.peptides.values():
+            if (peptide.bestModel):
+                bestModels[peptide.bestModel.getId()] = peptide.bestModel
+        dsspCache = self.pcssRunner.getDsspCache()
+        for model in bestModels.values():
+            if (dsspCache is not None and dsspCache.hasResults(model.getId())):
+                continue
+            entry.dsspRuns += 1
+            if (model.getPdbFileName() not in self.localModelFiles):
+                entry.modelRetrievals += 1
+
+    def getTotal(self, attributeName):
+        return sum([getattr(entry, attributeName) for entry in self.entries])
+
+    def getSummary(self):
+        sequenceFeatureProteins = len([entry for entry in self.entries if entry.needsSequenceFeatures()])
+        return ("Feature plan: %s proteins (%s skipped with errors); %s need sequence features: %s PSI-BLAST searches, "
+                "%s disopred runs, %s psipred runs; %s model retrievals; %s DSSP runs; estimated %.1f hours" %
+                (len(self.entries), self.errorProteinCount, sequenceFeatureProteins, self.getTotal("psiblastSearches"),
+                 self.getTotal("runDisopred"), self.getTotal("runPsipred"), self.getTotal("modelRetrievals"),
+                 self.getTotal("dsspRuns"), self.getTotal("estimatedSeconds") / 3600.0))
+
+    def writeManifest(self, fileName):
+        """Write one tab-separated line per protein, after the summary and column names as '#' lines"""
+        fh = open(fileName, 'w')
+        fh.write("# %s\n" % self.getSummary())
+        fh.write("# %s\n" % "\t".join(self.outputColumns))
+        for entry in self.entries:
+            fh.write("%s\n" % entry.getOutputLine())
+        fh.close()
+
 class PcssModelHandler:
 
-    """Class for managing model PDB files, retrieving them from file servers as necessary"""
+    """Class for managing model PDB files, retrieving them from file servers as necessary
+
+    By default (keep_model_files off) a model that isn't already in the structure directory is read straight from
+    its gzipped source file into a temporary file that only exists while it is being used (see runOnModelFile()),
+    so runs don't keep a copy of every model they touch. With keep_model_files set, source models are decompressed
+    into the structure directory and kept for later use.
+
+    Retrieval of one model file into the structure directory is guarded by a lock file next to it (<model
+    file>.lock) so threads and processes sharing the directory copy each model once; the others wait for the lock and
+    use the copied file. A lock older than model_fetch_lock_timeout seconds is assumed to be left by a killed process
+    and removed. Each lock holds its fetcher's host, process and thread, so a fetcher whose lock was removed as stale
+    doesn't remove the lock another fetcher has taken since. The time each retrieval takes is logged and kept in fetchLatencies as (model id, seconds).
+
+    If structure_cache_directory is set, models are decompressed once into that shared cache (see StructureCache)
+    and runs use the cached files, linking them into the structure directory when model files are kept."""
+
+    lockPollSeconds = 0.1
 
     def __init__(self, pcssConfig, pdh):
         self.pcssConfig = pcssConfig
         self.pdh = pdh
+        self.fetchLatencies = []
+        self.latencyLock = threading.Lock()
+        self.structureCache = None
+        if (self.pdh.internalConfig["structure_cache_directory"]):
+            self.structureCache = StructureCache(self.pdh.internalConfig["structure_cache_directory"],
+                                                 self.pdh.internalConfig.as_int("structure_cache_max_megabytes"), self)
         self.loadRunInfo()
 
     def loadRunInfo(self):
@@ -615,21 +922,294 @@ class PcssModelHandler:
             self.retrieveModelFile(pcssModel)
         return fullModelFileName
 
+    def keepModelFiles(self):
+        return self.pdh.internalConfig["keep_model_files"]
+
+    def runOnModelFile(self, pcssModel, modelFunction):
+        """Return modelFunction(model file name) for pcssModel's PDB file
+
+        Uses the model file in the structure directory if it is there or model files are kept (retrieving it if
+        needed); otherwise the gzipped source file is decompressed to a temporary directory that is removed as soon
+        as modelFunction returns. With a structure cache, the cached file is used instead of a temporary one"""
+        if (self.keepModelFiles() or os.path.exists(self.pdh.getFullModelFile(pcssModel))):
+            return modelFunction(self.getLocalModelFileName(pcssModel))
+        if (self.structureCache is not None):
+            return self.structureCache.runOnModelFile(pcssModel, modelFunction)
+        fullSourceModelFileZip = self.getSourceModelZipFile(pcssModel)
+        tempDirectory = PcssTempDirectory(changeDirectory=False)
+        try:
+            tempModelFile = os.path.join(tempDirectory.tempDir, pcssModel.getPdbFileName())
+            startTime = time.time()
+            self.pdh.decompressFile(fullSourceModelFileZip, tempModelFile)
+            self.recordFetchLatency(pcssModel, tempModelFile, time.time() - startTime)
+            return modelFunction(tempModelFile)
+        finally:
+            tempDirectory.changeBack()
+
+    def getPrefetchWorkerCount(self):
+        return self.pdh.internalConfig.as_int("model_prefetch_worker_count")
+
+    def prefetchModelFiles(self, pcssModels):
+        """Retrieve files for all models that aren't local yet in a thread pool of size model_prefetch_worker_count
+
+        Called once best models are chosen for a group of proteins, so file server latency overlaps across models
+        instead of adding to each DSSP run. A model whose file can't be retrieved is only logged here; the error is
+        raised for its peptides when DSSP asks for the file. Does nothing unless model files are kept, since
+        otherwise each model is read from its source when it is used."""
+        if (not self.keepModelFiles()):
+            return
+        missingModels = [pcssModel for pcssModel in pcssModels if not os.path.exists(self.pdh.getFullModelFile(pcssModel))]
+        if (len(missingModels) == 0):
+            return
+        workerCount = min(self.getPrefetchWorkerCount(), len(missingModels))
+        log.info("Prefetching %s model files with %s workers" % (len(missingModels), workerCount))
+        previousFetchCount = len(self.fetchLatencies)
+        pool = multiprocessing.pool.ThreadPool(workerCount)
+        try:
+            pool.map(self.prefetchModelFile, missingModels)
+        finally:
+            pool.close()
+            pool.join()
+        log.info(self.getFetchSummary(self.fetchLatencies[previousFetchCount:]))
+        self.logStructureCacheCounts()
+
+    def logStructureCacheCounts(self):
+        if (self.structureCache is not None):
+            log.info(self.structureCache.getCountSummary())
+
+    def prefetchModelFile(self, pcssModel):
+        try:
+            self.getLocalModelFileName(pcssModel)
+        except pcssErrors.StructureException, e:
+            log.info("Could not prefetch file for model %s: %s" % (pcssModel.getId(), e.msg))
+
+    def getFetchSummary(self, fetchLatencies):
+        if (len(fetchLatencies) == 0):
+            return "Fetched no model files"
+        latencies = [latency for (modelId, latency) in fetchLatencies]
+        [slowestModelId, slowestLatency] = max(fetchLatencies, key=lambda fetchLatency: fetchLatency[1])
+        return ("Fetched %s model files; %.3f seconds total, %.3f mean, %.3f max (model %s)" % 
+                (len(latencies), sum(latencies), sum(latencies) / len(latencies), slowestLatency, slowestModelId))
+
     def retrieveModelFile(self, pcssModel):
-        """Copy model file from modbase file server to local pcss directory"""
+        """Put model file into the structure directory: linked from the structure cache if there is one, otherwise
+        decompressed from the modbase file server"""
+        fullModelFileName = self.pdh.getFullModelFile(pcssModel)
+        if (self.structureCache is not None):
+            self.structureCache.linkModelFile(pcssModel, fullModelFileName)
+        else:
+            self.fetchModelFile(pcssModel, fullModelFileName)
+
+    def fetchModelFile(self, pcssModel, modelFileName):
+        """Decompress pcssModel's file from modbase file server to modelFileName, unless another thread or process
+        does it while this one waits for the lock; return True if this call wrote the file"""
+        lockFile = "%s.lock" % modelFileName
+        lockToken = self.acquireFetchLock(lockFile, modelFileName)
+        if (lockToken is None):
+            return False
+        try:
+            if (os.path.exists(modelFileName)):
+                return False
+            startTime = time.time()
+            self.pdh.decompressFile(self.getSourceModelZipFile(pcssModel), modelFileName)
+            self.recordFetchLatency(pcssModel, modelFileName, time.time() - startTime)
+            return True
+        finally:
+            self.releaseFetchLock(lockFile, lockToken)
+
+    def recordFetchLatency(self, pcssModel, modelFileName, latency):
+        log.info("Fetched model file %s in %.3f seconds" % (modelFileName, latency))
+        with self.latencyLock:
+            self.fetchLatencies.append((pcssModel.getId(), latency))
+
+    def getFetchLockToken(self):
+        """Return string identifying this fetcher (host, process and thread), written into the locks it holds"""
+        return "%s %s %s" % (socket.gethostname(), os.getpid(), threading.current_thread().ident)
+
+    def acquireFetchLock(self, lockFile, modelFileName):
+        """Create lockFile holding this fetcher's token; return the token once the lock is ours, or None if
+        modelFileName appears while another fetcher holds the lock"""
+        lockTimeout = self.pdh.internalConfig.as_int("model_fetch_lock_timeout")
+        lockToken = self.getFetchLockToken()
+        while (True):
+            try:
+                lockFd = os.open(lockFile, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0664)
+                try:
+                    os.write(lockFd, lockToken)
+                finally:
+                    os.close(lockFd)
+                return lockToken
+            except OSError, e:
+                if (e.errno != errno.EEXIST):
+                    raise pcssErrors.PcssGlobalException("Could not create model fetch lock %s: %s" % (lockFile, e))
+            if (os.path.exists(modelFileName)):
+                return None
+            try:
+                if (time.time() - os.path.getmtime(lockFile) > lockTimeout):
+                    log.warning("Removing model fetch lock %s older than %s seconds" % (lockFile, lockTimeout))
+                    os.remove(lockFile)
+                    continue
+            except OSError:
+                #other fetcher removed the lock; try again
+                continue
+            time.sleep(self.lockPollSeconds)
+
+    def releaseFetchLock(self, lockFile, lockToken):
+        """Remove lockFile if it still holds lockToken; if a waiter removed it as stale it may be gone or belong to
+        another fetcher by now, and is left alone"""
+        try:
+            lockFh = open(lockFile, 'r')
+            try:
+                currentToken = lockFh.read()
+            finally:
+                lockFh.close()
+            if (currentToken == lockToken):
+                os.remove(lockFile)
+            else:
+                log.warning("Model fetch lock %s was taken over by another fetcher (%s); leaving it" % (lockFile, currentToken))
+        except (IOError, OSError), e:
+            if (e.errno != errno.ENOENT):
+                raise pcssErrors.PcssGlobalException("Could not remove model fetch lock %s: %s" % (lockFile, e))
+            log.warning("Model fetch lock %s was removed by another fetcher" % lockFile)
+
+    def getSourceModelZipFile(self, pcssModel):
+        """Return full path of the gzipped model file on the modbase file server; raise NoSourceModelException if it isn't there"""
         modelRunInfo = self._runInfo[pcssModel.getRunName()]
         sourcePath = modelRunInfo.getSourcePath(pcssModel)
-        sourceModelFileZip = self.makeSourceModelZipFileName(pcssModel)
-        fullSourceModelFileZip = os.path.join(sourcePath, sourceModelFileZip)
+        fullSourceModelFileZip = os.path.join(sourcePath, self.makeSourceModelZipFileName(pcssModel))
         if (not(os.path.exists(fullSourceModelFileZip))):
             raise pcssErrors.NoSourceModelException("Did not find model file in source directory (searched for %s" % fullSourceModelFileZip)
-
-        self.pdh.copyFile(sourcePath, sourceModelFileZip, self.pdh.getStructureDirectory())
-        self.pdh.unzipFile(os.path.join(self.pdh.getStructureDirectory(), sourceModelFileZip))
+        return fullSourceModelFileZip
 
     def makeSourceModelZipFileName(self, model):
         return "%s.pdb.gz" % model.getId()
 
+class StructureCache:
+
+    """Model PDB files shared by all runs on a node (or file system), one file per model ID
+
+    Models are stored as <structure_cache_directory>/<first two letters of model id>/<model id>.pdb; a ModBase
+    model file never changes, so the model ID is enough to name its contents. A missing model is decompressed from
+    its source file by PcssModelHandler.fetchModelFile(), so concurrent runs insert each model once and readers
+    never see a partial file. Using a cached file updates its modification time, and once the files in the cache
+    take more than structure_cache_max_megabytes the least recently used ones are removed until the cache is back
+    under evictionFraction of that budget. Since another run can evict a file at any time, runs never use cached
+    files in place: they hard link them (see PcssDirectoryHandler.linkFile()) into the structure directory when
+    model files are kept, or otherwise into a private temporary directory inside the cache (skipped by eviction)
+    for as long as the file is used. Hits and misses are counted for the run log."""
+
+    evictionFraction = 0.9
+    linkAttempts = 3
+
+    def __init__(self, cacheDirectory, maxMegabytes, modelHandler):
+        self.cacheDirectory = cacheDirectory
+        self.maxBytes = maxMegabytes * 1024 * 1024
+        self.modelHandler = modelHandler
+        self.pdh = modelHandler.pdh
+        self.hitCount = 0
+        self.missCount = 0
+        self.evictionCount = 0
+        self.cacheBytes = None
+        self.cacheLock = threading.Lock()
+
+    def getCacheFile(self, modelId):
+        return os.path.join(self.cacheDirectory, modelId[0:2], "%s.pdb" % modelId)
+
+    def getModelFile(self, pcssModel):
+        """Return name of pcssModel's file in the cache, inserting it first if it isn't there"""
+        cacheFile = self.getCacheFile(pcssModel.getId())
+        if (os.path.exists(cacheFile)):
+            self.touchFile(cacheFile)
+            with self.cacheLock:
+                self.hitCount += 1
+            return cacheFile
+        with self.cacheLock:
+            self.missCount += 1
+        self.pdh.makeDirectory(os.path.dirname(cacheFile))
+        if (self.modelHandler.fetchModelFile(pcssModel, cacheFile)):
+            self.addFileSize(os.path.getsize(cacheFile))
+        return cacheFile
+
+    def linkModelFile(self, pcssModel, destinationFile):
+        """Hard link pcssModel's cached file to destinationFile, inserting it again if another run evicts it first"""
+        for attempt in range(self.linkAttempts):
+            try:
+                self.pdh.linkFile(self.getModelFile(pcssModel), destinationFile)
+                return
+            except pcssErrors.PcssShutilError, e:
+                if (e.ioError.errno != errno.ENOENT or attempt == self.linkAttempts - 1):
+                    raise
+
+    def runOnModelFile(self, pcssModel, modelFunction):
+        """Return modelFunction(model file name) for a private link to pcssModel's cached file, removed afterwards"""
+        self.pdh.makeDirectory(self.cacheDirectory)
+        tempDirectory = PcssTempDirectory(changeDirectory=False, parentDirectory=self.cacheDirectory, prefix=".run")
+        try:
+            tempModelFile = os.path.join(tempDirectory.tempDir, pcssModel.getPdbFileName())
+            self.linkModelFile(pcssModel, tempModelFile)
+            return modelFunction(tempModelFile)
+        finally:
+            tempDirectory.changeBack()
+
+    def touchFile(self, cacheFile):
+        """Mark cacheFile as recently used; the cache may be shared read-only, in which case the time isn't changed"""
+        try:
+            os.utime(cacheFile, None)
+        except OSError, e:
+            log.debug("Could not update access time of cached model file %s: %s" % (cacheFile, e))
+
+    def addFileSize(self, fileSize):
+        with self.cacheLock:
+            if (self.cacheBytes is None):
+                self.cacheBytes = sum([fileSize for (modificationTime, fileSize, cacheFile) in self.getCacheFiles()])
+            else:
+                self.cacheBytes += fileSize
+            if (self.cacheBytes > self.maxBytes):
+                self.evictFiles()
+
+    def getCacheFiles(self):
+        """Return list of (modification time, size, file name) for all model files in the cache"""
+        cacheFiles = []
+        for (directoryName, subdirectoryNames, fileNames) in os.walk(self.cacheDirectory):
+            #private links of files in use (see runOnModelFile())
+            subdirectoryNames[:] = [subdirectoryName for subdirectoryName in subdirectoryNames if not subdirectoryName.startswith(".")]
+            for fileName in fileNames:
+                if (not fileName.endswith(".pdb")):
+                    continue
+                cacheFile = os.path.join(directoryName, fileName)
+                try:
+                    fileStat = os.stat(cacheFile)
+                except OSError:
+                    #evicted by another run
+                    continue
+                cacheFiles.append((fileStat.st_mtime, fileStat.st_size, cacheFile))
+        return cacheFiles
+
+    def evictFiles(self):
+        """Remove least recently used files until the cache is under its eviction target; caller holds cacheLock
+
+        Sizes are recounted from the directory first since other runs add and remove files too"""
+        cacheFiles = sorted(self.getCacheFiles())
+        self.cacheBytes = sum([fileSize for (modificationTime, fileSize, cacheFile) in cacheFiles])
+        targetBytes = self.maxBytes * self.evictionFraction
+        for (modificationTime, fileSize, cacheFile) in cacheFiles:
+            if (self.cacheBytes <= targetBytes):
+                break
+            try:
+                os.remove(cacheFile)
+                self.evictionCount += 1
+            except OSError, e:
+                if (e.errno != errno.ENOENT):
+                    log.warning("Could not evict cached model file %s: %s" % (cacheFile, e))
+                    continue
+            self.cacheBytes -= fileSize
+        log.info("Evicted model files from structure cache %s; %s bytes remain" % (self.cacheDirectory, self.cacheBytes))
+
+    def getCountSummary(self):
+        with self.cacheLock:
+            return ("Structure cache %s: %s hits, %s misses, %s evictions" %
+                    (self.cacheDirectory, self.hitCount, self.missCount, self.evictionCount))
+
 class PcssModelRunInfo:
 
     """Simple class tracking data specific to modpipe runs; for example, each run has its own directory where models are written"""
@@ -679,17 +1259,24 @@ class OldModelStyle(ModelStyle):
                             
 class PcssTempDirectory:
 
-    """Class for managing creation of temporary directories and changing back and forth"""
+    """Class for managing creation of temporary directories and changing back and forth
+
+    The working directory belongs to the whole process, so callers that may run in several threads at once should
+    pass changeDirectory=False and use tempDir explicitly (e.g. as the cwd of a subprocess)"""
 
-    def __init__(self):
-        """Create temporary directory and change into it"""
+    def __init__(self, changeDirectory=True, parentDirectory=None, prefix="tmp"):
+        """Create temporary directory (in parentDirectory if given, otherwise the system default) and change into it
+        unless changeDirectory is False"""
         self.currentDir = os.getcwd()
-        self.tempDir = tempfile.mkdtemp()
-        os.chdir(self.tempDir)
+        self.tempDir = tempfile.mkdtemp(dir=parentDirectory, prefix=prefix)
+        self.changeDirectory = changeDirectory
+        if (changeDirectory):
+            os.chdir(self.tempDir)
 
     def changeBack(self, removeTemp=True):
         """Change back to original directory; remove temporary by default"""
-        os.chdir(self.currentDir)
+        if (self.changeDirectory):
+            os.chdir(self.currentDir)
         if removeTemp:
             shutil.rmtree(self.tempDir)
 
@@ -698,12 +1285,15 @@ class PcssDirectoryHandler:
 
     """Class for all of the directory creation and processing that occurs over the course of a PCSS run"""
     
+    copyBufferSize = 1024 * 1024
+    linkNameAttempts = 100
+
     def __init__(self, pcssConfig, internalConfig):
         self.pcssConfig = pcssConfig
         self.internalConfig = internalConfig
 
-    def makeTempDirectory(self):
-        ptd = PcssTempDirectory()
+    def makeTempDirectory(self, changeDirectory=True):
+        ptd = PcssTempDirectory(changeDirectory)
         return ptd
 
 
@@ -732,7 +1322,8 @@ class PcssDirectoryHandler:
     def getStructureDirectory(self):
         """Return full path of directory where models are stored and copied to"""
         if (not os.path.exists(self.getFullOutputFile("structures"))):
-            os.mkdir(self.getFullOutputFile("structures"))
+            #DSSP workers may get here at the same time
+            self.makeDirectory(self.getFullOutputFile("structures"))
         return self.getFullOutputFile("structures")
 
     def getFullOutputFile(self, fileName):
@@ -758,70 +1349,180 @@ class PcssDirectoryHandler:
         threeLetter = modbaseSequence[0:3]
         return os.path.join(threeLetter, modbaseSequence)
 
-    def tryShutil(self, function, *args):
-        """Run a python shutil module command"""
-        try:
-            function(*args)
-        except IOError, e:
-            raise pcssErrors.PcssShutilError(e, function, args)
-
     def copyFile(self, sourceDir, sourceFile, destinationDir):
-        """Copy source file from sourceDir to destinationDir; don't return until copy is done"""
-        
-        self.tryShutil(shutil.copy, os.path.join(sourceDir, sourceFile), destinationDir)
-        destinationFile = os.path.join(destinationDir, sourceFile)
+        """Copy source file from sourceDir to destinationDir
 
-        #possible error: if file is large, conceivably this could return before copy is done
-        self.sleepUntilDone(destinationFile, predicate=self.fileDoesNotExist)
+        The copy is written to a temporary name next to the destination and renamed into place, so the file
+        appears all at once and is complete as soon as this returns"""
+        destinationFile = os.path.join(destinationDir, sourceFile)
+        self.tryFileOperation(self.publishCopy, shutil.copy, os.path.join(sourceDir, sourceFile), destinationFile)
 
     def moveFile(self, sourceDir, sourceFile, destinationDir):
-        """Move source file from sourceDir to destinationDir; don't return until move is done"""
-        self.tryShutil(shutil.move, os.path.join(sourceDir, sourceFile), destinationDir)
+        """Move source file from sourceDir to destinationDir
+
+        Done with a rename when both are on the same file system; otherwise the file is copied next to the
+        destination, renamed into place and then removed from sourceDir. A directory on another file system is
+        moved with shutil.move"""
+        sourcePath = os.path.join(sourceDir, sourceFile)
         destinationFile = os.path.join(destinationDir, sourceFile)
-        self.sleepUntilDone(destinationFile, predicate=self.fileDoesNotExist)
+        try:
+            os.rename(sourcePath, destinationFile)
+        except OSError, e:
+            if (e.errno != errno.EXDEV):
+                raise pcssErrors.PcssShutilError(e, shutil.move, (sourcePath, destinationDir))
+            if (os.path.isdir(sourcePath)):
+                self.tryFileOperation(shutil.move, shutil.move, sourcePath, destinationFile)
+                return
+            self.tryFileOperation(self.publishCopy, shutil.move, sourcePath, destinationFile)
+            self.tryFileOperation(os.remove, shutil.move, sourcePath)
+
+    def linkFile(self, sourcePath, destinationFile):
+        """Make destinationFile a hard link to sourcePath, so it stays usable if sourcePath is later removed
+
+        Done by linking a temporary name next to the destination and renaming it into place; if sourcePath is on
+        another file system (or the file system has no hard links) the file is copied with publishCopy() instead,
+        which also writes a temporary file and renames it into place"""
+        tempFile = self.linkTempFile(sourcePath, destinationFile)
+        if (tempFile is None):
+            self.tryFileOperation(self.publishCopy, shutil.copy, sourcePath, destinationFile)
+            return
+        try:
+            os.rename(tempFile, destinationFile)
+        except OSError, e:
+            os.remove(tempFile)
+            raise pcssErrors.PcssShutilError(e, os.link, (sourcePath, destinationFile))
+
+    def linkTempFile(self, sourcePath, destinationFile):
+        """Hard link sourcePath to a new temporary name next to destinationFile and return that name; return None if
+        sourcePath can't be hard linked there
+
+        The name is only taken by os.link itself, which fails if it exists, so a name another process made in the
+        meantime is never used; a new one is tried instead"""
+        tempPrefix = os.path.join(os.path.dirname(destinationFile), ".%s." % os.path.basename(destinationFile))
+        for attempt in range(self.linkNameAttempts):
+            tempFile = tempPrefix + os.urandom(6).encode("hex")
+            try:
+                os.link(sourcePath, tempFile)
+                return tempFile
+            except OSError, e:
+                if (e.errno in (errno.EXDEV, errno.EPERM, errno.EMLINK)):
+                    return None
+                if (e.errno != errno.EEXIST or attempt == self.linkNameAttempts - 1):
+                    raise pcssErrors.PcssShutilError(e, os.link, (sourcePath, destinationFile))
+
+    def tryFileOperation(self, function, reportedFunction, *args):
+        """Run file operation function, raising PcssShutilError (naming reportedFunction) if it fails"""
+        try:
+            function(*args)
+        except (IOError, OSError), e:
+            raise pcssErrors.PcssShutilError(e, reportedFunction, args)
 
-    def runSubprocess(self, args, checkStdError=True):
-        """Run python subprocess module command; by default, raise exception if anything was written to stderr"""
-        process = subprocess.Popen(args, shell=False, stderr=subprocess.PIPE)
-        processOutput = process.communicate()
+    def publishCopy(self, sourcePath, destinationFile):
+        """Copy sourcePath to a temporary file in the destination directory, then rename it to destinationFile.
+        The copy gets sourcePath's permissions"""
+        sourceMode = stat.S_IMODE(os.stat(sourcePath).st_mode)
+        self.publishFile(destinationFile, lambda outputFh: self.copyFileContents(sourcePath, outputFh), sourceMode)
+
+    def copyFileContents(self, sourcePath, outputFh):
+        inputFh = open(sourcePath, 'rb')
+        try:
+            shutil.copyfileobj(inputFh, outputFh, self.copyBufferSize)
+        finally:
+            inputFh.close()
+
+    def publishFile(self, destinationFile, writeFunction, mode=0664):
+        """Write destinationFile atomically: writeFunction(fileHandle) writes the contents into a temporary file in
+        the same directory, which is then renamed to destinationFile with permissions mode. Readers either see the
+        whole file or none"""
+        destinationDir = os.path.dirname(destinationFile)
+        [tempFd, tempFile] = tempfile.mkstemp(dir=destinationDir, prefix=".%s." % os.path.basename(destinationFile))
+        try:
+            outputFh = os.fdopen(tempFd, 'wb')
+            try:
+                writeFunction(outputFh)
+            finally:
+                outputFh.close()
+            os.chmod(tempFile, mode)
+            os.rename(tempFile, destinationFile)
+        except:
+            if (os.path.exists(tempFile)):
+                os.remove(tempFile)
+            raise
+
+    def makeDirectory(self, directoryName):
+        """Make directoryName and any missing parents; fine if it already exists (e.g. made by another process)"""
+        try:
+            os.makedirs(directoryName)
+        except OSError, e:
+            if (e.errno != errno.EEXIST or not os.path.isdir(directoryName)):
+                raise pcssErrors.PcssGlobalException("Could not make directory %s: %s" % (directoryName, e))
+
+    def runSubprocess(self, args, checkStdError=True, cwd=None, timeout=None):
+        """Run python subprocess module command; by default, raise exception if anything was written to stderr
+
+        @param cwd: working directory for the command; defaults to the current directory
+        @param timeout: if set, kill the command and raise exception if it hasn't finished after this many seconds"""
+        if (timeout is None):
+            process = subprocess.Popen(args, shell=False, stderr=subprocess.PIPE, cwd=cwd)
+            processOutput = process.communicate()
+        else:
+            #own process group so the whole script, including anything it started, can be killed on timeout
+            process = subprocess.Popen(args, shell=False, stderr=subprocess.PIPE, cwd=cwd, preexec_fn=os.setsid)
+            timedOut = threading.Event()
+            timer = threading.Timer(timeout, self.killSubprocess, [process, timedOut])
+            timer.start()
+            try:
+                processOutput = process.communicate()
+            finally:
+                timer.cancel()
+            if (timedOut.is_set()):
+                raise pcssErrors.PcssGlobalException("Subprocess timed out after %s seconds.\nRan method args %s" % (timeout, args))
         if (processOutput[1] != "" and checkStdError):
             raise pcssErrors.PcssGlobalException("Got subprocess error.\nRan method args %s\nGot stderr %s" % (args, processOutput[1])) 
         return processOutput
 
+    def killSubprocess(self, process, timedOut):
+        """Kill process that ran past its timeout; called from a timer thread"""
+        timedOut.set()
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            #process finished on its own just before the timer fired
+            pass
+
     def unzipFile(self, sourceFile):
-        """Unzip sourceFile; expects .gz suffix"""
+        """Unzip sourceFile; expects .gz suffix. Like gunzip, the .gz file is removed afterwards"""
         if (not sourceFile.endswith(".gz")):
             #might end up having to change this later to include other filetypes, but this could wreak havoc
             #if result file isn't properly formatted
-            raise pcssErrors.PcssGlobalException("Attempted to unzip file %s that does not end with '.gz'")
-        resultFile = sourceFile.rstrip(".gz")
+            raise pcssErrors.PcssGlobalException("Attempted to unzip file %s that does not end with '.gz'" % sourceFile)
+        resultFile = sourceFile[:-len(".gz")]
         if (not os.path.exists(resultFile)): 
-            #should never already exist since we wouldn't be here if it did, but another process could possibly have put it here
-            #there is still somewhat of a race condition though as this check could return false and another process could put 
-            #the unzipped file in immdediately after, but chances are extremely low
-            self.runSubprocess(['gunzip', sourceFile])
+            #should never already exist since we wouldn't be here if it did, but another process could possibly have put it here.
+            #the unzipped file is published with a rename, so if two processes do this at once, both write complete files
+            #and the last rename wins
+            try:
+                self.publishFile(resultFile, lambda outputFh: self.unzipFileContents(sourceFile, outputFh))
+            except (IOError, OSError), e:
+                raise pcssErrors.PcssGlobalException("Could not unzip file %s: %s" % (sourceFile, e))
+        if (os.path.exists(sourceFile)):
+            os.remove(sourceFile)
+
+    def decompressFile(self, sourceFile, destinationFile):
+        """Write the decompressed contents of gzipped sourceFile to destinationFile in one pass, without copying
+        sourceFile first; sourceFile is left in place"""
+        try:
+            self.publishFile(destinationFile, lambda outputFh: self.unzipFileContents(sourceFile, outputFh))
+        except (IOError, OSError), e:
+            raise pcssErrors.PcssGlobalException("Could not decompress file %s to %s: %s" % (sourceFile, destinationFile, e))
 
-            self.sleepUntilDone(resultFile, predicate=self.fileDoesNotExist)
+    def unzipFileContents(self, sourceFile, outputFh):
+        inputFh = gzip.open(sourceFile, 'rb')
+        try:
+            shutil.copyfileobj(inputFh, outputFh, self.copyBufferSize)
+        finally:
+            inputFh.close()
 
-    def fileDoesNotExist(self, fileName):
-        """Simple predicate that returns true if fileName doesn't exist in file system"""
-        
-        return not os.path.exists(fileName)
-
-    def fileExists(self, fileName):
-        """Simple predicate that returns true if fileName exists in file system"""
-        return os.path.exists(fileName)
-
-    def sleepUntilDone(self, fileName, predicate):
-        """Sleep until predicate involving fileName is true; useful for avoiding race conditions in file manipulation"""
-        sleepTime = 0
-        while (predicate(fileName)):
-            print "sleep 1 second"
-            time.sleep(1)
-            sleepTime += 1
-            if (sleepTime > 10):
-                raise pcssErrors.PcssGlobalException("Timeout on file %s" % fileName)
-     
     def getSvmApplicationSetFile(self):
         return self.getFullOutputFile(self.internalConfig["application_set_file_name"])
 
@@ -1128,8 +1829,7 @@ class PcssFileReader:
 class FastaGrabber:
 
     def readSourceFastaFile(self):
-        fh = open(self.sourceFastaFile, 'r')
-        self.fastaIterator = SeqIO.FastaIO.FastaIterator(fh)
+        self.indexedFasta = pcssIO.IndexedFastaFile(self.sourceFastaFile)
 
     def getSeqList(self, sequence, size):
         if (size == 0):
@@ -1144,11 +1844,13 @@ class TwoLetterFastaGrabber(FastaGrabber):
         self.readSourceFastaFile()
         outputFh = open(outputFileName, 'w')
         seqCount = 0
-        for seqRecord in self.fastaIterator:
-            if (seqRecord.id.startswith(twoLetterCode)):
+        for entryIndex in range(self.indexedFasta.getRecordCount()):
+            recordId = self.indexedFasta.getRecordIdForEntry(entryIndex)
+            if (recordId.startswith(twoLetterCode)):
                 seqCount += 1
-                outputFh.write(">%s\n" % seqRecord.id)
-                seqList = self.getSeqList(str(seqRecord.seq), size)
+                outputFh.write(">%s\n" % recordId)
+                seqList = self.getSeqList(self.indexedFasta.getSequenceForEntry(entryIndex), size)
                 outputFh.write("%s\n" % '\n'.join(seqList))
         outputFh.close()
+        self.indexedFasta.close()
         print "wrote %s sequences with code %s to output file %s" % (seqCount, twoLetterCode, outputFileName)
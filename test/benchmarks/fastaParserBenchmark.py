@@ -0,0 +1,71 @@
+"""Compare pcssIO.FastaReader with Bio.SeqIO on a synthetic proteome.
+
+Run from the test directory:
+    PYTHONPATH=../lib python benchmarks/fastaParserBenchmark.py [proteinCount] [proteinLength]
+
+Writes a random proteome fasta (sequence lines wrapped at 60 residues) to a temporary directory, parses it
+with both readers, checks they return the same ids and sequences and reports the best of three timings
+for each. The Biopython path includes the str() and id access the importers used to do on every record."""
+
+import sys
+import os
+import random
+import tempfile
+import shutil
+import time
+from Bio import SeqIO
+import pcssIO
+
+residues = "ACDEFGHIKLMNPQRSTVWY"
+
+def writeProteome(fileName, proteinCount, proteinLength):
+    rng = random.Random(12345)
+    fh = open(fileName, 'w')
+    for i in range(proteinCount):
+        modbaseId = "%032x" % rng.getrandbits(128)
+        fh.write(">%s|P%05d\n" % (modbaseId, i))
+        sequence = "".join(rng.choice(residues) for j in range(rng.randint(proteinLength / 2, proteinLength * 2)))
+        fh.write("%s\n" % "\n".join(sequence[j:j+60] for j in range(0, len(sequence), 60)))
+    fh.close()
+
+def readBiopython(fastaFile):
+    fh = open(fastaFile, 'r')
+    records = [(seqRecord.id, str(seqRecord.seq)) for seqRecord in SeqIO.FastaIO.FastaIterator(fh)]
+    fh.close()
+    return records
+
+def readFastaReader(fastaFile):
+    return list(pcssIO.FastaReader(fastaFile))
+
+def timeReader(readFunction, fastaFile):
+    bestTime = None
+    for i in range(3):
+        startTime = time.time()
+        records = readFunction(fastaFile)
+        elapsed = time.time() - startTime
+        if (bestTime is None or elapsed < bestTime):
+            bestTime = elapsed
+    return [bestTime, records]
+
+def main():
+    proteinCount = 20000
+    proteinLength = 400
+    if (len(sys.argv) > 1):
+        proteinCount = int(sys.argv[1])
+    if (len(sys.argv) > 2):
+        proteinLength = int(sys.argv[2])
+    tempDir = tempfile.mkdtemp()
+    try:
+        fastaFile = os.path.join(tempDir, "proteome.fasta")
+        writeProteome(fastaFile, proteinCount, proteinLength)
+        [bioTime, bioRecords] = timeReader(readBiopython, fastaFile)
+        [readerTime, readerRecords] = timeReader(readFastaReader, fastaFile)
+        if (bioRecords != readerRecords):
+            print "ERROR: FastaReader records differ from Bio.SeqIO records"
+        print "proteins: %s file bytes: %s" % (proteinCount, os.path.getsize(fastaFile))
+        print "Bio.SeqIO: %.3f s  FastaReader: %.3f s  speedup: %.1fx" % (bioTime, readerTime, bioTime / readerTime)
+    finally:
+        shutil.rmtree(tempDir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""Compare model retrieval with the old shell-out file operations against PcssDirectoryHandler's in-process ones.
+
+Run from the test directory:
+    PYTHONPATH=../lib python benchmarks/modelRetrievalBenchmark.py [modelCount] [atomCount]
+
+Writes modelCount gzipped synthetic pdb files to a source directory standing in for the modbase file server,
+then retrieves every one of them into a structure directory the way ModelFileRetriever does (make the result
+directory, copy the .gz, unzip it), once with the old operations (`mkdir -p` and `gunzip` subprocesses,
+shutil.copy, sleepUntilDone checks after every step) and once with the current PcssDirectoryHandler methods.
+Reports the total and per-model time of each and checks both produce the same files."""
+
+import sys
+import os
+import gzip
+import tempfile
+import shutil
+import subprocess
+import time
+import pcssTools
+
+def writeSourceModels(sourceDir, modelCount, atomCount):
+    modelFiles = []
+    for i in range(modelCount):
+        modelFile = "model%05d.pdb.gz" % i
+        fh = gzip.open(os.path.join(sourceDir, modelFile), 'wb')
+        for j in range(atomCount):
+            fh.write("ATOM  %5d  CA  ALA A%4d    %8.3f%8.3f%8.3f  1.00  0.00           C\n" % (j, j / 4, i * 0.1, j * 0.2, j * 0.3))
+        fh.close()
+        modelFiles.append(modelFile)
+    return modelFiles
+
+def fileDoesNotExist(fileName):
+    return not os.path.exists(fileName)
+
+def sleepUntilDone(fileName, predicate):
+    sleepTime = 0
+    while (predicate(fileName)):
+        time.sleep(1)
+        sleepTime += 1
+        if (sleepTime > 10):
+            raise Exception("Timeout on file %s" % fileName)
+
+def runCommand(args):
+    process = subprocess.Popen(args, shell=False, stderr=subprocess.PIPE)
+    output = process.communicate()
+    if (output[1] != ""):
+        raise Exception("Got subprocess error running %s: %s" % (args, output[1]))
+
+def retrieveShellOut(sourceDir, modelFile, structureDir):
+    runCommand(["mkdir", "-p", structureDir])
+    sleepUntilDone(structureDir, fileDoesNotExist)
+    shutil.copy(os.path.join(sourceDir, modelFile), structureDir)
+    sleepUntilDone(os.path.join(structureDir, modelFile), fileDoesNotExist)
+    runCommand(["gunzip", os.path.join(structureDir, modelFile)])
+    sleepUntilDone(os.path.join(structureDir, modelFile[:-3]), fileDoesNotExist)
+
+def retrieveInProcess(pdh, sourceDir, modelFile, structureDir):
+    pdh.makeDirectory(structureDir)
+    pdh.copyFile(sourceDir, modelFile, structureDir)
+    pdh.unzipFile(os.path.join(structureDir, modelFile))
+
+def timeRetrieval(retrieveFunction, sourceDir, modelFiles, structureDir):
+    startTime = time.time()
+    for modelFile in modelFiles:
+        retrieveFunction(sourceDir, modelFile, structureDir)
+    return time.time() - startTime
+
+def readStructures(structureDir):
+    structures = {}
+    for fileName in os.listdir(structureDir):
+        structures[fileName] = open(os.path.join(structureDir, fileName)).read()
+    return structures
+
+def main():
+    modelCount = 300
+    atomCount = 2000
+    if (len(sys.argv) > 1):
+        modelCount = int(sys.argv[1])
+    if (len(sys.argv) > 2):
+        atomCount = int(sys.argv[2])
+    tempDir = tempfile.mkdtemp()
+    try:
+        sourceDir = os.path.join(tempDir, "source")
+        os.mkdir(sourceDir)
+        modelFiles = writeSourceModels(sourceDir, modelCount, atomCount)
+        pdh = pcssTools.PcssDirectoryHandler({}, {})
+
+        shellDir = os.path.join(tempDir, "shellOut", "structures")
+        shellTime = timeRetrieval(retrieveShellOut, sourceDir, modelFiles, shellDir)
+        inProcessDir = os.path.join(tempDir, "inProcess", "structures")
+        inProcessTime = timeRetrieval(lambda sourceDir, modelFile, structureDir: retrieveInProcess(pdh, sourceDir, modelFile, structureDir),
+                                      sourceDir, modelFiles, inProcessDir)
+        if (readStructures(shellDir) != readStructures(inProcessDir)):
+            print "ERROR: in-process retrieval produced different files than shell-out retrieval"
+        print "models: %s atoms per model: %s" % (modelCount, atomCount)
+        print "shell-out: %.3f s (%.2f ms/model)  in-process: %.3f s (%.2f ms/model)  speedup: %.1fx" % (
+            shellTime, 1000 * shellTime / modelCount, inProcessTime, 1000 * inProcessTime / modelCount, shellTime / inProcessTime)
+    finally:
+        shutil.rmtree(tempDir)
+
+if __name__ == '__main__':
+    main()
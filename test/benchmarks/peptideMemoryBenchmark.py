@@ -0,0 +1,94 @@
+"""Measure bytes used per PcssPeptide when scanning a synthetic proteome.
+
+Run from the test directory:
+    PYTHONPATH=../lib python benchmarks/peptideMemoryBenchmark.py [proteinCount] [proteinLength]
+
+Writes a random proteome fasta to a temporary directory, scans it with the test rules file and
+reports the size of the peptide object graph (peptides plus their feature objects) divided by
+the number of peptides. Synthetic sequence and structure features are attached to every peptide
+so the result reflects a fully annotated run."""
+
+import sys
+import os
+import random
+import tempfile
+import shutil
+import types
+import configobj
+import pcssTools
+import pcssIO
+import pcssFeatures
+
+residues = "ACDEFGHIKLMNPQRSTVWY"
+
+def writeProteome(fileName, proteinCount, proteinLength):
+    rng = random.Random(12345)
+    fh = open(fileName, 'w')
+    for i in range(proteinCount):
+        modbaseId = "%032x" % rng.getrandbits(128)
+        fh.write(">%s|P%05d\n" % (modbaseId, i))
+        fh.write("%s\n" % "".join(rng.choice(residues) for j in range(proteinLength)))
+    fh.close()
+
+def getDeepSize(rootObjects, excludedObjects):
+    """Return total size of all objects reachable from rootObjects, not counting excludedObjects or classes"""
+    seen = set(id(x) for x in excludedObjects)
+    stack = list(rootObjects)
+    totalSize = 0
+    while (len(stack) > 0):
+        nextObject = stack.pop()
+        if (id(nextObject) in seen):
+            continue
+        if (isinstance(nextObject, (type, types.ClassType, types.ModuleType, types.FunctionType))):
+            continue
+        seen.add(id(nextObject))
+        totalSize += sys.getsizeof(nextObject)
+        if (isinstance(nextObject, dict)):
+            stack.extend(nextObject.keys())
+            stack.extend(nextObject.values())
+        elif (isinstance(nextObject, (list, tuple, set, frozenset))):
+            stack.extend(nextObject)
+        if (hasattr(nextObject, "__dict__")):
+            stack.append(nextObject.__dict__)
+        for slotClass in type(nextObject).__mro__:
+            for slotName in getattr(slotClass, "__slots__", ()):
+                if (hasattr(nextObject, slotName)):
+                    stack.append(getattr(nextObject, slotName))
+    return totalSize
+
+def addSyntheticFeatures(peptide):
+    peptideLength = peptide.getPeptideLength()
+    peptide.addFeature(pcssFeatures.DisorderStringFeature(["O"] * peptideLength))
+    peptide.addFeature(pcssFeatures.DisorderScoreFeature([0.1] * peptideLength))
+    peptide.addFeature(pcssFeatures.PsipredStringFeature(["L"] * peptideLength))
+    peptide.addFeature(pcssFeatures.PsipredScoreFeature([0.2] * peptideLength))
+    peptide.addFeature(pcssFeatures.DsspStructureFeature(["H"] * peptideLength))
+    peptide.addFeature(pcssFeatures.DsspAccFeature([0.3] * peptideLength))
+
+def main():
+    proteinCount = 3000
+    proteinLength = 300
+    if (len(sys.argv) > 1):
+        proteinCount = int(sys.argv[1])
+    if (len(sys.argv) > 2):
+        proteinLength = int(sys.argv[2])
+    pcssConfig = configobj.ConfigObj("testConfig/testPcssConfig.txt")
+    pcssConfig["run_name"] = "peptideMemoryBenchmark"
+    tempDir = tempfile.mkdtemp()
+    try:
+        fastaFile = os.path.join(tempDir, "proteome.fasta")
+        writeProteome(fastaFile, proteinCount, proteinLength)
+        runner = pcssTools.AnnotationRunner(pcssConfig)
+        spi = pcssIO.ScanPeptideImporter(runner)
+        proteins = spi.readInputFile(fastaFile)
+        peptides = pcssTools.getAllPeptides(proteins, True)
+        for peptide in peptides:
+            addSyntheticFeatures(peptide)
+        totalSize = getDeepSize(peptides, [runner])
+        print "proteins: %s peptides: %s total bytes: %s bytes per peptide: %s" % (proteinCount, len(peptides), totalSize,
+                                                                                    totalSize / max(len(peptides), 1))
+    finally:
+        shutil.rmtree(tempDir)
+
+if __name__ == '__main__':
+    main()
@@ -9,6 +9,11 @@ import pcssErrors
 import logging
 import sys
 import pcssTests
+import pcssIO
+import numpy
+import shutil
+import threading
+import time
 
 class DisopredData:
     def __init__(self):
@@ -49,5 +54,272 @@ class TestDisopred(pcssTests.TestSequenceFeatures):
     def processResultFile(self):
         self.proteins[0].processDisopred(self.sequenceFeatureReader, self.sequenceFeatureRunner)
 
+    def writeFakeCommand(self, sleepSeconds):
+        """Write script standing in for rundisopred; it writes an empty result file for its fasta file into the cwd"""
+        commandFile = self.runner.pdh.getFullOutputFile("fakeDisopred.sh")
+        fh = open(commandFile, 'w')
+        fh.write("#!/bin/sh\nsleep %s\ntouch `basename $1 .fasta`.diso\n" % sleepSeconds)
+        fh.close()
+        os.chmod(commandFile, 0755)
+        self.fileHandler.sequenceCmd = commandFile
+        self.internalConfig["root_disopred_dir"] = self.runner.pdh.getFullOutputFile("pooledDisopredResults")
+
+    def test_pooled_runner(self):
+        initialCwd = os.getcwd()
+        proteins = pcssIO.ScanPeptideImporter(self.runner).readInputFile(self.getLargeFastaFile())
+        self.writeFakeCommand(1)
+        self.internalConfig["sequence_feature_worker_count"] = 4
+        self.sequenceFeatureRunner.runMissingSequenceFeatures(proteins)
+        for protein in proteins:
+            self.assertEquals(self.fileHandler.outputFileExists(protein.modbaseSequenceId), not protein.hasErrors())
+        self.assertEquals(os.getcwd(), initialCwd)
+
+    def test_pooled_runner_timeout(self):
+        self.writeFakeCommand(10)
+        self.internalConfig["sequence_feature_timeout"] = 1
+        with self.assertRaises(pcssErrors.PcssGlobalException) as e:
+            self.sequenceFeatureRunner.runMissingSequenceFeatures(self.proteins)
+        self.handleTestException(e)
+        self.assertFalse(self.fileHandler.outputFileExists(self.proteins[0].modbaseSequenceId))
+
+    def writeFakePssmCommands(self, sleepSeconds=0):
+        """Write scripts standing in for runpssm and rundisopredFromPssm; runpssm logs each search it runs"""
+        self.pssmLog = self.runner.pdh.getFullOutputFile("fakePssmLog.txt")
+        if (os.path.exists(self.pssmLog)):
+            os.remove(self.pssmLog)
+        pssmCommandFile = self.runner.pdh.getFullOutputFile("fakePssm.sh")
+        fh = open(pssmCommandFile, 'w')
+        fh.write("#!/bin/sh\nsleep %s\nroot=`basename $1 .fasta`\necho $root >> %s\ntouch $root.chk $root.mtx\n" % (sleepSeconds, self.pssmLog))
+        fh.close()
+        predictorCommandFile = self.runner.pdh.getFullOutputFile("fakeDisopredFromPssm.sh")
+        fh = open(predictorCommandFile, 'w')
+        fh.write("#!/bin/sh\ntest -f $2 && touch `basename $1 .fasta`.diso\n")
+        fh.close()
+        os.chmod(pssmCommandFile, 0755)
+        os.chmod(predictorCommandFile, 0755)
+
+        self.internalConfig["root_pssm_dir"] = self.runner.pdh.getFullOutputFile("sharedPssmResults")
+        self.internalConfig["root_disopred_dir"] = self.runner.pdh.getFullOutputFile("sharedPssmDisopredResults")
+        pssmFileHandler = pcssFeatureHandlers.PssmFileHandler(self.pcssConfig, self.runner.pdh)
+        pssmFileHandler.sequenceCmd = pssmCommandFile
+        self.fileHandler.pssmSequenceCmd = predictorCommandFile
+        return pssmFileHandler
+
+    def test_shared_pssm_runner(self):
+        pssmFileHandler = self.writeFakePssmCommands()
+        pssmRunner = pcssFeatureHandlers.PssmRunner(pssmFileHandler)
+        sequenceFeatureRunner = pcssFeatureHandlers.SequenceFeatureRunner(self.fileHandler, pssmRunner)
+        sequenceFeatureRunner.runMissingSequenceFeatures(self.proteins)
+
+        modbaseSeqId = self.proteins[0].modbaseSequenceId
+        self.assertTrue(self.fileHandler.outputFileExists(modbaseSeqId))
+        self.assertTrue(pssmFileHandler.outputFileExists(modbaseSeqId))
+        self.assertTrue(os.path.exists(pssmFileHandler.getCheckpointFile(modbaseSeqId)))
+
+        #second predictor reuses the cached profile instead of searching again
+        self.internalConfig["root_disopred_dir"] = self.runner.pdh.getFullOutputFile("sharedPssmDisopredResults2")
+        sequenceFeatureRunner = pcssFeatureHandlers.SequenceFeatureRunner(self.fileHandler, pssmRunner)
+        sequenceFeatureRunner.runMissingSequenceFeatures(self.proteins)
+        self.assertTrue(self.fileHandler.outputFileExists(modbaseSeqId))
+        searchCount = len([protein for protein in self.proteins if not protein.hasErrors()])
+        self.assertEquals(len(open(self.pssmLog).readlines()), searchCount)
+
+    def test_concurrent_pssm_searches(self):
+        pssmFileHandler = self.writeFakePssmCommands(1)
+        self.internalConfig["root_pssm_dir"] = self.runner.pdh.getFullOutputFile("concurrentPssmResults")
+        proteins = pcssIO.ScanPeptideImporter(self.runner).readInputFile(self.getLargeFastaFile())
+        proteins = [protein for protein in proteins if not protein.hasErrors()][0:4]
+        pssmRunner = pcssFeatureHandlers.PssmRunner(pssmFileHandler)
+
+        #each protein is asked for by two threads; the same protein is searched once, different proteins at once
+        threads = [threading.Thread(target=pssmRunner.getPssmFile, args=(protein,)) for protein in proteins + proteins]
+        startTime = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(time.time() - startTime < len(proteins))
+        self.assertEquals(sorted(open(self.pssmLog).read().split()), sorted([protein.modbaseSequenceId for protein in proteins]))
+
+    def test_batch_pssm_runner(self):
+        pssmFileHandler = self.writeFakePssmCommands()
+        batchLog = self.runner.pdh.getFullOutputFile("fakePssmBatchLog.txt")
+        if (os.path.exists(batchLog)):
+            os.remove(batchLog)
+        batchCommandFile = self.runner.pdh.getFullOutputFile("fakePssmBatch.sh")
+        fh = open(batchCommandFile, 'w')
+        fh.write("#!/bin/sh\necho $1 >> %s\nfor root in `grep '>' $1 | cut -c2-`; do touch $root.chk $root.mtx; done\n" % batchLog)
+        fh.close()
+        os.chmod(batchCommandFile, 0755)
+        pssmFileHandler.batchSequenceCmd = batchCommandFile
+        self.internalConfig["use_batch_pssm"] = True
+        self.internalConfig["root_pssm_dir"] = self.runner.pdh.getFullOutputFile("batchPssmResults")
+        self.internalConfig["root_disopred_dir"] = self.runner.pdh.getFullOutputFile("batchPssmDisopredResults")
+        self.internalConfig["sequence_feature_worker_count"] = 4
+
+        proteins = pcssIO.ScanPeptideImporter(self.runner).readInputFile(self.getLargeFastaFile())
+        pssmRunner = pcssFeatureHandlers.PssmRunner(pssmFileHandler)
+        sequenceFeatureRunner = pcssFeatureHandlers.SequenceFeatureRunner(self.fileHandler, pssmRunner)
+        sequenceFeatureRunner.runMissingSequenceFeatures(proteins)
+
+        for protein in proteins:
+            self.assertEquals(pssmFileHandler.outputFileExists(protein.modbaseSequenceId), not protein.hasErrors())
+            self.assertEquals(self.fileHandler.outputFileExists(protein.modbaseSequenceId), not protein.hasErrors())
+        self.assertEquals(len(open(batchLog).readlines()), 1)
+        self.assertFalse(os.path.exists(self.pssmLog))
+
+    def test_batch_pssm_script(self):
+        #runs the real runpssmBatch with stand-ins for blastpgp and makemat, which log each call they get
+        ncbiDir = self.runner.pdh.getFullOutputFile("fakeNcbi")
+        self.runner.pdh.makeDirectory(ncbiDir)
+        ncbiLog = os.path.join(ncbiDir, "calls.txt")
+        if (os.path.exists(ncbiLog)):
+            os.remove(ncbiLog)
+        fh = open(os.path.join(ncbiDir, "blastpgp"), 'w')
+        fh.write("#!/bin/sh\necho blastpgp $@ >> %s\nwhile [ $# -gt 0 ]; do if [ $1 = -C ]; then touch $2; fi; shift; done\n" % ncbiLog)
+        fh.close()
+        fh = open(os.path.join(ncbiDir, "makemat"), 'w')
+        fh.write("#!/bin/sh\necho makemat $@ >> %s\ntest -f `cat $2.pn` && touch $2.mtx $2.aux $2.mn\n" % ncbiLog)
+        fh.close()
+        os.chmod(os.path.join(ncbiDir, "blastpgp"), 0755)
+        os.chmod(os.path.join(ncbiDir, "makemat"), 0755)
+
+        pssmFileHandler = pcssFeatureHandlers.PssmFileHandler(self.pcssConfig, self.runner.pdh)
+        pssmFileHandler.batchSequenceCmd = "%s fakeDatabase %s" % (os.path.join(self.internalConfig["pcss_directory"], "bin", "runPssm", "runpssmBatch"), ncbiDir)
+        self.internalConfig["use_batch_pssm"] = True
+        self.internalConfig["root_pssm_dir"] = self.runner.pdh.getFullOutputFile("batchScriptPssmResults")
+        proteins = pcssIO.ScanPeptideImporter(self.runner).readInputFile(self.getLargeFastaFile())
+        pcssFeatureHandlers.PssmRunner(pssmFileHandler).runMissingSequenceFeatures(proteins)
+
+        searchedProteins = [protein for protein in proteins if not protein.hasErrors()]
+        for protein in searchedProteins:
+            self.assertTrue(pssmFileHandler.outputFileExists(protein.modbaseSequenceId))
+            self.assertTrue(os.path.exists(pssmFileHandler.getCheckpointFile(protein.modbaseSequenceId)))
+        calls = [line.split() for line in open(ncbiLog).readlines()]
+        self.assertEquals(len([call for call in calls if call[0] == "blastpgp"]), len(searchedProteins))
+        self.assertEquals(len([call for call in calls if call[0] == "makemat"]), len(searchedProteins))
+        for call in calls:
+            if (call[0] == "blastpgp"):
+                self.assertEquals(call[call.index("-d") + 1], "fakeDatabase")
+
+    def test_result_sidecar(self):
+        modbaseSeqId = self.proteins[0].modbaseSequenceId
+        sourceFile = self.fileHandler.getSequenceFeatureFile(modbaseSeqId)
+        self.internalConfig["root_disopred_dir"] = self.runner.pdh.getFullOutputFile("sidecarDisopredResults")
+        self.runner.pdh.makeDirectory(self.fileHandler.getSequenceFeatureDir(modbaseSeqId))
+        resultFile = self.fileHandler.getSequenceFeatureFile(modbaseSeqId)
+        shutil.copy(sourceFile, resultFile)
+        sidecarFile = self.sequenceFeatureReader.getSidecarFileName(resultFile)
+        if (os.path.exists(sidecarFile)):
+            os.remove(sidecarFile)
+
+        parsedCalls = self.sequenceFeatureReader.readResult(modbaseSeqId)
+        self.assertTrue(os.path.exists(sidecarFile))
+        mappedCalls = self.sequenceFeatureReader.readResult(modbaseSeqId)
+        self.assertFalse(mappedCalls.scores.flags.owndata)
+        for arrayName in ["residueCodes", "callCodes", "scores", "hasCall"]:
+            self.assertTrue(numpy.array_equal(getattr(parsedCalls, arrayName), getattr(mappedCalls, arrayName)))
+        self.assertEquals(mappedCalls.makeFullCallString(), self.seqData.getExpectedFullStringResult())
+
+        #changed result file makes the sidecar stale; it is reparsed and the sidecar rewritten
+        fh = open(resultFile, 'a')
+        fh.write("\n")
+        fh.close()
+        staleCalls = self.sequenceFeatureReader.readResult(modbaseSeqId)
+        self.assertTrue(staleCalls.scores.flags.owndata)
+        self.assertFalse(self.sequenceFeatureReader.readResult(modbaseSeqId).scores.flags.owndata)
+
+    def test_result_sidecar_shared_directory(self):
+        modbaseSeqId = self.proteins[0].modbaseSequenceId
+        sourceFile = self.fileHandler.getSequenceFeatureFile(modbaseSeqId)
+        self.internalConfig["root_disopred_dir"] = self.runner.pdh.getFullOutputFile("sharedSidecarDisopredResults")
+        resultDir = self.fileHandler.getSequenceFeatureDir(modbaseSeqId)
+        self.runner.pdh.makeDirectory(resultDir)
+        resultFile = self.fileHandler.getSequenceFeatureFile(modbaseSeqId)
+        shutil.copy(sourceFile, resultFile)
+        sidecarFile = self.sequenceFeatureReader.getSidecarFileName(resultFile)
+
+        #directory the run can't write to is only read
+        access = os.access
+        os.access = lambda path, mode: (path != resultDir and access(path, mode))
+        try:
+            calls = self.sequenceFeatureReader.readResult(modbaseSeqId)
+        finally:
+            os.access = access
+        self.assertEquals(calls.makeFullCallString(), self.seqData.getExpectedFullStringResult())
+        self.assertEquals(os.listdir(resultDir), [os.path.basename(resultFile)])
+
+        #sidecar is renamed into place, leaving no temporary file
+        self.sequenceFeatureReader.readResult(modbaseSeqId)
+        self.assertEquals(sorted(os.listdir(resultDir)), sorted([os.path.basename(resultFile), os.path.basename(sidecarFile)]))
+
+    def test_feature_store(self):
+        modbaseSeqId = self.proteins[0].modbaseSequenceId
+        sourceFile = self.fileHandler.getSequenceFeatureFile(modbaseSeqId)
+        databaseFile = self.runner.pdh.getFullOutputFile("sequenceFeatures.sqlite")
+        if (os.path.exists(databaseFile)):
+            os.remove(databaseFile)
+        commandFile = self.runner.pdh.getFullOutputFile("fakeDisopredCopy.sh")
+        fh = open(commandFile, 'w')
+        fh.write("#!/bin/sh\ncp %s .\n" % sourceFile)
+        fh.close()
+        os.chmod(commandFile, 0755)
+
+        featureStore = pcssFeatureHandlers.SequenceFeatureStore(databaseFile)
+        fileHandler = pcssFeatureHandlers.DisopredFileHandler(self.pcssConfig, self.runner.pdh, featureStore)
+        fileHandler.sequenceCmd = commandFile
+        self.internalConfig["root_disopred_dir"] = self.runner.pdh.getFullOutputFile("featureStoreDisopredResults")
+        self.assertFalse(fileHandler.outputFileExists(modbaseSeqId))
+
+        pcssFeatureHandlers.SequenceFeatureRunner(fileHandler).runMissingSequenceFeatures(self.proteins[0:1])
+        self.assertTrue(fileHandler.outputFileExists(modbaseSeqId))
+        self.assertFalse(os.path.exists(fileHandler.getSequenceFeatureDir(modbaseSeqId)))
+        self.assertEquals(fileHandler.getExistingResultIds([modbaseSeqId, "fakeId"]), set([modbaseSeqId]))
+
+        #new store object on the same database sees the saved result; bulk read matches reading the result file
+        featureStore.close()
+        fileHandler.featureStore = pcssFeatureHandlers.SequenceFeatureStore(databaseFile)
+        reader = pcssFeatureHandlers.DisopredReader(fileHandler)
+        reader.prefetchResults(self.proteins)
+        storedCalls = reader.readResult(modbaseSeqId)
+        fileCalls = self.fileHandler.getCallSetClass().fromResultFile(sourceFile)
+        for arrayName in ["residueCodes", "callCodes", "scores", "hasCall"]:
+            self.assertTrue(numpy.array_equal(getattr(storedCalls, arrayName), getattr(fileCalls, arrayName)))
+        self.assertEquals(reader.readResult(modbaseSeqId).makeFullCallString(), self.seqData.getExpectedFullStringResult())
+        fileHandler.featureStore.close()
+
+    def test_feature_store_bad_result(self):
+        modbaseSeqId = self.proteins[0].modbaseSequenceId
+        badLineFile = os.path.join(self.getErrorInputFile("badLine"), modbaseSeqId[0:2], "%s.diso" % modbaseSeqId)
+        databaseFile = self.runner.pdh.getFullOutputFile("badResultFeatures.sqlite")
+        if (os.path.exists(databaseFile)):
+            os.remove(databaseFile)
+        commandFile = self.runner.pdh.getFullOutputFile("fakeDisopredBadLine.sh")
+        fh = open(commandFile, 'w')
+        fh.write("#!/bin/sh\ncp %s .\n" % badLineFile)
+        fh.close()
+        os.chmod(commandFile, 0755)
+
+        featureStore = pcssFeatureHandlers.SequenceFeatureStore(databaseFile)
+        fileHandler = pcssFeatureHandlers.DisopredFileHandler(self.pcssConfig, self.runner.pdh, featureStore)
+        fileHandler.sequenceCmd = commandFile
+        sequenceFeatureRunner = pcssFeatureHandlers.SequenceFeatureRunner(fileHandler)
+
+        #malformed result is logged and not saved instead of aborting the run; reading it records the error for the peptides
+        sequenceFeatureRunner.runMissingSequenceFeatures(self.proteins[0:1])
+        self.assertFalse(fileHandler.outputFileExists(modbaseSeqId))
+        reader = pcssFeatureHandlers.DisopredReader(fileHandler)
+        processStoredResult = lambda: self.proteins[0].processDisopred(reader, sequenceFeatureRunner)
+        self.processFeatureException(self.proteins[0].peptides.values()[0], self.getStringFeatureName(), self.getBadLineCode(),
+                                     processStoredResult)
+        featureStore.close()
+
+    def test_peptide_features_share_protein_arrays(self):
+        self.processResultFile()
+        peptide = self.proteins[0].peptides[17]
+        proteinCalls = self.proteins[0].disopredProteinCalls
+        self.assertTrue(numpy.shares_memory(peptide.attributes["disopred_score_feature"].disorderScoreList, proteinCalls.scores))
+        self.assertTrue(numpy.shares_memory(peptide.attributes["disopred_string_feature"].disorderStringList, proteinCalls.callCodes))
+
 if __name__ == '__main__':
     unittest.main()
@@ -5,6 +5,9 @@ import pcssErrors
 import pcssIO
 import pcssPeptide
 import os
+import gzip
+import errno
+import stat
 import pcssTests
 
 class TestPcssInfrastructure(pcssTests.PcssTest):
@@ -34,11 +37,98 @@ class TestPcssInfrastructure(pcssTests.PcssTest):
         self.assertRaises(pcssErrors.PcssShutilError, self.pcssRunner.pdh.moveFile, sourceDir, sourceFile, destinationDir)
         open(os.path.join(sourceDir, sourceFile), 'w').close()
 
-    def test_subprocess_error(self):
+    def makeExecutableFile(self, directory, fileName):
+        self.pcssRunner.pdh.makeDirectory(directory)
+        fileName = os.path.join(directory, fileName)
+        fh = open(fileName, 'w')
+        fh.write("#!/bin/sh\n")
+        fh.close()
+        os.chmod(fileName, 0750)
+        return fileName
+
+    def test_copy_keeps_mode(self):
+        sourceDir = self.pcssRunner.pdh.getFullOutputFile("modeSourceDir")
+        destinationDir = self.pcssRunner.pdh.getFullOutputFile("modeDestinationDir")
+        self.pcssRunner.pdh.makeDirectory(destinationDir)
+        self.makeExecutableFile(sourceDir, "copyScript.sh")
+        self.pcssRunner.pdh.copyFile(sourceDir, "copyScript.sh", destinationDir)
+        self.assertEquals(stat.S_IMODE(os.stat(os.path.join(destinationDir, "copyScript.sh")).st_mode), 0750)
+
+    def test_move_across_file_systems(self):
+        sourceDir = self.pcssRunner.pdh.getFullOutputFile("crossDeviceSourceDir")
+        destinationDir = self.pcssRunner.pdh.getFullOutputFile("crossDeviceDestinationDir")
+        self.pcssRunner.pdh.makeDirectory(destinationDir)
+        self.makeExecutableFile(sourceDir, "moveScript.sh")
+        self.makeExecutableFile(os.path.join(sourceDir, "moveDir"), "dirScript.sh")
+
+        #renames out of sourceDir fail as they would between file systems, so moveFile takes its copy fallback
+        rename = os.rename
+        def crossDeviceRename(sourcePath, destinationPath):
+            if (os.path.dirname(sourcePath) == sourceDir):
+                raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+            rename(sourcePath, destinationPath)
+        os.rename = crossDeviceRename
+        try:
+            self.pcssRunner.pdh.moveFile(sourceDir, "moveScript.sh", destinationDir)
+            self.pcssRunner.pdh.moveFile(sourceDir, "moveDir", destinationDir)
+        finally:
+            os.rename = rename
+        self.assertEquals(os.listdir(sourceDir), [])
+        self.assertEquals(stat.S_IMODE(os.stat(os.path.join(destinationDir, "moveScript.sh")).st_mode), 0750)
+        self.assertEquals(stat.S_IMODE(os.stat(os.path.join(destinationDir, "moveDir", "dirScript.sh")).st_mode), 0750)
+
+    def test_link_file(self):
+        linkDir = self.pcssRunner.pdh.getFullOutputFile("linkDir")
+        sourceFile = self.makeExecutableFile(linkDir, "linkSource.sh")
+        destinationFile = os.path.join(linkDir, "linkDestination.sh")
+
+        #a temporary name that is already taken is skipped rather than overwritten
+        urandom = os.urandom
+        takenName = os.path.join(linkDir, ".linkDestination.sh.%s" % ("\0" * 6).encode("hex"))
+        open(takenName, 'w').close()
+        randomBytes = ["\0" * 6, "\1" * 6]
+        os.urandom = lambda byteCount: randomBytes.pop(0)
+        try:
+            self.pcssRunner.pdh.linkFile(sourceFile, destinationFile)
+        finally:
+            os.urandom = urandom
+        self.assertEquals(os.stat(destinationFile).st_ino, os.stat(sourceFile).st_ino)
+        self.assertEquals(os.path.getsize(takenName), 0)
+        os.remove(takenName)
+        os.remove(destinationFile)
+
+        #without hard links the file is copied into place, leaving no temporary files
+        link = os.link
+        def crossDeviceLink(sourcePath, destinationPath):
+            raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+        os.link = crossDeviceLink
+        try:
+            self.pcssRunner.pdh.linkFile(sourceFile, destinationFile)
+        finally:
+            os.link = link
+        self.assertNotEquals(os.stat(destinationFile).st_ino, os.stat(sourceFile).st_ino)
+        self.assertEquals(open(destinationFile).read(), "#!/bin/sh\n")
+        self.assertEquals(sorted(os.listdir(linkDir)), ["linkDestination.sh", "linkSource.sh"])
+
+    def test_unzip_missing_file_error(self):
         with self.assertRaises(pcssErrors.PcssGlobalException) as pge:
             self.pcssRunner.pdh.unzipFile("fake.gz")
         self.handleTestException(pge)
-        self.assertTrue(pge.exception.msg.startswith("Got subprocess error"))
+        self.assertTrue(pge.exception.msg.startswith("Could not unzip"))
+        self.assertFalse(os.path.exists("fake"))
+
+    def test_unzip_file(self):
+        outputDir = self.pcssRunner.pdh.getFullOutputFile("unzipTest")
+        self.pcssRunner.pdh.makeDirectory(outputDir)
+        self.pcssRunner.pdh.makeDirectory(outputDir)
+        zipFile = os.path.join(outputDir, "testUnzip.pdb.gz")
+        fh = gzip.open(zipFile, 'wb')
+        fh.write("ATOM\n" * 1000)
+        fh.close()
+        self.pcssRunner.pdh.unzipFile(zipFile)
+        self.assertEquals(open(os.path.join(outputDir, "testUnzip.pdb")).read(), "ATOM\n" * 1000)
+        self.assertFalse(os.path.exists(zipFile))
+        self.assertEquals(os.listdir(outputDir), ["testUnzip.pdb"])
         
     def test_gunzip_error(self):
         with self.assertRaises(pcssErrors.PcssGlobalException) as pge:
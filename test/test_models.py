@@ -8,8 +8,13 @@ import pcssFeatures
 import pcssFeatureHandlers
 import pcssErrors
 import runpy
+import random
+import shutil
+import gzip
+import numpy
 import pcssIO
 import pcssTests
+import weakref
 from Bio import PDB
 
 class TestModels(pcssTests.PcssTest):
@@ -52,9 +57,157 @@ class TestModels(pcssTests.PcssTest):
 
     def test_dssp_error(self):
         pcssProtein = self.addModelsToTestProtein()
+        self.runner.internalConfig['use_dssp_cache'] = False
         self.runner.internalConfig['dssp_executable'] = "fake"
         self.processModelException("peptide_error_dssp_error", pcssProtein.processDssp)
 
+        #model file removed before it is read (e.g. evicted from a structure cache) is a DSSP error, not a crash
+        with self.assertRaises(pcssErrors.DsspException):
+            pcssModels.runDsspOnModelFile("true", self.runner.pdh.getFullOutputFile("missingModel.pdb"))
+
+    def test_dssp_runner_error(self):
+        #failure in the pooled DSSP stage is kept by the model and recorded for each of its peptides afterwards
+        pcssProtein = self.createTestProtein()
+        self.runner.modelTable = self.modelTable
+        self.runner.internalConfig['use_dssp_cache'] = False
+        self.runner.internalConfig['dssp_executable'] = "fake"
+        self.assertFalse(pcssProtein.hasLoadedModels())
+        pcssModels.DsspRunner(self.runner).runMissingDssp([pcssProtein])
+        self.assertTrue(pcssProtein.hasLoadedModels())
+        bestModel = pcssProtein.peptides[2].bestModel
+        self.assertEquals(bestModel.dsspException.code, "peptide_error_dssp_error")
+        self.processModelException("peptide_error_dssp_error", pcssProtein.processDssp)
+
+    def makeModelSourceDirectory(self, pcssModel):
+        """Write a source tree laid out like a modbase NewModelStyle run holding pcssModel's local file, point the run
+        info at it and remove pcssModel's file from the structure directory; return the local file"""
+        sourceDir = self.runner.pdh.getFullOutputFile("modelSource")
+        if (os.path.exists(sourceDir)):
+            shutil.rmtree(sourceDir)
+        runInfoFile = self.runner.pdh.getFullOutputFile("modelSourceRunInfo.txt")
+        fh = open(runInfoFile, 'w')
+        fh.write("[human_2008]\npath = %s\noffset = 0\nstyle = NewModelStyle\n" % sourceDir)
+        fh.close()
+        self.runner.internalConfig["model_run_info"] = runInfoFile
+
+        localModelFile = os.path.join(self.runner.pcssConfig["user_pcss_directory"], "data", "features", "dssp", pcssModel.getPdbFileName())
+        modelSourceDir = os.path.join(sourceDir, self.runner.pdh.getThreeLetterOutputDir(pcssModel.getSequenceId()), "models")
+        os.makedirs(modelSourceDir)
+        sourceFh = gzip.open(os.path.join(modelSourceDir, "%s.gz" % pcssModel.getPdbFileName()), 'wb')
+        sourceFh.write(open(localModelFile, 'r').read())
+        sourceFh.close()
+        fullModelFile = self.runner.pdh.getFullModelFile(pcssModel)
+        if (os.path.exists(fullModelFile)):
+            os.remove(fullModelFile)
+        return localModelFile
+
+    def test_run_on_source_model_file(self):
+        pcssProtein = self.addModelsToTestProtein()
+        pcssModel = pcssProtein.getRankedModels()[0]
+        localModelFile = self.makeModelSourceDirectory(pcssModel)
+        modelHandler = pcssTools.PcssModelHandler(self.runner.pcssConfig, self.runner.pdh)
+        
+        #decompressed to a temporary file that is gone afterwards; nothing is left in the structure directory
+        [tempModelFile, modelContents] = modelHandler.runOnModelFile(pcssModel, lambda modelFileName: [modelFileName, open(modelFileName, 'r').read()])
+        self.assertEquals(modelContents, open(localModelFile, 'r').read())
+        self.assertFalse(os.path.exists(tempModelFile))
+        self.assertFalse(os.path.exists(self.runner.pdh.getFullModelFile(pcssModel)))
+        self.assertEquals([modelId for (modelId, latency) in modelHandler.fetchLatencies], [pcssModel.getId()])
+
+        #file already in the structure directory is used in place
+        shutil.copy(localModelFile, self.runner.pdh.getFullModelFile(pcssModel))
+        self.assertEquals(modelHandler.runOnModelFile(pcssModel, lambda modelFileName: modelFileName), self.runner.pdh.getFullModelFile(pcssModel))
+
+    def test_prefetch_model_files(self):
+        pcssProtein = self.addModelsToTestProtein()
+        pcssModel = pcssProtein.getRankedModels()[0]
+        localModelFile = self.makeModelSourceDirectory(pcssModel)
+        fullModelFile = self.runner.pdh.getFullModelFile(pcssModel)
+        self.runner.internalConfig["keep_model_files"] = True
+        modelHandler = pcssTools.PcssModelHandler(self.runner.pcssConfig, self.runner.pdh)
+
+        #missing source is only logged by the prefetcher and raised when the file is asked for
+        missingModel = pcssModels.PcssModel(self.runner)
+        for attributeName in pcssModel.getAttributeNames():
+            missingModel.setAttribute(attributeName, pcssModel.getAttributeValue(attributeName))
+        missingModel.setAttribute("model_id", "missingModel")
+        modelHandler.prefetchModelFiles([pcssModel, missingModel])
+        self.assertEquals(open(fullModelFile, 'r').read(), open(localModelFile, 'r').read())
+        self.assertEquals([modelId for (modelId, latency) in modelHandler.fetchLatencies], [pcssModel.getId()])
+        self.assertFalse(os.path.exists(fullModelFile + ".lock"))
+        with self.assertRaises(pcssErrors.NoSourceModelException):
+            modelHandler.getLocalModelFileName(missingModel)
+
+        #waiting on a lock ends when the other fetcher's file appears; a stale lock is removed
+        lockFile = fullModelFile + ".lock"
+        open(lockFile, 'w').close()
+        self.assertFalse(modelHandler.acquireFetchLock(lockFile, fullModelFile))
+        os.remove(fullModelFile)
+        os.utime(lockFile, (0, 0))
+        lockToken = modelHandler.acquireFetchLock(lockFile, fullModelFile)
+        self.assertEquals(open(lockFile, 'r').read(), lockToken)
+
+        #a lock taken over by another fetcher is left alone on release; one already removed is fine
+        open(lockFile, 'w').write("otherHost 1 1")
+        modelHandler.releaseFetchLock(lockFile, lockToken)
+        self.assertTrue(os.path.exists(lockFile))
+        os.remove(lockFile)
+        modelHandler.releaseFetchLock(lockFile, lockToken)
+        shutil.copy(localModelFile, fullModelFile)
+
+    def test_structure_cache(self):
+        pcssProtein = self.addModelsToTestProtein()
+        pcssModel = pcssProtein.getRankedModels()[0]
+        localModelFile = self.makeModelSourceDirectory(pcssModel)
+        fullModelFile = self.runner.pdh.getFullModelFile(pcssModel)
+        cacheDir = self.runner.pdh.getFullOutputFile("structureCache")
+        if (os.path.exists(cacheDir)):
+            shutil.rmtree(cacheDir)
+        self.runner.internalConfig["structure_cache_directory"] = cacheDir
+        modelHandler = pcssTools.PcssModelHandler(self.runner.pcssConfig, self.runner.pdh)
+        structureCache = modelHandler.structureCache
+        cacheFile = structureCache.getCacheFile(pcssModel.getId())
+
+        #first use inserts the model into the cache, second one is a hit; each use gets a private link to the cached
+        #file that is removed afterwards, and nothing is left in the structure directory
+        for i in range(2):
+            [linkFile, linkInode] = modelHandler.runOnModelFile(pcssModel, lambda modelFileName: [modelFileName, os.stat(modelFileName).st_ino])
+            self.assertEquals(linkInode, os.stat(cacheFile).st_ino)
+            self.assertFalse(os.path.exists(linkFile))
+        self.assertEquals(open(cacheFile, 'r').read(), open(localModelFile, 'r').read())
+        self.assertFalse(os.path.exists(fullModelFile))
+        self.assertEquals([structureCache.hitCount, structureCache.missCount], [1, 1])
+        self.assertEquals([modelId for (modelId, latency) in modelHandler.fetchLatencies], [pcssModel.getId()])
+
+        #kept model files are hard linked from the cache
+        self.runner.internalConfig["keep_model_files"] = True
+        self.assertEquals(modelHandler.getLocalModelFileName(pcssModel), fullModelFile)
+        self.assertEquals(os.stat(fullModelFile).st_ino, os.stat(cacheFile).st_ino)
+        self.assertEquals(structureCache.hitCount, 2)
+
+        #file evicted by another run before it is linked is inserted again
+        os.remove(fullModelFile)
+        os.remove(cacheFile)
+        self.assertEquals(modelHandler.getLocalModelFileName(pcssModel), fullModelFile)
+        self.assertEquals(os.stat(fullModelFile).st_ino, os.stat(cacheFile).st_ino)
+        self.assertEquals([structureCache.hitCount, structureCache.missCount], [2, 2])
+
+        #least recently used files are evicted once the cache is over budget; links in use are not cache files
+        privateLinkDir = os.path.join(cacheDir, ".runInUse")
+        os.mkdir(privateLinkDir)
+        os.link(cacheFile, os.path.join(privateLinkDir, os.path.basename(cacheFile)))
+        self.assertEquals([cacheFileName for (modificationTime, fileSize, cacheFileName) in structureCache.getCacheFiles()], [cacheFile])
+        staleFile = structureCache.getCacheFile(pcssModel.getId()[0:2] + "stale")
+        shutil.copy(localModelFile, staleFile)
+        os.utime(staleFile, (0, 0))
+        structureCache.maxBytes = os.path.getsize(cacheFile) * 1.5
+        structureCache.addFileSize(os.path.getsize(staleFile))
+        self.assertFalse(os.path.exists(staleFile))
+        self.assertTrue(os.path.exists(cacheFile))
+        self.assertEquals(structureCache.evictionCount, 1)
+        self.assertTrue("2 hits, 2 misses, 1 evictions" in structureCache.getCountSummary())
+        shutil.copy(localModelFile, fullModelFile)
+
     def test_dssp_peptide_mismatch(self):
         pcssProtein = self.addModelsToTestProtein()
         pcssProtein.peptides[2].sequence = "FAKEFAKE"
@@ -67,6 +220,195 @@ class TestModels(pcssTests.PcssTest):
             pcssModels.PcssModelTable(self.runner, modelColumns)
         self.handleTestException(pge)
 
+    def test_indexed_model_table(self):
+        #interleave a second sequence with the test sequence's models so it gets more than one range in the index
+        lines = pcssTools.PcssFileReader(self.runner.internalConfig['model_table_file']).getLines()
+        otherLine = "\t".join(["otherSequence"] + lines[0].split('\t')[1:])
+        modelTableFile = self.runner.pdh.getFullOutputFile("indexedModelTableTest.txt")
+        fh = open(modelTableFile, 'w')
+        fh.write("#comment\n%s\n\n%s\n%s\n%s\n" % (lines[0], otherLine, "\n".join(lines[1:]), otherLine))
+        fh.close()
+        if (os.path.exists(modelTableFile + ".pcssidx")):
+            os.remove(modelTableFile + ".pcssidx")
+        self.runner.internalConfig['model_table_file'] = modelTableFile
+        modelColumns = pcssModels.PcssModelTableColumns(self.runner.internalConfig['model_table_column_file'])
+
+        self.runner.internalConfig['index_model_table'] = False
+        fullTable = pcssModels.PcssModelTable(self.runner, modelColumns)
+        self.runner.internalConfig['index_model_table'] = True
+        indexedTable = pcssModels.PcssModelTable(self.runner, modelColumns)
+        self.assertTrue(os.path.exists(indexedTable.indexedTable.getIndexFileName()))
+        self.assertEquals(len(indexedTable.getSequences()), 0)
+
+        for sequenceId in ["76c3a409540532138c6b44bde9e4d248MDDRDENQ", "otherSequence", "missingSequence"]:
+            fullModels = fullTable.getPcssModelSequence(sequenceId).getModels()
+            indexedModels = indexedTable.getPcssModelSequence(sequenceId).getModels()
+            self.assertEquals([model.getId() for model in indexedModels], [model.getId() for model in fullModels])
+        self.assertEquals(len(indexedTable.getPcssModelSequence("76c3a409540532138c6b44bde9e4d248MDDRDENQ").getModels()), 4)
+        self.assertEquals(len(indexedTable.getPcssModelSequence("otherSequence").getModels()), 2)
+        self.assertEquals(pcssIO.IndexedModelTableFile(modelTableFile).readIndexFile(), indexedTable.indexedTable.recordEntries)
+
+    def test_typed_model_columns(self):
+        #no35 is declared float, so 10.5 ranks above 9.75 (it wouldn't as a string); table text is kept for output
+        lines = pcssTools.PcssFileReader(self.runner.internalConfig['model_table_file']).getLines()
+        modelColumns = pcssModels.PcssModelTableColumns(self.runner.internalConfig['model_table_column_file'])
+        no35Column = modelColumns.getColumnNumber("no35")
+        modelTableFile = self.runner.pdh.getFullOutputFile("typedModelTableTest.txt")
+        fh = open(modelTableFile, 'w')
+        for [line, no35] in zip(lines, ["9.75", "10.5", "0.991304", "10.50"]):
+            fields = line.split('\t')
+            fields[no35Column] = no35
+            fh.write("%s\n" % "\t".join(fields))
+        fh.close()
+        self.runner.internalConfig['model_table_file'] = modelTableFile
+        self.runner.internalConfig['index_model_table'] = False
+        pcssProtein = self.addModelsToTestProtein()
+        rankedModels = pcssProtein.getRankedModels()
+        self.assertEquals([model.getAttributeValue("no35") for model in rankedModels][2:], ["9.75", "0.991304"])
+        self.assertEquals(sorted([model.getAttributeValue("no35") for model in rankedModels][0:2]), ["10.5", "10.50"])
+        self.assertEquals(rankedModels[0].getTypedValue("no35"), 10.5)
+        self.assertEquals(rankedModels[0].getTypedValue("target_beg"), int(rankedModels[0].getAttributeValue("target_beg")))
+        self.assertEquals(rankedModels[0].getAttributeValue("coverage"), float(rankedModels[0].getLength()) / pcssProtein.getSequenceLength())
+
+        #value that doesn't convert to its column type
+        fields = lines[0].split('\t')
+        fields[no35Column] = "high"
+        modelSequence = pcssModels.PcssModelSequence("badSequence")
+        with self.assertRaises(pcssErrors.PcssGlobalException) as pge:
+            modelSequence.loadModelTableFields(self.runner, [fields], modelColumns)
+        self.handleTestException(pge)
+
+    def test_ranked_model_index(self):
+        #compare against scanning the ranked list for each peptide, including ties in model bounds and peptides at model edges
+        randomGenerator = random.Random(17)
+        rankedModels = []
+        for i in range(60):
+            model = pcssModels.PcssModel(self.runner)
+            modelStart = randomGenerator.randint(1, 180)
+            model.setAttribute("target_beg", str(modelStart))
+            model.setAttribute("target_end", str(modelStart + randomGenerator.randint(1, 60)))
+            model.setAttribute("model_id", "model%s" % i)
+            rankedModels.append(model)
+        peptides = [pcssPeptide.PcssPeptide("A" * 8, start, start + 7, self.runner) for start in range(0, 250)]
+        bestModels = pcssModels.RankedModelIndex(rankedModels).getBestModels(peptides)
+        for peptide in peptides:
+            peptide.setBestModel(rankedModels)
+            self.assertEquals(bestModels.get(peptide.startPosition), peptide.bestModel)
+        self.assertTrue(0 < len(bestModels) < len(peptides))
+
+    def test_dssp_cache(self):
+        self.runner.internalConfig['use_dssp_cache'] = True
+        self.runner.internalConfig['model_directory'] = self.runner.pdh.getFullOutputFile("dsspCache")
+        if (os.path.exists(self.runner.internalConfig['model_directory'])):
+            shutil.rmtree(self.runner.internalConfig['model_directory'])
+        pcssProtein = self.addModelsToTestProtein()
+        pcssProtein.processDssp()
+        bestModel = pcssProtein.peptides[2].bestModel
+        dsspCache = self.runner.getDsspCache()
+        self.assertTrue(dsspCache.hasResults(bestModel.getId()))
+
+        #second run reads the cache without running DSSP or parsing the PDB file
+        self.runner.internalConfig['dssp_executable'] = "fake"
+        cachedProtein = self.addModelsToTestProtein()
+        cachedProtein.processDssp()
+        cachedModel = cachedProtein.peptides[2].bestModel
+        self.assertEquals(cachedModel.dsspResidueCodes.tolist(), bestModel.dsspResidueCodes.tolist())
+        self.assertEquals(cachedModel.dsspSecondaryStructure.tolist(), bestModel.dsspSecondaryStructure.tolist())
+        self.assertTrue(numpy.array_equal(cachedModel.dsspRelativeSolventAcc, bestModel.dsspRelativeSolventAcc))
+        for startPosition in pcssProtein.peptides.keys():
+            self.assertTrue(cachedProtein.peptides[startPosition].isEqual(pcssProtein.peptides[startPosition]))
+
+        #cache file for a different model is ignored
+        fakeModelId = bestModel.getId()[0:2] + "fake"
+        shutil.copy(dsspCache.getCacheFile(bestModel.getId()), dsspCache.getCacheFile(fakeModelId))
+        fakeModel = pcssModels.PcssModel(self.runner)
+        fakeModel.setAttribute("model_id", fakeModelId)
+        self.assertFalse(dsspCache.readResults(fakeModel))
+
+    def test_loaded_dssp_results(self):
+        self.runner.internalConfig['use_dssp_cache'] = True
+        self.runner.internalConfig['model_directory'] = self.runner.pdh.getFullOutputFile("dsspCache")
+        if (os.path.exists(self.runner.internalConfig['model_directory'])):
+            shutil.rmtree(self.runner.internalConfig['model_directory'])
+        self.runner.internalConfig['dssp_executable'] = "fake"
+        dsspCache = self.runner.getDsspCache()
+        self.assertEquals(self.runner.getLoadedDsspResults(), None)
+        self.runner.internalConfig['loaded_dssp_max_megabytes'] = 1
+        loadedDsspResults = self.runner.getLoadedDsspResults()
+        models = []
+        for i in range(3):
+            model = pcssModels.PcssModel(self.runner)
+            model.setAttribute("model_id", "aaLoadedModel%s" % i)
+            model.setDsspArrays(numpy.array(list("ACDEFGHIKL"), dtype='S1'), numpy.array(list("HHHHEEEE  "), dtype='S1'),
+                                numpy.arange(10, dtype=numpy.float64) / 10)
+            self.runner.pdh.makeDirectory(os.path.dirname(dsspCache.getCacheFile(model.getId())))
+            dsspCache.writeResults(model)
+            models.append(model)
+        loadedDsspResults.maxBytes = models[0].getDsspArraysSize() * 2
+
+        #adding a third model releases the least recently used one
+        loadedDsspResults.addModel(models[0])
+        loadedDsspResults.addModel(models[1])
+        models[0].loadDsspResults()
+        loadedDsspResults.addModel(models[2])
+        self.assertEquals([model.hasDsspResults() for model in models], [True, False, True])
+        self.assertEquals([loadedDsspResults.getLoadedModelCount(), loadedDsspResults.releaseCount], [2, 1])
+
+        #released results are read back from the DSSP cache when asked for, releasing the next least recently used
+        models[1].loadDsspResults()
+        self.assertEquals([model.hasDsspResults() for model in models], [False, True, True])
+        self.assertEquals(models[1].getPeptideDsspArrays(2, 4)[0].tolist(), ["D", "E", "F"])
+
+    def test_loaded_dssp_results_memory_bound(self):
+        self.runner.internalConfig['loaded_dssp_max_megabytes'] = 1
+        loadedDsspResults = self.runner.getLoadedDsspResults()
+        residueCount = 20000
+        peptideFeatures = []
+        modelArrays = []
+        for i in range(6):
+            model = pcssModels.PcssModel(self.runner)
+            model.setAttribute("model_id", "aaBoundModel%s" % i)
+            model.setDsspArrays(numpy.array(list("ACDEFGHIKL" * (residueCount / 10)), dtype='S1'),
+                                numpy.array(list("HHHHEEEE  " * (residueCount / 10)), dtype='S1'),
+                                numpy.arange(residueCount, dtype=numpy.float64) / residueCount)
+            modelArrays.append([weakref.ref(model.dsspRelativeSolventAcc), weakref.ref(model.dsspMappedStructure)])
+            loadedDsspResults.addModel(model)
+            [residueCodes, structureCalls, accValues] = model.getPeptideDsspArrays(2, 4)
+            peptideFeatures.append([pcssFeatures.DsspStructureFeature.fromMappedCalls(structureCalls), pcssFeatures.DsspAccFeature(accValues)])
+            self.assertTrue(loadedDsspResults.loadedBytes <= loadedDsspResults.maxBytes)
+
+        #peptide features keep only their own slices, so released models' arrays are freed while the features are kept
+        self.assertTrue(loadedDsspResults.releaseCount > 0)
+        self.assertEquals(len([arrays for arrays in modelArrays if arrays[0]() is not None]), loadedDsspResults.getLoadedModelCount())
+        for arrays in modelArrays[0:loadedDsspResults.releaseCount]:
+            self.assertTrue(arrays[0]() is None and arrays[1]() is None)
+        self.assertEquals(peptideFeatures[0][1].getValueString(), peptideFeatures[-1][1].getValueString())
+
+    def test_read_dssp_output(self):
+        modelFileName = self.runner.pdh.getFullOutputFile("dsspParseTest.pdb")
+        fh = open(modelFileName, 'w')
+        for (recordName, residueName, residueNumber, altLoc) in [("ATOM  ", "ALA", 1, " "), ("ATOM  ", "CYS", 2, "B"),
+                                                                  ("ATOM  ", "SER", 2, "A"), ("HETATM", "MSE", 3, " "),
+                                                                  ("HETATM", "HOH", 4, " "), ("ATOM  ", "GLY", 5, " ")]:
+            fh.write("%s%5d  CA %s%s  %4d    %8.3f%8.3f%8.3f\n" % (recordName, residueNumber, altLoc, residueName, residueNumber, 0, 0, 0))
+        fh.close()
+        residueNames = pcssModels.readModelResidueNames(modelFileName)
+        self.assertEquals(residueNames, {(1, ' ') : "ALA", (2, ' ') : "SER", (3, ' ') : "MSE", (5, ' ') : "GLY"})
+
+        dsspLines = ["==== Secondary Structure Definition by the program DSSP ====",
+                     "  #  RESIDUE AA STRUCTURE BP1 BP2  ACC"]
+        for (residueNumber, aminoAcid, structure, accessibility) in [(1, "A", "H", 53), (2, "S", " ", 260), (3, "X", "E", 10), (5, "G", "T", 42)]:
+            dsspLines.append(("%5d%5d   %s  %s" % (residueNumber, residueNumber, aminoAcid, structure)).ljust(34) + "%4d" % accessibility +
+                             " " * 65 + "%6.1f%6.1f" % (-60.0, -45.0))
+        dsspLines.insert(4, "    4        !              0")
+        [residueCodes, secondaryStructure, relativeSolventAcc] = pcssModels.readDsspOutput(dsspLines, residueNames)
+        self.assertEquals(residueCodes.tolist(), ["A", "S", "", "", "G"])
+        self.assertEquals(secondaryStructure.tolist(), ["H", "-", "E", "", "T"])
+        self.assertEquals(relativeSolventAcc[0], 53 / 106.0)
+        self.assertEquals(relativeSolventAcc[1], 1.0)
+        self.assertTrue(numpy.isnan(relativeSolventAcc[2]))
+        self.assertEquals(relativeSolventAcc[4], 0.5)
+
     def test_read_model_table(self):
 
         pcssProtein = self.addModelsToTestProtein()
@@ -91,7 +433,8 @@ class TestModels(pcssTests.PcssTest):
             pcssModel.getAttributeValue("fake")
         self.handleTestException(pge)
 
-        self.assertTrue(os.path.exists(self.runner.pdh.getFullModelFile(pcssModel)))
+        #model was read from its source file without keeping a copy in the run directory
+        self.assertFalse(os.path.exists(self.runner.pdh.getFullModelFile(pcssModel)))
 
         self.assertEquals(self.runner.getModelUrl("MYMODELID"), "http://salilab.org/modbase/search?modelID=MYMODELID&displaymode=moddetail")
 
@@ -6,10 +6,14 @@ import pcssModels
 import logging
 import pcssErrors
 import pcssIO
+import pcssCluster
 import pcssFeatureHandlers
 import pcssFeatures
 import os
 import sys
+import shutil
+import multiprocessing
+from Bio import SeqIO
 import pcssTests
 
 class TestReadInput(pcssTests.PcssTest):
@@ -134,7 +138,131 @@ class TestReadInput(pcssTests.PcssTest):
         self.assertEqual(self.proteins[0].peptides.values()[0].endPosition, 9)
         self.assertEqual(self.proteins[0].peptides.values()[0].sequence, "DREDLVYQ")
         self.assertEqual(len(self.proteins[0].peptides.values()), 19)
-        
+
+    def test_compiled_rules_match_peptide_rules(self):
+        self.proteins = self.spi.readInputFile(self.runner.pcssConfig['fasta_file'])
+        peptideLength = self.runner.getPeptideLength()
+        for protein in self.proteins:
+            sequence = str(protein.proteinSequence)
+            expectedStarts = []
+            for i in range(0, len(sequence) - peptideLength + 1):
+                if (self.spi.rules.isValidPeptide(sequence[i:i+peptideLength])):
+                    expectedStarts.append(i)
+            self.assertEqual(list(self.spi.rules.getValidStartPositions(sequence)), expectedStarts)
+            self.assertEqual(sorted(protein.peptides.keys()), expectedStarts)
+
+
+    def test_parallel_scan_peptides(self):
+        expectedProteins = self.spi.readInputFile(self.getLargeFastaFile())
+        self.runner.pcssConfig["peptide_import_processes"] = 2
+        proteins = self.spi.readInputFile(self.getLargeFastaFile())
+        self.assertEqual([protein.modbaseSequenceId for protein in proteins], 
+                         [protein.modbaseSequenceId for protein in expectedProteins])
+        for (protein, expectedProtein) in zip(proteins, expectedProteins):
+            self.assertEqual(protein.proteinSequence, expectedProtein.proteinSequence)
+            self.assertEqual(sorted(protein.peptides.keys()), sorted(expectedProtein.peptides.keys()))
+            for (startPosition, peptide) in protein.peptides.iteritems():
+                self.assertEqual(peptide.sequence, expectedProtein.peptides[startPosition].sequence)
+
+        fastaReader = pcssIO.FastaReader(self.getLargeFastaFile())
+        offsets = fastaReader.getRecordBoundaryOffsets(5)
+        chunkRecords = []
+        scannedRecords = []
+        for i in range(len(offsets) - 1):
+            chunkRecords += list(pcssIO.FastaReader(self.getLargeFastaFile(), startOffset=offsets[i], endOffset=offsets[i + 1]))
+            chunkArgs = (self.getLargeFastaFile(), offsets[i], offsets[i + 1], self.runner.pcssConfig['rules_file'], self.runner.getPeptideLength())
+            scannedRecords += [(recordId, sequence) for (recordId, sequence, startPositions) in pcssIO.scanFastaChunk(chunkArgs)]
+        self.assertEqual(chunkRecords, list(fastaReader))
+        self.assertEqual(scannedRecords, chunkRecords)
+
+        #stopping early shuts the worker pool down
+        proteinIterator = self.spi.iterateProteins(self.getLargeFastaFile())
+        self.assertEqual(proteinIterator.next().modbaseSequenceId, expectedProteins[0].modbaseSequenceId)
+        proteinIterator.close()
+        self.assertEqual(multiprocessing.active_children(), [])
+
+    def test_motif_rules(self):
+        rulesFile = self.runner.pdh.getFullOutputFile("motifRulesFile")
+        fh = open(rulesFile, 'w')
+        fh.write("1 P\nallow 2 D E K R\nrequire ST\nmotif ...[^CW].[AG]\n")
+        fh.close()
+        rules = pcssIO.ParsingRules(rulesFile)
+        self.assertTrue(rules.isValidPeptide("ADSAAAAA"))
+        self.assertFalse(rules.isValidPeptide("PDSAAAAA"))
+        self.assertFalse(rules.isValidPeptide("AASAAAAA"))
+        self.assertFalse(rules.isValidPeptide("ADAAAAAA"))
+        self.assertFalse(rules.isValidPeptide("ADSCAAAA"))
+        self.assertFalse(rules.isValidPeptide("ADSAAPAA"))
+
+        rules.compileAllowedResidueTable(8)
+        for (recordId, sequence) in pcssIO.FastaReader(self.getLargeFastaFile()):
+            expectedStarts = [i for i in range(0, len(sequence) - 7) if rules.isValidPeptide(sequence[i:i+8])]
+            self.assertEqual(list(rules.getValidStartPositions(sequence)), expectedStarts)
+
+        fh = open(rulesFile, 'w')
+        fh.write("motif ..[DE\n")
+        fh.close()
+        with self.assertRaises(pcssErrors.PcssGlobalException) as e:
+            pcssIO.ParsingRules(rulesFile)
+        self.handleTestException(e)
+
+    def test_fasta_reader(self):
+        fh = open(self.getLargeFastaFile(), 'r')
+        expectedRecords = [(seqRecord.id, str(seqRecord.seq)) for seqRecord in SeqIO.FastaIO.FastaIterator(fh)]
+        fh.close()
+        self.assertEqual(list(pcssIO.FastaReader(self.getLargeFastaFile())), expectedRecords)
+        #small buffer so records span several reads
+        self.assertEqual(list(pcssIO.FastaReader(self.getLargeFastaFile(), bufferSize=7)), expectedRecords)
+
+    def test_indexed_fasta_file(self):
+        fastaFile = self.runner.pdh.getFullOutputFile("indexedFastaTest.txt")
+        shutil.copy(self.getLargeFastaFile(), fastaFile)
+        fh = open(fastaFile, 'r')
+        seqRecords = list(SeqIO.FastaIO.FastaIterator(fh))
+        fh.close()
+
+        indexedFasta = pcssIO.IndexedFastaFile(fastaFile)
+        self.assertTrue(os.path.exists(indexedFasta.getIndexFileName()))
+        self.assertEqual(indexedFasta.getRecordIds(), [seqRecord.id for seqRecord in seqRecords])
+        for seqRecord in seqRecords:
+            self.assertEqual(indexedFasta.getSequence(seqRecord.id), str(seqRecord.seq))
+            self.assertEqual(indexedFasta.getSequenceByModbaseId(seqRecord.id.split('|')[0]), str(seqRecord.seq))
+        self.assertEqual([recordId for (recordId, sequence) in indexedFasta.iterateRecords(sortById=True)],
+                         sorted(seqRecord.id for seqRecord in seqRecords))
+        indexedFasta.close()
+
+        #index is reused while current and rebuilt once the fasta file changes
+        self.assertEqual(pcssIO.IndexedFastaFile(fastaFile).readIndexFile(), indexedFasta.recordEntries)
+        fh = open(fastaFile, 'a')
+        fh.write(">newSequence|P00000\nMDDRDENQ\n")
+        fh.close()
+        os.utime(fastaFile, (0, 0))
+        newIndexedFasta = pcssIO.IndexedFastaFile(fastaFile)
+        self.assertEqual(newIndexedFasta.getSequenceByModbaseId("newSequence"), "MDDRDENQ")
+        self.assertEqual(newIndexedFasta.getRecordCount(), len(seqRecords) + 1)
+        newIndexedFasta.close()
+
+    def test_duplicate_fasta_ids(self):
+        #records sharing an id each keep their own sequence when fasta files are split
+        fastaFile = self.runner.pdh.getFullOutputFile("duplicateIdFastaTest.txt")
+        fh = open(fastaFile, 'w')
+        fh.write(">bbSecond\nMKKK\n>aaDuplicate\nMDDR\n>aaDuplicate\nMEEQ\n")
+        fh.close()
+        expectedRecords = [("aaDuplicate", "MDDR"), ("aaDuplicate", "MEEQ"), ("bbSecond", "MKKK")]
+        self.assertEqual(list(pcssIO.IndexedFastaFile(fastaFile).iterateRecords(sortById=True)), expectedRecords)
+
+        twoLetterFile = self.runner.pdh.getFullOutputFile("duplicateIdTwoLetter.txt")
+        pcssTools.TwoLetterFastaGrabber(fastaFile, "aa", twoLetterFile)
+        self.assertEqual(open(twoLetterFile, 'r').read(), ">aaDuplicate\nMDDR\n>aaDuplicate\nMEEQ\n")
+
+        #dividing the fasta file into seq batches closes the indexed fasta file when the batch files are written
+        self.runner.pcssConfig['fasta_file'] = fastaFile
+        seqDivider = pcssCluster.SeqDivider(self.runner)
+        seqDivider.divideSeqsFromFasta()
+        self.assertTrue(seqDivider.indexedFasta is None)
+        fh = open(self.runner.pdh.getSeqBatchFastaFileName(0), 'r')
+        self.assertEqual([(seqRecord.id, str(seqRecord.seq)) for seqRecord in SeqIO.FastaIO.FastaIterator(fh)], expectedRecords)
+        fh.close()
 
     def test_defined_peptides(self):
         self.runner.pcssConfig['fasta_file'] = "testInput/inputSequenceDefined.txt"
@@ -116,6 +116,49 @@ class TestRunner(pcssTests.PcssTest):
                                      "svmApplication", False, True)
 
 
+    def test_feature_plan_runner(self):
+        self.pcssConfig['fasta_file'] = self.getLargeFastaFile()
+        self.runner = pcssTools.FeaturePlanRunner(self.pcssConfig)
+        self.clearErrorFiles()
+        self.runner.execute()
+        self.assertFalse(os.path.exists(self.runner.pdh.getPcssErrorFile()))
+        self.assertFalse(os.path.exists(self.runner.pdh.getInternalErrorFile()))
+
+        reader = pcssTools.PcssFileReader(self.runner.pdh.getFullOutputFile(self.runner.internalConfig["feature_plan_file_name"]))
+        entries = [line.split('\t') for line in reader.getLines()]
+        self.assertTrue(len(entries) > 0)
+        for entry in entries:
+            self.assertEquals(len(entry), len(pcssTools.FeaturePlan.outputColumns))
+            [modbaseSeqId, psiblastSearches, runDisopred, runPsipred] = [entry[0], int(entry[3]), int(entry[4]), int(entry[5])]
+            self.assertEquals(runDisopred, not self.runner.disopredRunner.sfh.outputFileExists(modbaseSeqId))
+            self.assertEquals(runPsipred, not self.runner.psipredRunner.sfh.outputFileExists(modbaseSeqId))
+            self.assertEquals(psiblastSearches, runDisopred + runPsipred)
+            self.assertTrue(int(entry[7]) <= int(entry[2]))
+            
+    def test_streaming_annotation_output(self):
+        self.compareStreamingOutput(pcssTools.AnnotationRunner)
+
+    def test_streaming_svm_application_output(self):
+        self.compareStreamingOutput(pcssTools.SvmApplicationFeatureRunner)
+
+    def compareStreamingOutput(self, runnerClass):
+        #disopred and psipred results are already in the feature directories and no protein has models, so no
+        #external program runs; streaming one protein at a time writes the same lines as writing them all at the end
+        self.pcssConfig['fasta_file'] = self.getLargeFastaFile()
+        outputLines = {}
+        for streamingMode in [False, True]:
+            self.pcssConfig["streaming_mode"] = streamingMode
+            self.runner = runnerClass(self.pcssConfig)
+            self.runner.internalConfig['model_table_file'] = os.path.join(self.runner.internalConfig["pcss_directory"], "data", "models", "fakeIdModelTable.txt")
+            self.clearErrorFiles()
+            self.runner.execute()
+            self.assertFalse(os.path.exists(self.runner.pdh.getPcssErrorFile()))
+            self.assertFalse(os.path.exists(self.runner.pdh.getInternalErrorFile()))
+            outputFile = self.runner.pdh.getFullOutputFile(self.runner.internalConfig["annotation_output_file"])
+            outputLines[streamingMode] = open(outputFile, 'r').read().splitlines()
+        self.assertTrue(len(outputLines[False]) > 1)
+        self.assertEquals(outputLines[True], outputLines[False])
+
     def dtest_svm_application_input_runner(self):
         
         self.executeRunnerTest(self.getLargeFastaFile(), pcssTools.SvmApplicationInputRunner, "svmApplication")